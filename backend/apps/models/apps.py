@@ -0,0 +1,12 @@
+"""模型管理应用配置"""
+from django.apps import AppConfig
+
+
+class ModelsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'apps.models'
+    verbose_name = '模型管理'
+
+    def ready(self):
+        # 注册信号处理器
+        from . import signals  # noqa: F401
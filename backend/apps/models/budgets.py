@@ -0,0 +1,360 @@
+"""
+使用预算
+职责: 按提供商 extra_config['pricing'] 计算每次调用的费用, 把用量原子累加到项目/用户预算账本,
+并在调用上游之前检查账本并预留估算用量, 拒绝会超出预算的请求
+
+价格配置示例(单位由使用方约定, 如人民币元):
+    extra_config = {
+        "pricing": {
+            "input_per_1k_tokens": 0.002,   # 按输入/输出 Token 分别计价(需要响应中的 usage 明细)
+            "output_per_1k_tokens": 0.006,
+            "per_1k_tokens": 0.004,         # 没有输入/输出明细时按总 Token 计价
+            "per_image": 0.04,              # 每张图片产出
+            "per_video": 0.5,               # 每段视频产出
+            "per_request": 0                # 每次调用的固定费用
+        }
+    }
+"""
+import threading
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.ai_client.base import AIClientError
+
+from .models import ModelProvider, ModelUsageLog, UsageBudget
+
+ZERO = Decimal('0')
+THOUSAND = Decimal('1000')
+PRICING_KEYS = (
+    'input_per_1k_tokens', 'output_per_1k_tokens', 'per_1k_tokens', 'per_image', 'per_video', 'per_request',
+)
+
+
+class BudgetExceededError(AIClientError):
+    """调用会超出项目或用户预算, 未发往上游"""
+    status = 'budget_exceeded'
+
+
+def get_pricing(provider: ModelProvider) -> Dict[str, Decimal]:
+    """提供商的价格配置, 未配置时返回空字典"""
+    pricing = (provider.extra_config or {}).get('pricing') or {}
+    return {key: Decimal(str(value)) for key, value in pricing.items() if value is not None}
+
+
+def count_outputs(provider: ModelProvider, response_data: Any) -> Tuple[int, int]:
+    """
+    统计一次媒体调用产出的图片数和视频数
+
+    Returns:
+        (图片数, 视频数); 结果中没有文件列表时按提供商类型计为1个产出
+    """
+    if provider.provider_type == 'llm':
+        return 0, 0
+    files = []
+    if isinstance(response_data, dict):
+        files = [item for scene in response_data.get('scenes') or [] for item in scene if isinstance(item, dict)]
+    default = 'video' if provider.provider_type == 'image2video' else 'image'
+    if not files:
+        return (0, 1) if default == 'video' else (1, 0)
+    # 没有 MIME 类型的文件按提供商类型计
+    kinds = [str(item.get('mime_type') or default).split('/')[0] for item in files]
+    videos = kinds.count('video')
+    return len(files) - videos, videos
+
+
+def usage_cost(log: ModelUsageLog) -> Optional[Decimal]:
+    """
+    计算一条使用日志的费用
+    只有成功的上游调用计费; 缓存命中、合并请求和复用产出不产生费用
+
+    Returns:
+        费用, 提供商未配置价格时返回 None
+    """
+    pricing = get_pricing(log.model_provider)
+    if not pricing:
+        return None
+    if log.status != 'success' or log.source != 'upstream':
+        return ZERO
+    cost = pricing.get('per_request', ZERO)
+    usage = (log.response_data or {}).get('usage') if isinstance(log.response_data, dict) else None
+    usage = usage if isinstance(usage, dict) else {}
+    split_pricing = 'input_per_1k_tokens' in pricing or 'output_per_1k_tokens' in pricing
+    if split_pricing and 'prompt_tokens' in usage:
+        cost += Decimal(usage.get('prompt_tokens') or 0) * pricing.get('input_per_1k_tokens', ZERO) / THOUSAND
+        cost += Decimal(usage.get('completion_tokens') or 0) * pricing.get('output_per_1k_tokens', ZERO) / THOUSAND
+    else:
+        cost += Decimal(log.tokens_used or 0) * pricing.get('per_1k_tokens', ZERO) / THOUSAND
+    images, videos = count_outputs(log.model_provider, log.response_data)
+    cost += images * pricing.get('per_image', ZERO) + videos * pricing.get('per_video', ZERO)
+    return cost
+
+
+def estimate_cost(provider: ModelProvider, estimated_tokens: int = 0) -> Decimal:
+    """
+    调用前估算的费用上界: 固定费用 + Token 按较高的单价 + 一个图片/视频产出
+    """
+    pricing = get_pricing(provider)
+    if not pricing:
+        return ZERO
+    token_price = max(
+        pricing.get('per_1k_tokens', ZERO), pricing.get('input_per_1k_tokens', ZERO),
+        pricing.get('output_per_1k_tokens', ZERO),
+    )
+    cost = pricing.get('per_request', ZERO) + Decimal(estimated_tokens) * token_price / THOUSAND
+    if provider.provider_type == 'text2image':
+        cost += pricing.get('per_image', ZERO)
+    elif provider.provider_type == 'image2video':
+        cost += pricing.get('per_video', ZERO)
+    return cost
+
+
+def estimate_tokens(messages: Any, max_tokens: Optional[int] = None) -> int:
+    """粗略估算一次LLM调用的Token数: 输入按每4个字符1个Token, 加上输出上限"""
+    return len(str(messages)) // 4 + (max_tokens or 0)
+
+
+class BudgetReservation:
+    """
+    一次调用在有上限的账本上预留的估算用量
+    调用结束时随使用日志交给写缓冲(usage_log_buffer.record(reservation=...)), 日志落库时与实际用量
+    在同一条 UPDATE 中结算; 没有交给日志的预留(如熔断、取消)由 BudgetLedger.release() 归还。
+    日志和 release() 中只有先认领(claim)的一方结算, 不会重复归还
+    """
+
+    def __init__(self, keys: List[Tuple[str, str]], tokens: int, cost: Decimal):
+        self.keys = keys
+        self.tokens = tokens
+        self.cost = cost
+        self._lock = threading.Lock()
+        self._claimed = False
+
+    def claim(self) -> bool:
+        """认领结算责任, 只有第一次调用返回 True"""
+        with self._lock:
+            if self._claimed:
+                return False
+            self._claimed = True
+            return True
+
+
+class BudgetLedger:
+    """
+    预算账本
+
+    - apply_logs(): 日志落库时按项目/用户分组, 用 F() 表达式原子累加计数(与汇总表同一时机)
+    - check()/enforce(): 调用前用条件 UPDATE 在有上限的账本上预留本次估算用量,
+      已用量 + 在途预留 + 本次估算超过上限时拒绝; 并发调用不会同时通过检查
+    - 预留随使用日志落库时按实际用量结算, 或调用未产生日志时由 release() 归还
+
+    进程异常退出时未结算的预留会留在账本中(reserved_tokens/reserved_cost), 可通过 clear_reservations() 清除。
+    """
+
+    def __init__(self, enabled: bool = True, default_limits: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.enabled = enabled
+        self.default_limits = default_limits or {}
+
+    @classmethod
+    def from_settings(cls) -> 'BudgetLedger':
+        """根据 settings.USAGE_BUDGETS 创建账本"""
+        config = getattr(settings, 'USAGE_BUDGETS', {})
+        return cls(enabled=config.get('ENABLED', True), default_limits=config.get('DEFAULT_LIMITS', {}))
+
+    @staticmethod
+    def scope_keys(project_id=None, user_id=None) -> List[Tuple[str, str]]:
+        """一次调用涉及的账本 (scope, scope_id)"""
+        keys = []
+        if project_id:
+            keys.append(('project', str(project_id)))
+        if user_id:
+            keys.append(('user', str(user_id)))
+        return keys
+
+    def defaults(self, scope: str) -> Dict[str, Any]:
+        limits = self.default_limits.get(scope) or {}
+        cost_limit = limits.get('cost_limit')
+        return {
+            'token_limit': limits.get('token_limit'),
+            'cost_limit': None if cost_limit is None else Decimal(str(cost_limit)),
+        }
+
+    def get_or_create(self, scope: str, scope_id) -> UsageBudget:
+        budget, _ = UsageBudget.objects.get_or_create(
+            scope=scope, scope_id=str(scope_id), defaults=self.defaults(scope),
+        )
+        return budget
+
+    @staticmethod
+    def exceeded(budget: UsageBudget, estimated_tokens: int, estimated_cost: Decimal) -> Optional[str]:
+        """已用量 + 在途预留 + 本次估算超过上限时返回原因"""
+        label = budget.get_scope_display()
+        tokens = budget.tokens_used + budget.reserved_tokens
+        if budget.token_limit is not None and tokens + estimated_tokens > budget.token_limit:
+            return (f'{label} {budget.scope_id} 的Token预算不足'
+                    f'(已用 {budget.tokens_used}, 在途 {budget.reserved_tokens}/{budget.token_limit})')
+        cost = budget.cost_used + budget.reserved_cost
+        if budget.cost_limit is not None and cost + estimated_cost > budget.cost_limit:
+            return (f'{label} {budget.scope_id} 的费用预算不足'
+                    f'(已用 {budget.cost_used}, 在途 {budget.reserved_cost}/{budget.cost_limit})')
+        return None
+
+    def check(self, provider: ModelProvider, project_id=None, user_id=None,
+              estimated_tokens: int = 0) -> Tuple[Optional[str], Optional[BudgetReservation]]:
+        """
+        检查本次调用是否会超出预算, 未超出时在有上限的账本上原子地预留估算用量
+
+        每个账本一条条件 UPDATE(上限在数据库中比较), 全部在一个事务中, 任一账本不足时整体回滚
+
+        Returns:
+            (超出时的原因, 预留); 没有需要预留的账本时预留为 None
+        """
+        keys = self.scope_keys(project_id, user_id)
+        if not self.enabled or not keys:
+            return None, None
+        estimated_cost = estimate_cost(provider, estimated_tokens)
+        condition = Q()
+        for scope, scope_id in keys:
+            condition |= Q(scope=scope, scope_id=scope_id)
+        reserved = []
+        rejected = None
+        with transaction.atomic():
+            budgets = {(budget.scope, budget.scope_id): budget for budget in UsageBudget.objects.filter(condition)}
+            for scope, scope_id in keys:
+                budget = budgets.get((scope, scope_id))
+                if budget is None:
+                    defaults = self.defaults(scope)
+                    if defaults['token_limit'] is None and defaults['cost_limit'] is None:
+                        continue
+                    # 还没有用量但有默认上限, 先建账本才能预留
+                    budget = self.get_or_create(scope, scope_id)
+                if budget.token_limit is None and budget.cost_limit is None:
+                    continue
+                within_limit = UsageBudget.objects.filter(pk=budget.pk).filter(
+                    Q(token_limit__isnull=True)
+                    | Q(token_limit__gte=F('tokens_used') + F('reserved_tokens') + estimated_tokens),
+                    Q(cost_limit__isnull=True)
+                    | Q(cost_limit__gte=F('cost_used') + F('reserved_cost') + estimated_cost),
+                )
+                if estimated_tokens or estimated_cost:
+                    admitted = within_limit.update(
+                        reserved_tokens=F('reserved_tokens') + estimated_tokens,
+                        reserved_cost=F('reserved_cost') + estimated_cost,
+                    )
+                else:
+                    admitted = within_limit.exists()
+                if not admitted:
+                    # 回滚已在其他账本上做的预留
+                    transaction.set_rollback(True)
+                    rejected = budget
+                    break
+                reserved.append((scope, scope_id))
+        if rejected is not None:
+            rejected = UsageBudget.objects.filter(scope=rejected.scope, scope_id=rejected.scope_id).first() or rejected
+            reason = self.exceeded(rejected, estimated_tokens, estimated_cost)
+            return reason or f'{rejected.get_scope_display()} {rejected.scope_id} 的预算不足', None
+        if not reserved or not (estimated_tokens or estimated_cost):
+            return None, None
+        return None, BudgetReservation(reserved, estimated_tokens, estimated_cost)
+
+    def enforce(self, provider: ModelProvider, estimated_tokens: int = 0, **log_fields) -> Optional[BudgetReservation]:
+        """
+        检查预算并预留估算用量; 超出预算时写入一条 status='budget_exceeded' 的使用日志并抛出异常
+
+        Returns:
+            本次调用的预留, 需要交给调用结束时的使用日志或 release()
+
+        Raises:
+            BudgetExceededError: 调用会超出预算
+        """
+        from .usage_buffer import usage_log_buffer
+
+        reason, reservation = self.check(
+            provider, log_fields.get('project_id'), log_fields.get('user_id'), estimated_tokens,
+        )
+        if reason is None:
+            return reservation
+        usage_log_buffer.record(
+            model_provider=provider, status=BudgetExceededError.status, tokens_used=0, latency_ms=0,
+            error_message=reason, **log_fields,
+        )
+        raise BudgetExceededError(reason)
+
+    async def aenforce(self, provider: ModelProvider, estimated_tokens: int = 0,
+                       **log_fields) -> Optional[BudgetReservation]:
+        if not self.enabled or not self.scope_keys(log_fields.get('project_id'), log_fields.get('user_id')):
+            return None
+        return await sync_to_async(self.enforce)(provider, estimated_tokens, **log_fields)
+
+    def release(self, reservation: Optional[BudgetReservation]) -> None:
+        """归还没有交给使用日志的预留(已被日志认领时不做任何事)"""
+        if reservation is not None and reservation.claim():
+            self._return_reservation(reservation)
+
+    async def arelease(self, reservation: Optional[BudgetReservation]) -> None:
+        if reservation is not None and reservation.claim():
+            await sync_to_async(self._return_reservation)(reservation)
+
+    @staticmethod
+    @transaction.atomic
+    def _return_reservation(reservation: BudgetReservation) -> None:
+        for scope, scope_id in reservation.keys:
+            UsageBudget.objects.filter(scope=scope, scope_id=scope_id).update(
+                reserved_tokens=F('reserved_tokens') - reservation.tokens,
+                reserved_cost=F('reserved_cost') - reservation.cost,
+            )
+
+    @staticmethod
+    def clear_reservations() -> int:
+        """清除所有在途预留(只应在没有进行中的调用时执行, 如全部 worker 重启后)"""
+        return UsageBudget.objects.exclude(reserved_tokens=0, reserved_cost=0).update(
+            reserved_tokens=0, reserved_cost=ZERO, updated_at=timezone.now(),
+        )
+
+    def apply_logs(self, logs) -> None:
+        """
+        把一批使用日志的用量累加到账本, 并结算日志携带的预留
+
+        本地拒绝(LOCAL_STATUSES)和非上游调用(缓存、合并请求等)不计入用量, 但同样结算预留
+
+        Args:
+            logs: ModelUsageLog 实例列表
+        """
+        grouped: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+        def delta_for(key: Tuple[str, str]) -> Dict[str, Any]:
+            return grouped.setdefault(key, {
+                'request_count': 0, 'tokens_used': 0, 'cost_used': ZERO, 'reserved_tokens': 0, 'reserved_cost': ZERO,
+            })
+
+        for log in logs:
+            reservation = getattr(log, '_budget_reservation', None)
+            if reservation is not None:
+                for key in reservation.keys:
+                    delta = delta_for(key)
+                    delta['reserved_tokens'] -= reservation.tokens
+                    delta['reserved_cost'] -= reservation.cost
+            if log.source != 'upstream' or log.status in ModelUsageLog.LOCAL_STATUSES:
+                continue
+            for key in self.scope_keys(log.project_id, log.user_id):
+                delta = delta_for(key)
+                delta['request_count'] += 1
+                delta['tokens_used'] += log.tokens_used or 0
+                delta['cost_used'] += log.cost or ZERO
+        if not grouped:
+            return
+        with transaction.atomic():
+            for (scope, scope_id), delta in grouped.items():
+                self.get_or_create(scope, scope_id)
+                UsageBudget.objects.filter(scope=scope, scope_id=scope_id).update(
+                    **{field: F(field) + value for field, value in delta.items()},
+                    updated_at=timezone.now(),
+                )
+
+
+# 进程级单例
+budget_ledger = BudgetLedger.from_settings()
@@ -0,0 +1,276 @@
+"""
+提供商熔断器与自适应超时
+职责: 按提供商统计连续失败次数, 连续 failed/timeout 达到阈值后熔断(open), 熔断期间直接拒绝调用;
+冷却结束后进入半开(half_open)放行少量探测请求, 探测成功则恢复(closed), 失败则重新熔断。
+同时根据最近成功调用的延迟分布计算自适应超时(pXX × 倍数), 不超过提供商配置的 timeout。
+
+状态保存在进程内存中(与路由器的健康状态一致), 每次状态切换写入一条
+status 为 circuit_open/circuit_half_open/circuit_closed 的使用日志, 便于跨进程查看;
+熔断期间被拒绝的调用记为 short_circuited。
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.ai_client.base import AIClientError
+
+from .models import ModelProvider, ModelUsageLog
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# 状态切换记录的日志状态
+TRANSITION_STATUSES = ('circuit_open', 'circuit_half_open', 'circuit_closed')
+
+
+class CircuitOpenError(AIClientError):
+    """提供商处于熔断状态, 调用未发往上游"""
+    status = 'short_circuited'
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderCircuit:
+    """单个提供商的熔断状态和延迟样本"""
+
+    def __init__(self, sample_size: int):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.probes = 0
+        self.probe_deadline = 0.0
+        self.latencies: Deque[int] = deque(maxlen=sample_size)
+        self.adaptive_timeout: Optional[float] = None
+        self.changed_at: Optional[float] = None
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_after': round(max(self.opened_until - now, 0), 2) if self.state == OPEN else 0,
+            'adaptive_timeout': self.adaptive_timeout,
+            'latency_samples': len(self.latencies),
+            'changed_seconds_ago': None if self.changed_at is None else round(now - self.changed_at, 2),
+        }
+
+
+class CircuitBreaker:
+    """
+    提供商熔断器
+
+    - before_call(): 调用上游之前检查熔断状态, 返回本次调用应使用的超时
+    - observe_log(): usage_log_buffer 记录日志时自动回报调用结果(与路由器相同的时机)
+
+    只有上游调用(source='upstream')的 success/failed/timeout 参与统计;
+    限流、预算等本地拒绝和 unpack_failed(上游成功但输出无法拆分)不计入连续失败,
+    但会释放半开状态下占用的探测名额。
+    """
+    # 计入连续失败的 ModelUsageLog 状态
+    FAILURE_STATUSES = ('failed', 'timeout')
+
+    def __init__(self, enabled: bool = True, failure_threshold: int = 5, recovery_seconds: float = 30.0,
+                 half_open_max_calls: int = 1, adaptive_timeout: Optional[Dict[str, Any]] = None):
+        adaptive_timeout = adaptive_timeout or {}
+        self.enabled = enabled
+        self.failure_threshold = max(failure_threshold, 1)
+        self.recovery_seconds = recovery_seconds
+        self.half_open_max_calls = max(half_open_max_calls, 1)
+        self.adaptive_enabled = adaptive_timeout.get('ENABLED', True)
+        self.percentile = adaptive_timeout.get('PERCENTILE', 99)
+        self.multiplier = adaptive_timeout.get('MULTIPLIER', 3.0)
+        self.min_samples = adaptive_timeout.get('MIN_SAMPLES', 20)
+        self.sample_size = adaptive_timeout.get('SAMPLE_SIZE', 200)
+        self.min_timeout = adaptive_timeout.get('MIN_TIMEOUT', 5.0)
+        self._lock = threading.Lock()
+        self._circuits: Dict[str, ProviderCircuit] = {}
+
+    @classmethod
+    def from_settings(cls) -> 'CircuitBreaker':
+        """根据 settings.CIRCUIT_BREAKER 创建熔断器"""
+        config = getattr(settings, 'CIRCUIT_BREAKER', {})
+        return cls(
+            enabled=config.get('ENABLED', True),
+            failure_threshold=config.get('FAILURE_THRESHOLD', 5),
+            recovery_seconds=config.get('RECOVERY_SECONDS', 30.0),
+            half_open_max_calls=config.get('HALF_OPEN_MAX_CALLS', 1),
+            adaptive_timeout=config.get('ADAPTIVE_TIMEOUT', {}),
+        )
+
+    @staticmethod
+    def configured_timeout(provider: ModelProvider) -> float:
+        return float(provider.timeout or 60)
+
+    def timeout_for(self, provider: ModelProvider) -> float:
+        """提供商当前的调用超时: 自适应超时与配置的 timeout 中较小的一个"""
+        configured = self.configured_timeout(provider)
+        with self._lock:
+            circuit = self._circuits.get(str(provider.id))
+            adaptive = circuit.adaptive_timeout if circuit is not None else None
+        return configured if adaptive is None else min(adaptive, configured)
+
+    def is_open(self, provider_id, now: Optional[float] = None) -> bool:
+        """提供商是否处于熔断中(冷却未结束), 供路由器跳过"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            circuit = self._circuits.get(str(provider_id))
+            return circuit is not None and circuit.state == OPEN and circuit.opened_until > now
+
+    def before_call(self, provider: ModelProvider, **log_fields) -> float:
+        """
+        调用上游之前检查熔断状态
+
+        冷却结束的熔断进入半开状态, 放行最多 half_open_max_calls 个探测请求
+
+        Returns:
+            本次调用应使用的超时(秒)
+
+        Raises:
+            CircuitOpenError: 熔断中或半开状态的探测名额已占满(已写入使用日志)
+        """
+        if not self.enabled:
+            return self.configured_timeout(provider)
+        now = time.monotonic()
+        transition = None
+        rejected = None
+        with self._lock:
+            circuit = self._get(provider.id)
+            if circuit.state == OPEN:
+                if circuit.opened_until > now:
+                    rejected = circuit.opened_until - now
+                else:
+                    transition = self._set_state(circuit, HALF_OPEN, now)
+                    circuit.probes = 0
+            if circuit.state == HALF_OPEN and rejected is None:
+                if circuit.probes >= self.half_open_max_calls and circuit.probe_deadline > now:
+                    rejected = max(circuit.probe_deadline - now, 0.0)
+                else:
+                    if circuit.probe_deadline <= now:
+                        # 探测请求没有回报结果(如被取消), 超时后释放名额
+                        circuit.probes = 0
+                    circuit.probes += 1
+                    circuit.probe_deadline = now + self.configured_timeout(provider)
+            adaptive = circuit.adaptive_timeout
+        if transition:
+            self._record_transition(provider, HALF_OPEN, '熔断冷却结束, 放行探测请求', **log_fields)
+        if rejected is not None:
+            message = f'提供商 {provider.name} 熔断中, {rejected:.1f} 秒后重试'
+            self._record(provider, CircuitOpenError.status, message, **log_fields)
+            raise CircuitOpenError(message, rejected)
+        configured = self.configured_timeout(provider)
+        return configured if adaptive is None else min(adaptive, configured)
+
+    async def abefore_call(self, provider: ModelProvider, **log_fields) -> float:
+        if not self.enabled:
+            return self.configured_timeout(provider)
+        return await sync_to_async(self.before_call)(provider, **log_fields)
+
+    def observe_log(self, log: ModelUsageLog) -> None:
+        """从一条 ModelUsageLog 回报调用结果"""
+        if not self.enabled or log.source != 'upstream' or log.status in ModelUsageLog.CIRCUIT_STATUSES:
+            return
+        provider = log.model_provider
+        now = time.monotonic()
+        transition = None
+        with self._lock:
+            circuit = self._get(provider.id)
+            if circuit.state == HALF_OPEN:
+                circuit.probes = max(circuit.probes - 1, 0)
+            if log.status == 'success':
+                circuit.consecutive_failures = 0
+                if log.latency_ms is not None:
+                    circuit.latencies.append(log.latency_ms)
+                    circuit.adaptive_timeout = self._adaptive_timeout(circuit.latencies, provider)
+                if circuit.state == HALF_OPEN:
+                    transition = (self._set_state(circuit, CLOSED, now), '探测请求成功, 恢复调用')
+            elif log.status in self.FAILURE_STATUSES:
+                circuit.consecutive_failures += 1
+                if log.status == 'timeout' and circuit.adaptive_timeout is not None:
+                    # 延迟整体变慢时成功样本进不来, 超时后放宽自适应超时
+                    circuit.adaptive_timeout = min(
+                        circuit.adaptive_timeout * 2, self.configured_timeout(provider)
+                    )
+                if circuit.state == HALF_OPEN or (
+                        circuit.state == CLOSED and circuit.consecutive_failures >= self.failure_threshold):
+                    reason = (
+                        '探测请求失败, 重新熔断' if circuit.state == HALF_OPEN
+                        else f'连续 {circuit.consecutive_failures} 次失败/超时, 熔断'
+                    )
+                    circuit.opened_until = now + self.recovery_seconds
+                    transition = (self._set_state(circuit, OPEN, now), f'{reason} {self.recovery_seconds:g} 秒')
+        if transition and transition[0]:
+            self._record_transition(
+                provider, transition[0], transition[1], project_id=log.project_id,
+                stage_type=log.stage_type, user_id=log.user_id,
+            )
+
+    def reset(self, provider_id=None) -> None:
+        """丢弃指定提供商(或全部)的熔断状态"""
+        with self._lock:
+            if provider_id is None:
+                self._circuits.clear()
+            else:
+                self._circuits.pop(str(provider_id), None)
+
+    def snapshot(self, provider_id) -> Dict[str, Any]:
+        """提供商在当前进程中的熔断状态"""
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuits.get(str(provider_id))
+            if circuit is None:
+                return ProviderCircuit(0).snapshot(now)
+            return circuit.snapshot(now)
+
+    def _adaptive_timeout(self, latencies: Deque[int], provider: ModelProvider) -> Optional[float]:
+        """延迟样本的 pXX × 倍数(秒), 样本不足时返回 None(使用配置的 timeout)"""
+        if not self.adaptive_enabled or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        rank = min(max(math.ceil(len(ordered) * self.percentile / 100) - 1, 0), len(ordered) - 1)
+        timeout = ordered[rank] / 1000 * self.multiplier
+        return round(min(max(timeout, self.min_timeout), self.configured_timeout(provider)), 3)
+
+    def _set_state(self, circuit: ProviderCircuit, state: str, now: float) -> Optional[str]:
+        """切换状态(调用方需持有锁), 状态未变化时返回 None"""
+        if circuit.state == state:
+            return None
+        circuit.state = state
+        circuit.changed_at = now
+        if state == CLOSED:
+            circuit.consecutive_failures = 0
+        return state
+
+    def _record_transition(self, provider: ModelProvider, state: str, message: str, **log_fields) -> None:
+        self._record(provider, f'circuit_{state}', message, **log_fields)
+
+    @staticmethod
+    def _record(provider: ModelProvider, status: str, message: str, **log_fields) -> None:
+        from .usage_buffer import usage_log_buffer
+
+        usage_log_buffer.record(
+            model_provider=provider, status=status, tokens_used=0, latency_ms=0,
+            error_message=message, **log_fields,
+        )
+
+    def _get(self, provider_id) -> ProviderCircuit:
+        """获取提供商熔断状态(调用方需持有锁)"""
+        return self._circuits.setdefault(str(provider_id), ProviderCircuit(self.sample_size))
+
+
+def recent_transitions(provider_id, limit: int = 20) -> List[Tuple]:
+    """从使用日志读取提供商最近的熔断状态变化(包含所有进程)"""
+    return list(
+        ModelUsageLog.objects.filter(model_provider_id=provider_id, status__in=TRANSITION_STATUSES)
+        .order_by('-created_at')
+        .values_list('status', 'error_message', 'created_at')[:limit]
+    )
+
+
+# 进程级共享的熔断器
+circuit_breaker = CircuitBreaker.from_settings()
@@ -0,0 +1,264 @@
+"""
+媒体派生文件(缩略图/预览图/视频封面帧)
+首次请求时生成或在媒体任务完成后预先生成, 按 源文件哈希+规格 缓存,
+缓存总大小超过上限时按最近访问时间淘汰
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import MediaBlob, MediaDerivative
+from .storage import blob_store
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 未安装时只能提供原图
+    Image = ImageOps = None
+
+# 源文件损坏/无法识别(UnidentifiedImageError 是 OSError 的子类)或像素数超过 Image.MAX_IMAGE_PIXELS 的两倍
+IMAGE_ERRORS = (OSError,) if Image is None else (OSError, Image.DecompressionBombError)
+
+FORMAT_MIME_TYPES = {
+    'WEBP': ('image/webp', 'webp'),
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+}
+
+
+class DerivativeUnavailable(Exception):
+    """源文件类型不支持或缺少 Pillow/ffmpeg, 无法生成派生文件"""
+
+
+class DerivativeCache:
+    """
+    派生文件缓存
+    职责: 生成缩略图和视频封面帧, 维护 MediaDerivative 索引, 并把磁盘占用控制在上限以内
+    """
+
+    def __init__(self, root, presets: Dict[str, Dict[str, int]], image_format: str = 'WEBP', quality: int = 80,
+                 max_disk_bytes: int = 2 * 1024 ** 3, ffmpeg_binary: str = 'ffmpeg',
+                 poster_offset: float = 1.0, touch_interval: float = 60.0):
+        self.root = Path(root)
+        self.presets = presets
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.max_disk_bytes = max_disk_bytes
+        self.ffmpeg_binary = ffmpeg_binary
+        self.poster_offset = poster_offset
+        self.touch_interval = timedelta(seconds=touch_interval)
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    @classmethod
+    def from_settings(cls) -> 'DerivativeCache':
+        config = getattr(settings, 'MEDIA_DERIVATIVES', {})
+        return cls(
+            root=config.get('ROOT') or Path(settings.STORAGE_ROOT) / 'derivatives',
+            presets=config.get('PRESETS', {'thumb': {'width': 256, 'height': 256}}),
+            image_format=config.get('FORMAT', 'WEBP'),
+            quality=config.get('QUALITY', 80),
+            max_disk_bytes=config.get('MAX_DISK_BYTES', 2 * 1024 ** 3),
+            ffmpeg_binary=config.get('FFMPEG_BINARY', 'ffmpeg'),
+            poster_offset=config.get('POSTER_OFFSET', 1.0),
+            touch_interval=config.get('TOUCH_INTERVAL', 60.0),
+        )
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def relative_path(self, sha256: str, preset: str) -> str:
+        extension = FORMAT_MIME_TYPES[self.image_format][1]
+        return f'{sha256[:2]}/{sha256}/{preset}.{extension}'
+
+    def path(self, derivative: MediaDerivative) -> Path:
+        return self.root / derivative.relative_path
+
+    def get(self, blob: MediaBlob, preset: str) -> MediaDerivative:
+        """
+        获取派生文件, 不存在时生成
+
+        Raises:
+            KeyError: 未配置的规格
+            DerivativeUnavailable: 无法生成
+        """
+        if preset not in self.presets:
+            raise KeyError(preset)
+        derivative = self._lookup(blob, preset)
+        if derivative is not None:
+            return derivative
+
+        key = f'{blob.sha256}:{preset}'
+        try:
+            with self._key_lock(key):
+                # 等锁期间其他线程可能已经生成
+                derivative = self._lookup(blob, preset)
+                if derivative is None:
+                    derivative = self._generate(blob, preset)
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+        self.enforce_limit(keep=derivative.pk)
+        return derivative
+
+    def _lookup(self, blob: MediaBlob, preset: str) -> Optional[MediaDerivative]:
+        derivative = MediaDerivative.objects.filter(source=blob, preset=preset).first()
+        if derivative is None:
+            return None
+        if not self.path(derivative).is_file():
+            derivative.delete()
+            return None
+        now = timezone.now()
+        # 限制访问时间的写入频率
+        if now - derivative.last_accessed_at > self.touch_interval:
+            MediaDerivative.objects.filter(pk=derivative.pk).update(last_accessed_at=now)
+            derivative.last_accessed_at = now
+        return derivative
+
+    def load_image(self, blob: MediaBlob):
+        """读取源图片; 视频取封面帧"""
+        if Image is None:
+            raise DerivativeUnavailable('未安装 Pillow')
+        source = blob_store.path(blob.sha256)
+        if blob.mime_type.startswith('image/'):
+            image = Image.open(source)
+            # 按 EXIF 方向旋转
+            return ImageOps.exif_transpose(image)
+        if blob.mime_type.startswith('video/'):
+            return Image.open(BytesIO(self.extract_poster_frame(source)))
+        raise DerivativeUnavailable(f'不支持为 {blob.mime_type} 生成预览')
+
+    def extract_poster_frame(self, source: Path) -> bytes:
+        """用 ffmpeg 截取视频第 poster_offset 秒的帧(视频更短时取第一帧), 返回PNG数据"""
+        if shutil.which(self.ffmpeg_binary) is None:
+            raise DerivativeUnavailable('未找到 ffmpeg')
+        for offset in (self.poster_offset, 0):
+            try:
+                result = subprocess.run(
+                    [self.ffmpeg_binary, '-v', 'error', '-ss', str(offset), '-i', str(source),
+                     '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+                    capture_output=True, timeout=60,
+                )
+            except subprocess.TimeoutExpired as exc:
+                raise DerivativeUnavailable('截取封面帧超时') from exc
+            if result.returncode == 0 and result.stdout:
+                return result.stdout
+        raise DerivativeUnavailable(f"截取封面帧失败: {result.stderr.decode(errors='replace')[:200]}")
+
+    def render(self, blob: MediaBlob, preset: str) -> tuple:
+        """
+        生成派生图片
+
+        Returns:
+            (图片数据, 宽, 高)
+
+        Raises:
+            DerivativeUnavailable: 源文件无法解码(损坏、无法识别或像素数过大)
+        """
+        spec = self.presets[preset]
+        try:
+            with self.load_image(blob) as image:
+                image.draft('RGB', (spec['width'], spec['height']))  # JPEG 解码时直接缩小, 其他格式忽略
+                image = image.copy()
+        except IMAGE_ERRORS as exc:
+            raise DerivativeUnavailable(f'无法解码源文件: {exc}') from exc
+        image.thumbnail((spec['width'], spec['height']), Image.LANCZOS)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        if self.image_format == 'JPEG' and image.mode == 'RGBA':
+            image = image.convert('RGB')
+        output = BytesIO()
+        image.save(output, self.image_format, quality=self.quality)
+        return output.getvalue(), image.width, image.height
+
+    def _generate(self, blob: MediaBlob, preset: str) -> MediaDerivative:
+        content, width, height = self.render(blob, preset)
+        relative_path = self.relative_path(blob.sha256, preset)
+        target = self.root / relative_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=target.parent)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        fields = {
+            'relative_path': relative_path,
+            'mime_type': FORMAT_MIME_TYPES[self.image_format][0],
+            'size': len(content),
+            'width': width,
+            'height': height,
+            'last_accessed_at': timezone.now(),
+        }
+        try:
+            derivative, _ = MediaDerivative.objects.update_or_create(source=blob, preset=preset, defaults=fields)
+        except IntegrityError:
+            # 其他进程同时生成了同一个派生文件
+            derivative = MediaDerivative.objects.get(source=blob, preset=preset)
+        return derivative
+
+    def ensure(self, sha256: str, presets: Optional[Iterable[str]] = None) -> List[MediaDerivative]:
+        """预先生成派生文件(媒体任务完成后调用); 无法生成的规格会被跳过"""
+        blob = blob_store.get(sha256)
+        if blob is None:
+            return []
+        derivatives = []
+        for preset in presets if presets is not None else self.presets:
+            try:
+                derivatives.append(self.get(blob, preset))
+            except DerivativeUnavailable:
+                break
+        return derivatives
+
+    def disk_usage(self) -> int:
+        return MediaDerivative.objects.aggregate(total=Sum('size'))['total'] or 0
+
+    def enforce_limit(self, keep: Optional[int] = None) -> int:
+        """
+        磁盘占用超过上限时按最近访问时间从旧到新删除, 直到降到上限的90%
+
+        Args:
+            keep: 不淘汰的派生文件ID(刚生成、即将返回给请求方的文件)
+
+        Returns:
+            删除的派生文件数
+        """
+        usage = self.disk_usage()
+        if usage <= self.max_disk_bytes:
+            return 0
+        target = int(self.max_disk_bytes * 0.9)
+        removed = 0
+        oldest = MediaDerivative.objects.exclude(pk=keep).order_by('last_accessed_at').values_list(
+            'pk', 'relative_path', 'size'
+        )
+        for pk, relative_path, size in oldest.iterator(chunk_size=200):
+            if usage <= target:
+                break
+            try:
+                os.unlink(self.root / relative_path)
+            except FileNotFoundError:
+                pass
+            MediaDerivative.objects.filter(pk=pk).delete()
+            usage -= size
+            removed += 1
+        return removed
+
+
+# 进程级单例
+derivative_cache = DerivativeCache.from_settings()
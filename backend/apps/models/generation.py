@@ -0,0 +1,455 @@
+"""
+生成服务
+职责: 统一封装一次模型调用的前后处理(响应缓存、请求合并、限流、执行器调用、使用日志),
+业务代码通过这里调用模型而不是直接使用执行器
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.ai_client.base import AIClientError
+from core.ai_client.fingerprint import request_fingerprint
+from core.ai_client.openai_client import PackedResponseError
+from core.ai_client.registry import executor_registry
+from core.ai_client.response_cache import response_cache
+from core.ai_client.single_flight import single_flight
+
+from .budgets import BudgetExceededError, BudgetReservation, budget_ledger, estimate_tokens
+from .circuit_breaker import CircuitOpenError, circuit_breaker
+from .models import ModelProvider
+from .rate_limit import rate_limiter
+from .usage_buffer import usage_log_buffer
+
+
+class RateLimitedError(AIClientError):
+    """本地限流拒绝了调用"""
+    status = 'rate_limited'
+    # 使用日志的 source, 与上游返回的 429 区分
+    source = 'local'
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_batch_settings() -> Dict[str, Any]:
+    """批量生成配置(settings.LLM_BATCH 覆盖默认值)"""
+    config = {'MAX_ITEMS': 200, 'CONCURRENCY': 4, 'PACK_SIZE': 1, 'MAX_PACK_SIZE': 20}
+    config.update(getattr(settings, 'LLM_BATCH', {}))
+    return config
+
+
+def split_evenly(total: int, count: int) -> List[int]:
+    """把打包调用的 Token 数平均分摊给每条提示语, 余数分给前几条"""
+    base, remainder = divmod(total or 0, count)
+    return [base + (1 if index < remainder else 0) for index in range(count)]
+
+
+class GenerationService:
+    """模型生成服务"""
+
+    @staticmethod
+    async def admit(provider: ModelProvider, estimated_tokens: int = 0, max_wait: float = 0.0,
+                    **log_fields) -> Optional[BudgetReservation]:
+        """
+        调用方自己的预算检查和限流
+        在合并请求之前执行, 共享结果的调用方同样受自己的项目/用户预算和限流配额约束
+
+        Returns:
+            预算预留, 调用方需交给自己的使用日志或用 budget_ledger.arelease() 归还
+
+        Raises:
+            BudgetExceededError: 超出预算(已写入使用日志)
+            RateLimitedError: 被本地限流(已写入使用日志, 预留已归还)
+        """
+        reservation = await budget_ledger.aenforce(provider, estimated_tokens, **log_fields)
+        try:
+            decision = await rate_limiter.aacquire(provider, max_wait=max_wait, **log_fields)
+        except BaseException:
+            await budget_ledger.arelease(reservation)
+            raise
+        if not decision.allowed:
+            await budget_ledger.arelease(reservation)
+            raise RateLimitedError(f'触发 {decision.limit} 限流', decision.retry_after)
+        return reservation
+
+    @staticmethod
+    async def coalesce(provider: ModelProvider, key: str, call: Callable[[], Awaitable[Dict[str, Any]]],
+                       request_data: Dict[str, Any], reservation: Optional[BudgetReservation] = None,
+                       **log_fields) -> Tuple[Dict[str, Any], bool]:
+        """
+        合并键相同的并发调用, 只有第一个调用者真正请求上游
+
+        call 由 leader 执行并负责写自己的使用日志; 其余调用者共享结果,
+        各自写一条 source='coalesced'、tokens_used=0 的使用日志, 延迟为等待时间,
+        并随这条日志归还自己的预算预留(合并请求不产生用量)
+
+        Returns:
+            (结果, 是否共享了其他调用者的结果)
+        """
+        started = time.monotonic()
+        result, shared = await single_flight.do(key, call)
+        if shared:
+            await sync_to_async(usage_log_buffer.record)(
+                model_provider=provider, request_data=request_data,
+                response_data={'shared_tokens': result.get('tokens_used', 0)},
+                tokens_used=0, latency_ms=int((time.monotonic() - started) * 1000),
+                status='success', source='coalesced', reservation=reservation, **log_fields,
+            )
+        return result, shared
+
+    @staticmethod
+    async def generate_text(provider: ModelProvider, prompt: str, system_prompt: Optional[str] = None,
+                            project_id=None, stage_type: Optional[str] = None, use_cache: bool = True,
+                            cache_nondeterministic: Optional[bool] = None, max_wait: float = 0.0,
+                            user_id=None, **overrides) -> Dict[str, Any]:
+        """
+        调用LLM生成文本
+        依次经过: 响应缓存 -> 预算检查 -> 限流 -> 合并相同的在途请求 -> 熔断 -> 执行器(自适应超时)
+
+        Args:
+            provider: LLM 提供商
+            prompt: 提示语
+            system_prompt: 系统提示语
+            project_id/stage_type/user_id: 写入使用日志的关联信息, project_id/user_id 同时决定计入哪些预算
+            use_cache: 是否使用响应缓存
+            cache_nondeterministic: temperature > 0 时是否也走缓存, None 表示使用全局配置
+            max_wait: 触发限流时最多等待的秒数
+            overrides: 覆盖提供商的 max_tokens/temperature/top_p 等参数
+
+        Returns:
+            {'content', 'tokens_used', 'latency_ms', 'cached', 'coalesced'}
+
+        Raises:
+            AIClientError: 调用失败(已写入使用日志)
+        """
+        with executor_registry.lease(provider) as client:
+            log_fields = {'project_id': project_id, 'stage_type': stage_type, 'user_id': user_id}
+            messages = client.to_messages(prompt, system_prompt)
+            params = client.build_payload(messages, **overrides)
+            params.pop('messages')
+            request_data = {'messages': messages, **params}
+            key = request_fingerprint(provider.id, provider.model_name, params, messages)
+
+            cacheable = use_cache and response_cache.should_cache(params, cache_nondeterministic)
+            if cacheable:
+                started = time.monotonic()
+                cached = await sync_to_async(response_cache.get)(key)
+                if cached is not None:
+                    latency_ms = int((time.monotonic() - started) * 1000)
+                    await sync_to_async(usage_log_buffer.record)(
+                        model_provider=provider, request_data=request_data,
+                        response_data={'content': cached['content'], 'cached_tokens': cached['tokens_used']},
+                        tokens_used=0, latency_ms=latency_ms, status='success', source='cache',
+                        **log_fields,
+                    )
+                    return {
+                        'content': cached['content'],
+                        'tokens_used': cached['tokens_used'],
+                        'latency_ms': latency_ms,
+                        'cached': True,
+                        'coalesced': False,
+                    }
+
+            async def call_upstream() -> Dict[str, Any]:
+                timeout = await circuit_breaker.abefore_call(provider, **log_fields)
+                started = time.monotonic()
+                try:
+                    result = await client.chat(messages, timeout=timeout, **overrides)
+                except AIClientError as exc:
+                    await sync_to_async(usage_log_buffer.record)(
+                        model_provider=provider, request_data=request_data,
+                        latency_ms=int((time.monotonic() - started) * 1000),
+                        status=exc.status, error_message=str(exc), reservation=reservation, **log_fields,
+                    )
+                    raise
+                await sync_to_async(usage_log_buffer.record)(
+                    model_provider=provider, request_data=result['request'], response_data=result['response'],
+                    tokens_used=result['tokens_used'], latency_ms=result['latency_ms'], status='success',
+                    reservation=reservation, **log_fields,
+                )
+                if cacheable:
+                    await sync_to_async(response_cache.set)(
+                        key, {'content': result['content'], 'tokens_used': result['tokens_used']}
+                    )
+                return result
+
+            reservation = await GenerationService.admit(
+                provider, estimate_tokens(messages, params.get('max_tokens')), max_wait, **log_fields
+            )
+            try:
+                result, shared = await GenerationService.coalesce(
+                    provider, key, call_upstream, request_data, reservation=reservation, **log_fields
+                )
+            finally:
+                # 没有交给使用日志的预留(熔断、取消等)在这里归还
+                await budget_ledger.arelease(reservation)
+            return {
+                'content': result['content'],
+                'tokens_used': result['tokens_used'],
+                'latency_ms': result['latency_ms'],
+                'cached': False,
+                'coalesced': shared,
+            }
+
+    @staticmethod
+    async def run_media(provider: ModelProvider, payload: Dict[str, Any], project_id=None,
+                        stage_type: Optional[str] = None, max_wait: float = 0.0, user_id=None,
+                        on_progress=None) -> Dict[str, Any]:
+        """
+        调用文生图/图生视频执行器(client.run)
+        每个调用方先通过自己的预算检查和限流, 相同提供商、相同参数的并发请求再合并为一次上游调用;
+        on_progress 为执行器的进度回调(执行器 supports_progress 为 True 时生效),
+        合并的请求只有真正执行上游调用的一方收到进度
+
+        Returns:
+            执行器返回的结果, 附加 latency_ms 和 coalesced
+
+        Raises:
+            AIClientError: 调用失败(已写入使用日志)
+        """
+        with executor_registry.lease(provider) as client:
+            log_fields = {'project_id': project_id, 'stage_type': stage_type, 'user_id': user_id}
+            key = request_fingerprint(provider.id, provider.model_name, provider.extra_config or {}, payload)
+
+            async def call_upstream() -> Dict[str, Any]:
+                timeout = await circuit_breaker.abefore_call(provider, **log_fields)
+                # 超时和进度回调只传给声明支持的执行器(自定义执行器的 run() 可能只接受 payload)
+                options = {}
+                if getattr(client, 'supports_timeout', False):
+                    options['timeout'] = timeout
+                if on_progress is not None and getattr(client, 'supports_progress', False):
+                    options['on_progress'] = on_progress
+                started = time.monotonic()
+                try:
+                    result = await client.run(payload, **options)
+                except AIClientError as exc:
+                    await sync_to_async(usage_log_buffer.record)(
+                        model_provider=provider, request_data=payload,
+                        latency_ms=int((time.monotonic() - started) * 1000),
+                        status=exc.status, error_message=str(exc), reservation=reservation, **log_fields,
+                    )
+                    raise
+                latency_ms = int((time.monotonic() - started) * 1000)
+                await sync_to_async(usage_log_buffer.record)(
+                    model_provider=provider, request_data=payload, response_data=result,
+                    tokens_used=result.get('tokens_used', 0), latency_ms=latency_ms, status='success',
+                    reservation=reservation, **log_fields,
+                )
+                return {**result, 'latency_ms': latency_ms}
+
+            reservation = await GenerationService.admit(provider, max_wait=max_wait, **log_fields)
+            try:
+                result, shared = await GenerationService.coalesce(
+                    provider, key, call_upstream, payload, reservation=reservation, **log_fields
+                )
+            finally:
+                await budget_ledger.arelease(reservation)
+            return {**result, 'coalesced': shared}
+
+    @staticmethod
+    async def generate_batch(provider: ModelProvider, prompts: List[str], system_prompt: Optional[str] = None,
+                             concurrency: Optional[int] = None, pack_size: Optional[int] = None,
+                             project_id=None, stage_type: Optional[str] = None, user_id=None,
+                             use_cache: bool = True, max_wait: float = 0.0, **overrides) -> List[Dict[str, Any]]:
+        """
+        批量调用LLM生成文本
+        先逐条查响应缓存, 未命中的提示语每 pack_size 条打包成一次上游调用(pack_size=1 时逐条调用),
+        最多 concurrency 个上游调用同时进行; 每次上游调用前依次检查预算、限流和熔断。
+        打包的输出无法拆分时, 该组改为逐条调用。
+        每条提示语都有自己的使用日志(打包调用的 Token 平均分摊), 全部结束后一次批量写入。
+
+        Args:
+            provider: LLM 提供商
+            prompts: 提示语列表
+            system_prompt: 所有提示语共享的系统提示语
+            concurrency: 同时进行的上游调用数, 默认 LLM_BATCH.CONCURRENCY
+            pack_size: 每次上游调用打包的提示语数, 默认 LLM_BATCH.PACK_SIZE
+            overrides: 覆盖提供商参数; 打包调用的 max_tokens 按单条上限乘以打包条数
+
+        Returns:
+            与 prompts 一一对应的结果:
+            {'index', 'success', 'content', 'tokens_used', 'latency_ms', 'cached', 'packed', 'status', 'error'}
+        """
+        config = get_batch_settings()
+        concurrency = max(concurrency or config['CONCURRENCY'], 1)
+        pack_size = min(max(pack_size or config['PACK_SIZE'], 1), config['MAX_PACK_SIZE'])
+        with executor_registry.lease(provider) as client:
+            log_fields = {'project_id': project_id, 'stage_type': stage_type, 'user_id': user_id}
+            entries: List[Dict[str, Any]] = []
+            reservations: List[BudgetReservation] = []
+            results: List[Optional[Dict[str, Any]]] = [None] * len(prompts)
+            to_cache: Dict[str, Dict[str, Any]] = {}
+
+            items = []
+            for index, prompt in enumerate(prompts):
+                messages = client.to_messages(prompt, system_prompt)
+                params = client.build_payload(messages, **overrides)
+                params.pop('messages')
+                items.append({
+                    'messages': messages,
+                    'request_data': {'messages': messages, **params},
+                    'key': request_fingerprint(provider.id, provider.model_name, params, messages),
+                    'cacheable': use_cache and response_cache.should_cache(params, None),
+                })
+
+            def finish(index: int, content: Optional[str] = None, tokens_used: int = 0, latency_ms: int = 0,
+                       status: str = 'success', error: Optional[str] = None, cached: bool = False,
+                       packed: bool = False) -> None:
+                results[index] = {
+                    'index': index, 'success': status == 'success', 'content': content,
+                    'tokens_used': tokens_used, 'latency_ms': latency_ms, 'cached': cached, 'packed': packed,
+                    'status': status, 'error': error,
+                }
+
+            def lookup_cache() -> None:
+                for index, item in enumerate(items):
+                    if not item['cacheable']:
+                        continue
+                    started = time.monotonic()
+                    cached = response_cache.get(item['key'])
+                    if cached is None:
+                        continue
+                    latency_ms = int((time.monotonic() - started) * 1000)
+                    finish(index, cached['content'], cached['tokens_used'], latency_ms, cached=True)
+                    entries.append({
+                        'model_provider': provider, 'request_data': item['request_data'],
+                        'response_data': {'content': cached['content'], 'cached_tokens': cached['tokens_used']},
+                        'tokens_used': 0, 'latency_ms': latency_ms, 'status': 'success', 'source': 'cache',
+                        **log_fields,
+                    })
+
+            await sync_to_async(lookup_cache)()
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def call_group(indices: List[int]) -> List[int]:
+                """
+                执行一次上游调用
+
+                Returns:
+                    打包输出无法拆分、需要逐条重试的下标
+                """
+                async with semaphore:
+                    packed = len(indices) > 1
+                    if packed:
+                        messages = client.to_packed_messages([prompts[index] for index in indices], system_prompt)
+                        max_tokens = overrides.get('max_tokens', provider.max_tokens)
+                        call_overrides = dict(overrides)
+                        if max_tokens:
+                            call_overrides['max_tokens'] = max_tokens * len(indices)
+                    else:
+                        messages = items[indices[0]]['messages']
+                        call_overrides = overrides
+                    # 与 generate_text 相同的准入顺序: 预算 -> 限流 -> 熔断
+                    try:
+                        reservation = await GenerationService.admit(
+                            provider, estimate_tokens(messages, call_overrides.get('max_tokens', provider.max_tokens)),
+                            max_wait, **log_fields,
+                        )
+                        if reservation is not None:
+                            # 随本组的第一条日志结算, 没有日志时在批量结束后归还
+                            reservations.append(reservation)
+                        timeout = await circuit_breaker.abefore_call(provider, **log_fields)
+                    except (CircuitOpenError, BudgetExceededError, RateLimitedError) as exc:
+                        # 熔断/预算/限流已为本次调用写入一条日志, 组内其余提示语各补一条; 预留在批量结束后归还
+                        for position, index in enumerate(indices):
+                            finish(index, status=exc.status, error=str(exc), packed=packed)
+                            if position:
+                                entries.append({
+                                    'model_provider': provider, 'request_data': items[index]['request_data'],
+                                    'tokens_used': 0, 'latency_ms': 0, 'status': exc.status,
+                                    'source': getattr(exc, 'source', 'upstream'), 'error_message': str(exc),
+                                    **log_fields,
+                                })
+                        return []
+
+                    started = time.monotonic()
+                    try:
+                        if packed:
+                            result = await client.chat_packed(
+                                [prompts[index] for index in indices], system_prompt, timeout=timeout, **call_overrides
+                            )
+                            contents = result['contents']
+                        else:
+                            result = await client.chat(messages, timeout=timeout, **call_overrides)
+                            contents = [result['content']]
+                    except PackedResponseError as exc:
+                        # 上游已经产生用量, 记为 unpack_failed(计入预算, 不影响健康判断和熔断)后逐条重试
+                        usage = (exc.result or {}).get('response', {}).get('usage') or {}
+                        shares = split_evenly((exc.result or {}).get('tokens_used', 0), len(indices))
+                        for index, tokens_used in zip(indices, shares):
+                            entries.append({
+                                'model_provider': provider, 'request_data': items[index]['request_data'],
+                                'response_data': {'packed': {'size': len(indices)}, 'usage': usage},
+                                'tokens_used': tokens_used, 'latency_ms': (exc.result or {}).get('latency_ms', 0),
+                                'status': exc.status, 'error_message': str(exc), 'reservation': reservation,
+                                **log_fields,
+                            })
+                        return indices
+                    except AIClientError as exc:
+                        latency_ms = int((time.monotonic() - started) * 1000)
+                        for index in indices:
+                            finish(index, status=exc.status, error=str(exc), latency_ms=latency_ms, packed=packed)
+                            entries.append({
+                                'model_provider': provider, 'request_data': items[index]['request_data'],
+                                'latency_ms': latency_ms, 'status': exc.status, 'error_message': str(exc),
+                                'reservation': reservation, **log_fields,
+                            })
+                        return []
+
+                    usage = result['response'].get('usage') or {}
+                    shares = {
+                        field: split_evenly(usage.get(field, 0), len(indices))
+                        for field in ('prompt_tokens', 'completion_tokens') if field in usage
+                    }
+                    token_shares = split_evenly(result['tokens_used'], len(indices))
+                    for position, (index, content) in enumerate(zip(indices, contents)):
+                        tokens_used = token_shares[position]
+                        finish(index, content, tokens_used, result['latency_ms'], packed=packed)
+                        if packed:
+                            response_data = {
+                                'content': content,
+                                'usage': {
+                                    'total_tokens': tokens_used,
+                                    **{field: values[position] for field, values in shares.items()},
+                                },
+                                'packed': {
+                                    'id': result['response'].get('id'), 'size': len(indices), 'position': position,
+                                },
+                            }
+                            request_data = {**items[index]['request_data'], 'packed': {'size': len(indices)}}
+                        else:
+                            response_data, request_data = result['response'], result['request']
+                        entries.append({
+                            'model_provider': provider, 'request_data': request_data, 'response_data': response_data,
+                            'tokens_used': tokens_used, 'latency_ms': result['latency_ms'], 'status': 'success',
+                            'reservation': reservation, **log_fields,
+                        })
+                        if items[index]['cacheable']:
+                            to_cache[items[index]['key']] = {'content': content, 'tokens_used': tokens_used}
+                    return []
+
+            async def run_group(indices: List[int]) -> None:
+                retry = await call_group(indices)
+                if retry:
+                    await asyncio.gather(*(call_group([index]) for index in retry))
+
+            pending = [index for index, result in enumerate(results) if result is None]
+            groups = [pending[start:start + pack_size] for start in range(0, len(pending), pack_size)]
+            try:
+                await asyncio.gather(*(run_group(group) for group in groups))
+            finally:
+                # 取消时也写入已完成调用的日志, 没有随日志结算的预留一并归还
+                await sync_to_async(usage_log_buffer.record_many)(entries)
+                for reservation in reservations:
+                    await budget_ledger.arelease(reservation)
+            if to_cache:
+                def store_cache() -> None:
+                    for key, value in to_cache.items():
+                        response_cache.set(key, value)
+
+                await sync_to_async(store_cache)()
+            return results
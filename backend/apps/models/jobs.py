@@ -0,0 +1,399 @@
+"""
+生成任务队列
+职责: 基于数据库的持久化任务队列, 不依赖消息中间件;
+worker 通过条件 UPDATE 抢占任务, 锁定超过可见性超时的任务会被其他 worker 重新领取
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, IntegerField, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.ai_client.base import AIClientError
+
+from .budgets import BudgetExceededError
+from .generation import GenerationService
+from .models import GenerationJob, ModelProvider
+from .provider_cache import provider_cache
+from .router import provider_router
+
+logger = logging.getLogger(__name__)
+
+
+def get_job_settings() -> Dict[str, Any]:
+    """settings.GENERATION_JOBS 与默认值合并后的配置"""
+    config = {
+        'VISIBILITY_TIMEOUT': 600,
+        'POLL_INTERVAL': 1.0,
+        'MAX_ATTEMPTS': 3,
+        'RETRY_BACKOFF': 5,
+        'RETRY_BACKOFF_MAX': 600,
+        'DEFAULT_PROVIDER_CONCURRENCY': 2,
+        'WORKER_CONCURRENCY': 4,
+        'PROGRESS_INTERVAL': 2.0,
+    }
+    config.update(getattr(settings, 'GENERATION_JOBS', {}))
+    return config
+
+
+class JobService:
+    """
+    生成任务服务
+    职责: 提交、领取、续期、完成、重试和取消任务
+    """
+
+    @staticmethod
+    def submit(provider: ModelProvider, payload: Dict[str, Any], project_id=None,
+               stage_type: Optional[str] = None, max_attempts: Optional[int] = None, user_id=None) -> GenerationJob:
+        """提交任务(user_id 为提交用户, 执行时计入该用户的预算)"""
+        return GenerationJob.objects.create(
+            model_provider=provider,
+            job_type=provider.provider_type,
+            payload=payload,
+            project_id=project_id,
+            stage_type=stage_type,
+            user_id=user_id,
+            max_attempts=max_attempts or get_job_settings()['MAX_ATTEMPTS'],
+            run_after=timezone.now(),
+        )
+
+    @staticmethod
+    def cancel(job: GenerationJob) -> GenerationJob:
+        """
+        取消任务
+        等待中的任务直接取消; 执行中的任务标记 cancel_requested, 由 worker 在下次续期时中止
+        """
+        now = timezone.now()
+        updated = GenerationJob.objects.filter(pk=job.pk, status='pending').update(
+            status='cancelled', finished_at=now, locked_by=None, locked_until=None, updated_at=now,
+        )
+        if not updated:
+            GenerationJob.objects.filter(pk=job.pk, status='running').update(
+                cancel_requested=True, updated_at=now,
+            )
+        job.refresh_from_db()
+        return job
+
+    @staticmethod
+    def provider_concurrency(provider: ModelProvider) -> int:
+        """提供商的并发任务上限, 取 extra_config['max_concurrency']"""
+        limit = (provider.extra_config or {}).get('max_concurrency')
+        if limit is None:
+            return get_job_settings()['DEFAULT_PROVIDER_CONCURRENCY']
+        return int(limit)
+
+    @staticmethod
+    def queue_filter() -> Q:
+        """worker 会领取的任务范围: 提供商处于激活状态(未激活提供商的任务保持排队, 重新激活后继续执行)"""
+        return Q(model_provider__is_active=True)
+
+    @staticmethod
+    def claim(worker_id: str, limit: int, visibility_timeout: float) -> List[GenerationJob]:
+        """
+        领取最多 limit 个可执行的任务
+        可执行: 等待中且到了 run_after; 或执行中但锁已过期(worker 崩溃)
+        通过带原状态条件的 UPDATE 抢占, 多个 worker 并发领取时每个任务只会被一个 worker 拿到;
+        提供商的并发上限也作为 UPDATE 的条件, 不会被并发领取突破
+        """
+        now = timezone.now()
+        candidates = list(
+            GenerationJob.objects.filter(
+                Q(status='pending', run_after__lte=now) | Q(status='running', locked_until__lt=now),
+                JobService.queue_filter(),
+            ).order_by('run_after', 'created_at')[:limit * 5]
+        )
+        if not candidates:
+            return []
+        provider_ids = {job.model_provider_id for job in candidates}
+        running = dict(
+            GenerationJob.objects.filter(
+                model_provider_id__in=provider_ids, status='running', locked_until__gte=now,
+            ).values_list('model_provider_id').annotate(count=Count('id'))
+        )
+
+        claimed = []
+        for job in candidates:
+            if len(claimed) >= limit:
+                break
+            if job.status == 'running' and job.attempts >= job.max_attempts:
+                # worker 崩溃导致锁过期, 且已经没有重试次数
+                GenerationJob.objects.filter(pk=job.pk, status='running', locked_until=job.locked_until).update(
+                    status='failed', error_message='任务执行超时(超过可见性超时)且已达到最大执行次数',
+                    locked_until=None, finished_at=now, updated_at=now,
+                )
+                continue
+            provider = provider_cache.get(job.model_provider_id)
+            if provider is None or not provider.is_active:
+                continue
+            job.model_provider = provider
+            provider_limit = JobService.provider_concurrency(provider)
+            if running.get(provider.id, 0) >= provider_limit:
+                continue
+            locked_until = now + timedelta(seconds=visibility_timeout)
+            if JobService.claim_one(job, provider, provider_limit, worker_id, locked_until, now):
+                running[provider.id] = running.get(provider.id, 0) + 1
+                job.status, job.locked_by, job.locked_until = 'running', worker_id, locked_until
+                job.attempts += 1
+                job.started_at = now
+                claimed.append(job)
+        return claimed
+
+    @staticmethod
+    def claim_one(job: GenerationJob, provider: ModelProvider, provider_limit: int, worker_id: str,
+                  locked_until, now) -> bool:
+        """
+        抢占一个任务, 同时检查提供商的并发上限
+
+        执行中任务数作为 UPDATE 的子查询条件, SQLite 的单条 UPDATE 本身串行执行;
+        支持行锁的数据库先锁住提供商行, 同一提供商的领取串行执行
+        """
+        running = (
+            GenerationJob.objects.filter(model_provider_id=provider.id, status='running', locked_until__gte=now)
+            .order_by().values('model_provider_id').annotate(count=Count('id')).values('count')
+        )
+        with transaction.atomic():
+            if connection.features.has_select_for_update:
+                list(ModelProvider.objects.select_for_update().filter(pk=provider.id).values_list('pk'))
+            updated = GenerationJob.objects.alias(
+                running_count=Coalesce(Subquery(running, output_field=IntegerField()), 0),
+            ).filter(
+                pk=job.pk, status=job.status, locked_until=job.locked_until, attempts=job.attempts,
+                running_count__lt=provider_limit,
+            ).update(
+                status='running', locked_by=worker_id, locked_until=locked_until,
+                attempts=F('attempts') + 1, progress=None, started_at=now, updated_at=now,
+            )
+        return bool(updated)
+
+    @staticmethod
+    def has_unfinished() -> bool:
+        """是否还有会被领取的等待中(含退避重试)或执行中的任务, 范围与 claim() 一致"""
+        return GenerationJob.objects.filter(
+            JobService.queue_filter(), status__in=['pending', 'running'],
+        ).exists()
+
+    @staticmethod
+    def heartbeat(job: GenerationJob, worker_id: str, visibility_timeout: float) -> bool:
+        """
+        续期任务锁
+
+        Returns:
+            任务是否应该继续执行(被取消或锁已被其他 worker 接管时返回 False)
+        """
+        now = timezone.now()
+        updated = GenerationJob.objects.filter(
+            pk=job.pk, status='running', locked_by=worker_id, cancel_requested=False,
+        ).update(locked_until=now + timedelta(seconds=visibility_timeout), updated_at=now)
+        return bool(updated)
+
+    @staticmethod
+    def update_progress(job: GenerationJob, worker_id: str, progress: Dict[str, Any]) -> None:
+        GenerationJob.objects.filter(pk=job.pk, status='running', locked_by=worker_id).update(
+            progress=progress, updated_at=timezone.now(),
+        )
+
+    @staticmethod
+    def complete(job: GenerationJob, worker_id: str, result: Dict[str, Any]) -> None:
+        now = timezone.now()
+        GenerationJob.objects.filter(pk=job.pk, status='running', locked_by=worker_id).update(
+            status='succeeded', result=result, error_message=None, locked_until=None,
+            finished_at=now, updated_at=now,
+        )
+
+    @staticmethod
+    def fail(job: GenerationJob, worker_id: str, error: str, retryable: bool = True) -> None:
+        """任务失败: 未达到最大次数时按指数退避重新排队"""
+        now = timezone.now()
+        queryset = GenerationJob.objects.filter(pk=job.pk, status='running', locked_by=worker_id)
+        if retryable and job.attempts < job.max_attempts:
+            config = get_job_settings()
+            backoff = min(config['RETRY_BACKOFF'] * 2 ** (job.attempts - 1), config['RETRY_BACKOFF_MAX'])
+            queryset.update(
+                status='pending', error_message=error, locked_by=None, locked_until=None,
+                run_after=now + timedelta(seconds=backoff), updated_at=now,
+            )
+            return
+        queryset.update(
+            status='failed', error_message=error, locked_until=None, finished_at=now, updated_at=now,
+        )
+
+    @staticmethod
+    def mark_cancelled(job: GenerationJob, worker_id: str) -> None:
+        now = timezone.now()
+        GenerationJob.objects.filter(pk=job.pk, status='running', locked_by=worker_id).update(
+            status='cancelled', locked_until=None, finished_at=now, updated_at=now,
+        )
+
+
+async def run_llm_job(job: GenerationJob) -> Dict[str, Any]:
+    """LLM任务: payload 为 {"prompt", "system_prompt", 以及 GenerationJob.LLM_OVERRIDE_KEYS 中的覆盖参数}"""
+    payload = job.payload
+    overrides = {key: payload[key] for key in GenerationJob.LLM_OVERRIDE_KEYS if key in payload}
+    return await GenerationService.generate_text(
+        job.model_provider, payload['prompt'], system_prompt=payload.get('system_prompt'),
+        project_id=job.project_id, stage_type=job.stage_type, user_id=job.user_id, **overrides,
+    )
+
+
+def progress_reporter(job: GenerationJob):
+    """
+    执行器进度回调: 把最新进度写入任务的 progress 字段
+    两次写入至少间隔 GENERATION_JOBS['PROGRESS_INTERVAL'] 秒, 间隔内的事件直接丢弃
+    """
+    interval = get_job_settings()['PROGRESS_INTERVAL']
+    last_written = 0.0
+
+    async def report(event: Dict[str, Any]) -> None:
+        nonlocal last_written
+        now = time.monotonic()
+        if now - last_written < interval:
+            return
+        last_written = now
+        progress = {key: event.get(key) for key in ('type', 'node', 'value', 'max') if event.get(key) is not None}
+        await sync_to_async(JobService.update_progress)(job, job.locked_by, progress)
+
+    return report
+
+
+async def run_media_job(job: GenerationJob) -> Dict[str, Any]:
+    """文生图/图生视频任务: payload 原样交给执行器的 run(), 完成后预先生成缩略图"""
+    result = await GenerationService.run_media(
+        job.model_provider, job.payload, project_id=job.project_id, stage_type=job.stage_type,
+        user_id=job.user_id, on_progress=progress_reporter(job),
+    )
+    await sync_to_async(generate_derivatives)(result)
+    return result
+
+
+def generate_derivatives(result: Dict[str, Any]) -> None:
+    """为结果中的每个文件生成 MEDIA_DERIVATIVES['EAGER_PRESETS'] 规格的派生文件, 失败不影响任务结果"""
+    from .derivatives import derivative_cache
+
+    presets = getattr(settings, 'MEDIA_DERIVATIVES', {}).get('EAGER_PRESETS', [])
+    if not presets:
+        return
+    for scene_files in result.get('scenes') or []:
+        for file_info in scene_files:
+            if not file_info.get('sha256'):
+                continue
+            try:
+                derivative_cache.ensure(file_info['sha256'], presets)
+            except Exception:
+                logger.exception('生成 %s 的预览失败', file_info['sha256'])
+
+
+# 任务类型 -> 执行函数
+JOB_HANDLERS = {
+    'llm': run_llm_job,
+    'text2image': run_media_job,
+    'image2video': run_media_job,
+}
+
+
+class JobWorker:
+    """
+    任务worker
+    在一个事件循环中并发执行最多 concurrency 个任务, 数据库操作通过 sync_to_async 串行执行
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, poll_interval: Optional[float] = None,
+                 visibility_timeout: Optional[float] = None, worker_id: Optional[str] = None):
+        config = get_job_settings()
+        self.concurrency = concurrency or config['WORKER_CONCURRENCY']
+        self.poll_interval = poll_interval if poll_interval is not None else config['POLL_INTERVAL']
+        self.visibility_timeout = visibility_timeout or config['VISIBILITY_TIMEOUT']
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._stopping = False
+
+    def stop(self) -> None:
+        """不再领取新任务, 等待在途任务结束"""
+        self._stopping = True
+
+    async def run(self, burst: bool = False) -> int:
+        """
+        运行worker
+
+        Args:
+            burst: 为 True 时队列中没有未完成的任务后退出(本地测试用)
+
+        Returns:
+            处理的任务数
+        """
+        processed = 0
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while not self._stopping:
+                free = self.concurrency - len(self._tasks)
+                claimed = []
+                if free > 0:
+                    claimed = await sync_to_async(JobService.claim)(self.worker_id, free, self.visibility_timeout)
+                for job in claimed:
+                    self._tasks[str(job.pk)] = asyncio.create_task(self._execute(job))
+                    processed += 1
+                if burst and not claimed and not self._tasks:
+                    if not await sync_to_async(JobService.has_unfinished)():
+                        break
+                if claimed and len(self._tasks) < self.concurrency:
+                    continue
+                await self._wait(self.poll_interval)
+            if self._tasks:
+                await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        finally:
+            heartbeat.cancel()
+            await sync_to_async(close_old_connections)()
+        return processed
+
+    async def _wait(self, timeout: float) -> None:
+        """等待任一在途任务结束或轮询间隔到期"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(timeout)
+
+    async def _execute(self, job: GenerationJob) -> None:
+        key = str(job.pk)
+        handler = JOB_HANDLERS.get(job.job_type)
+        try:
+            if handler is None:
+                await sync_to_async(JobService.fail)(job, self.worker_id, f'未知的任务类型: {job.job_type}', False)
+                return
+            # 提交时由路由器选定的提供商, 执行期间计入其并发数
+            with provider_router.track(job.model_provider_id):
+                result = await handler(job)
+        except asyncio.CancelledError:
+            await sync_to_async(JobService.mark_cancelled)(job, self.worker_id)
+        except AIClientError as exc:
+            logger.warning('任务 %s 执行失败(%s): %s', key, exc.status, exc)
+            # 超出预算时重试也不会成功
+            retryable = exc.status != BudgetExceededError.status
+            await sync_to_async(JobService.fail)(job, self.worker_id, str(exc), retryable)
+        except Exception as exc:
+            logger.exception('任务 %s 执行异常', key)
+            await sync_to_async(JobService.fail)(job, self.worker_id, f'{type(exc).__name__}: {exc}')
+        else:
+            await sync_to_async(JobService.complete)(job, self.worker_id, result)
+        finally:
+            self._tasks.pop(key, None)
+
+    async def _heartbeat_loop(self) -> None:
+        """定期续期在途任务的锁, 并中止已请求取消的任务"""
+        # 续期间隔不超过5秒, 让取消请求能及时生效
+        interval = max(min(self.visibility_timeout / 3, 5.0), 0.5)
+        while True:
+            await asyncio.sleep(interval)
+            for key, task in list(self._tasks.items()):
+                job = GenerationJob(pk=key)
+                alive = await sync_to_async(JobService.heartbeat)(job, self.worker_id, self.visibility_timeout)
+                if not alive:
+                    task.cancel()
@@ -0,0 +1,52 @@
+"""
+归档并清理过期的模型使用日志
+用法:
+    python manage.py archive_usage_logs                          # 按 USAGE_LOG_RETENTION 配置执行
+    python manage.py archive_usage_logs --days 7 --dry-run       # 查看7天前的日志有多少需要归档
+    python manage.py archive_usage_logs --delete-after-days 180  # 同时删除180天前已归档的日志行
+
+删除日志行后, rebuild_usage_rollups 只重建原始日志仍完整保留的时间桶, 更早的汇总保持不变
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.models.retention import UsageLogArchiver, cutoff, get_retention_settings
+
+
+class Command(BaseCommand):
+    help = '把超过保留期的 model_usage_logs 写入压缩归档文件, 清空请求/响应数据并分批删除更早的日志'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='归档N天前的日志, 默认 ARCHIVE_AFTER_DAYS')
+        parser.add_argument(
+            '--delete-after-days', type=int, default=None,
+            help='删除N天前已归档的日志行, 默认 DELETE_AFTER_DAYS(为空时不删除)'
+        )
+        parser.add_argument('--format', choices=['gzip', 'zstd'], default=None, help='归档压缩格式, 默认 FORMAT')
+        parser.add_argument('--batch-size', type=int, default=None, help='每批处理的行数, 默认 BATCH_SIZE')
+        parser.add_argument('--pause', type=float, default=None, help='批次之间暂停的秒数, 默认 BATCH_PAUSE')
+        parser.add_argument('--dry-run', action='store_true', help='只统计, 不写归档也不修改数据库')
+
+    def handle(self, *args, **options):
+        config = get_retention_settings()
+        archive_days = options['days'] if options['days'] is not None else config['ARCHIVE_AFTER_DAYS']
+        delete_days = (
+            options['delete_after_days'] if options['delete_after_days'] is not None
+            else config['DELETE_AFTER_DAYS']
+        )
+        if delete_days is not None and delete_days < archive_days:
+            raise CommandError('删除天数不能小于归档天数')
+        try:
+            archiver = UsageLogArchiver.from_settings(
+                compression=options['format'], batch_size=options['batch_size'], batch_pause=options['pause'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        prefix = '[dry-run] ' if options['dry_run'] else ''
+        archived = archiver.archive(cutoff(archive_days), dry_run=options['dry_run'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}归档 {archive_days} 天前的日志 {archived} 条 -> {archiver.archive_root}'
+        ))
+        if delete_days is not None:
+            deleted = archiver.delete(cutoff(delete_days), dry_run=options['dry_run'])
+            self.stdout.write(self.style.SUCCESS(f'{prefix}删除 {delete_days} 天前的日志 {deleted} 条'))
@@ -0,0 +1,41 @@
+"""
+从原始使用日志重建/压缩使用汇总表
+用法:
+    python manage.py rebuild_usage_rollups                 # 重建原始日志保留期内的全部时间桶
+    python manage.py rebuild_usage_rollups --days 2        # 只重建最近2天
+    python manage.py rebuild_usage_rollups --compact       # 只合并重复汇总行
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.models.services import ModelUsageRollupService
+
+
+class Command(BaseCommand):
+    help = '从 model_usage_logs 重建或压缩 model_usage_rollups 汇总表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='只处理最近N天的时间桶, 默认全部(重建时不早于原始日志保留期)')
+        parser.add_argument(
+            '--granularity', choices=ModelUsageRollupService.GRANULARITIES, default=None,
+            help='只处理指定粒度, 默认小时和天都处理'
+        )
+        parser.add_argument('--compact', action='store_true', help='只合并重复汇总行, 不读取原始日志')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days'] is not None:
+            since = timezone.now() - timedelta(days=options['days'])
+        granularities = (
+            [options['granularity']] if options['granularity']
+            else list(ModelUsageRollupService.GRANULARITIES)
+        )
+        for granularity in granularities:
+            if options['compact']:
+                merged = ModelUsageRollupService.compact(granularity, since)
+                self.stdout.write(self.style.SUCCESS(f'[{granularity}] 合并重复汇总行 {merged} 条'))
+            else:
+                created = ModelUsageRollupService.rebuild(granularity, since)
+                self.stdout.write(self.style.SUCCESS(f'[{granularity}] 重建汇总行 {created} 条'))
@@ -0,0 +1,45 @@
+"""
+运行生成任务worker
+用法:
+    python manage.py run_generation_worker                  # 常驻运行
+    python manage.py run_generation_worker --burst          # 处理完队列中的任务后退出
+    python manage.py run_generation_worker --concurrency 8
+"""
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from apps.models.jobs import JobWorker
+from apps.models.usage_buffer import usage_log_buffer
+
+
+class Command(BaseCommand):
+    help = '从 generation_jobs 表领取并执行生成任务(不依赖消息中间件)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help='同时执行的任务数')
+        parser.add_argument('--poll-interval', type=float, default=None, help='队列为空时的轮询间隔(秒)')
+        parser.add_argument('--visibility-timeout', type=float, default=None, help='任务锁定时长(秒)')
+        parser.add_argument('--burst', action='store_true', help='队列为空时退出')
+
+    def handle(self, *args, **options):
+        worker = JobWorker(
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+            visibility_timeout=options['visibility_timeout'],
+        )
+        self.stdout.write(f'worker {worker.worker_id} 启动, 并发数 {worker.concurrency}')
+        processed = asyncio.run(self._run(worker, options['burst']))
+        usage_log_buffer.flush()
+        self.stdout.write(self.style.SUCCESS(f'worker 退出, 共处理 {processed} 个任务'))
+
+    async def _run(self, worker, burst):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, worker.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows 不支持 add_signal_handler
+                pass
+        return await worker.run(burst=burst)
@@ -0,0 +1,299 @@
+"""
+生成产物文件服务
+为 STORAGE_URL / MEDIA_URL 提供文件访问, 支持 Range 请求、ETag 协商缓存,
+以及交给 nginx(X-Accel-Redirect) / Apache(X-Sendfile) 直接发送文件的模式
+
+STORAGE_URL 下只开放内容寻址文件(blobs/)和派生文件(derivatives/), 临时文件、日志归档等其他目录不可访问;
+访问需要登录(JWT/Session), 或者带上 blob_store.url() 生成的 sig 签名参数
+"""
+import mimetypes
+import os
+import re
+from pathlib import Path
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed
+from django.utils.crypto import constant_time_compare
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import condition
+from rest_framework.exceptions import APIException
+
+from .derivatives import DerivativeUnavailable, derivative_cache
+from .models import MediaBlob
+from .storage import blob_store
+from .streaming import authenticate
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_media_settings() -> dict:
+    config = {
+        'MODE': 'django',  # django / x-accel-redirect / x-sendfile
+        'ACCEL_PREFIXES': {},
+        'BLOB_MAX_AGE': 365 * 24 * 3600,
+        'MAX_AGE': 0,
+    }
+    config.update(getattr(settings, 'MEDIA_SERVING', {}))
+    return config
+
+
+class RangeFile:
+    """
+    只暴露文件中一段区间的只读文件对象
+    read() 不会越过区间末尾; fileno()/tell() 保留给 wsgi.file_wrapper 用 sendfile 从当前偏移发送
+    """
+
+    def __init__(self, file, start: int, length: int):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class MediaFile:
+    """一次请求要发送的文件及其元数据"""
+
+    def __init__(self, root_name: str, root: Path, relative_path: str):
+        try:
+            self.path = Path(safe_join(root, relative_path))
+        except SuspiciousFileOperation:
+            # 路径穿越
+            raise Http404('文件不存在')
+        if not self.path.is_file():
+            raise Http404('文件不存在')
+        self.root_name = root_name
+        self.relative_path = relative_path
+        self.stat = self.path.stat()
+        self.sha256 = self._blob_hash()
+
+    def _blob_hash(self) -> Optional[str]:
+        """文件位于内容寻址存储中时返回内容哈希"""
+        try:
+            relative = self.path.relative_to(blob_store.root)
+        except ValueError:
+            return None
+        sha256 = relative.name
+        if len(sha256) == 64 and blob_store.relative_path(sha256) == relative.as_posix():
+            return sha256
+        return None
+
+    @property
+    def size(self) -> int:
+        return self.stat.st_size
+
+    @property
+    def etag(self) -> str:
+        """内容寻址文件直接使用内容哈希, 其他文件用大小+修改时间, 避免为计算ETag读取整个文件"""
+        if self.sha256:
+            return f'"{self.sha256}"'
+        return f'"{self.stat.st_size:x}-{self.stat.st_mtime_ns:x}"'
+
+    @property
+    def content_type(self) -> str:
+        if self.sha256:
+            mime_type = MediaBlob.objects.filter(sha256=self.sha256).values_list('mime_type', flat=True).first()
+            if mime_type:
+                return mime_type
+        mime_type, _ = mimetypes.guess_type(self.path.name)
+        return mime_type or 'application/octet-stream'
+
+    @property
+    def cache_control(self) -> str:
+        config = get_media_settings()
+        if self.sha256:
+            # 内容寻址文件永不改变
+            return f"public, max-age={config['BLOB_MAX_AGE']}, immutable"
+        return f"public, max-age={config['MAX_AGE']}, must-revalidate"
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单个区间的 Range 请求头
+
+    Returns:
+        (起始偏移, 结束偏移(含)); 请求头无法识别或包含多个区间时返回 None(按整个文件返回)
+
+    Raises:
+        ValueError: 区间不可满足(416)
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N: 最后N个字节
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError('unsatisfiable')
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable')
+    return start, end
+
+
+def set_common_headers(response: HttpResponse, media: MediaFile) -> HttpResponse:
+    response['ETag'] = media.etag
+    response['Last-Modified'] = http_date(media.stat.st_mtime)
+    response['Cache-Control'] = media.cache_control
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def offload_response(media: MediaFile, mode: str) -> HttpResponse:
+    """交给前端服务器发送文件, Range 与条件请求也由前端服务器处理"""
+    response = HttpResponse(content_type=media.content_type)
+    if mode == 'x-accel-redirect':
+        prefix = get_media_settings()['ACCEL_PREFIXES'].get(media.root_name, f'/protected/{media.root_name}/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + media.relative_path.lstrip('/')
+    else:
+        response['X-Sendfile'] = str(media.path)
+    return set_common_headers(response, media)
+
+
+def file_response(request, media: MediaFile) -> HttpResponse:
+    """由 Django 以流式方式发送文件; WSGI 服务器支持 wsgi.file_wrapper 时走 sendfile"""
+    content_type = media.content_type
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range.strip() == media.etag):
+        try:
+            byte_range = parse_range(range_header, media.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{media.size}'
+            return set_common_headers(response, media)
+
+    file = open(media.path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = FileResponse(RangeFile(file, start, length), content_type=content_type, status=206)
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{end}/{media.size}'
+    return set_common_headers(response, media)
+
+
+def serve(request, root_name: str, root: Path, path: str) -> HttpResponse:
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    media = MediaFile(root_name, root, path)
+
+    @condition(etag_func=lambda request: media.etag)
+    def send(request):
+        mode = get_media_settings()['MODE']
+        if mode in ('x-accel-redirect', 'x-sendfile'):
+            return offload_response(media, mode)
+        return file_response(request, media)
+
+    return send(request)
+
+
+def storage_area(root: Path) -> Optional[str]:
+    """目录相对 STORAGE_ROOT 的路径前缀, 不在 STORAGE_ROOT 内时返回 None"""
+    try:
+        return Path(root).relative_to(Path(settings.STORAGE_ROOT)).as_posix().strip('/') + '/'
+    except ValueError:
+        return None
+
+
+def resolve_storage_path(path: str) -> Optional[str]:
+    """
+    STORAGE_URL 下允许访问的路径对应的内容哈希
+
+    只允许两类路径, 其余(临时文件、日志归档等)一律返回 None:
+    - blobs/ab/cd/<sha256>: 内容寻址文件
+    - derivatives/ab/<sha256>/<preset>.<扩展名>: 已配置规格的派生文件
+    """
+    blob_prefix = storage_area(blob_store.root)
+    if blob_prefix and path.startswith(blob_prefix):
+        rest = path[len(blob_prefix):]
+        sha256 = rest.rsplit('/', 1)[-1]
+        if SHA256_RE.match(sha256) and rest == blob_store.relative_path(sha256):
+            return sha256
+        return None
+    derivative_prefix = storage_area(derivative_cache.root)
+    if derivative_prefix and path.startswith(derivative_prefix):
+        rest = path[len(derivative_prefix):]
+        parts = rest.split('/')
+        sha256 = parts[1] if len(parts) == 3 else ''
+        if SHA256_RE.match(sha256) and rest in {
+            derivative_cache.relative_path(sha256, preset) for preset in derivative_cache.presets
+        }:
+            return sha256
+    return None
+
+
+def is_authorized(request, sha256: str) -> bool:
+    """请求带有该文件的有效签名, 或者已登录"""
+    signature = request.GET.get('sig')
+    if signature and constant_time_compare(signature, blob_store.signature(sha256)):
+        return True
+    try:
+        user = authenticate(request)
+    except APIException:
+        return False
+    return bool(user and user.is_authenticated)
+
+
+def serve_storage(request, path: str) -> HttpResponse:
+    """STORAGE_URL 下的生成产物(仅内容寻址文件和派生文件)"""
+    sha256 = resolve_storage_path(path)
+    if sha256 is None:
+        raise Http404('文件不存在')
+    if not is_authorized(request, sha256):
+        return HttpResponseForbidden('需要登录或有效的访问签名')
+    return serve(request, 'storage', Path(settings.STORAGE_ROOT), path)
+
+
+def serve_media(request, path: str) -> HttpResponse:
+    """MEDIA_URL 下的上传文件"""
+    return serve(request, 'media', Path(settings.MEDIA_ROOT), path)
+
+
+def serve_derivative(request, sha256: str, preset: str) -> HttpResponse:
+    """内容寻址文件的缩略图/视频封面帧, 首次请求时生成; 与原文件使用相同的访问签名"""
+    if not SHA256_RE.match(sha256):
+        raise Http404('文件不存在')
+    if not is_authorized(request, sha256):
+        return HttpResponseForbidden('需要登录或有效的访问签名')
+    blob = blob_store.get(sha256)
+    if blob is None:
+        raise Http404('文件不存在')
+    try:
+        derivative = derivative_cache.get(blob, preset)
+    except KeyError:
+        raise Http404(f'未知的预览规格: {preset}')
+    except DerivativeUnavailable as exc:
+        return HttpResponse(str(exc), status=415, content_type='text/plain; charset=utf-8')
+    return serve(request, 'derivatives', derivative_cache.root, derivative.relative_path)
@@ -0,0 +1,253 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:45
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('job_type', models.CharField(choices=[('llm', 'LLM模型'), ('text2image', '文生图模型'), ('image2video', '图生视频模型')], max_length=50, verbose_name='任务类型')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('running', '执行中'), ('succeeded', '成功'), ('failed', '失败'), ('cancelled', '已取消')], default='pending', max_length=20, verbose_name='状态')),
+                ('payload', models.JSONField(default=dict, verbose_name='任务参数')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='任务结果')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='错误信息')),
+                ('attempts', models.IntegerField(default=0, verbose_name='已执行次数')),
+                ('max_attempts', models.IntegerField(default=3, verbose_name='最大执行次数')),
+                ('run_after', models.DateTimeField(verbose_name='最早执行时间')),
+                ('locked_by', models.CharField(blank=True, max_length=255, null=True, verbose_name='执行worker')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='锁定截止时间')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='是否请求取消')),
+                ('progress', models.JSONField(blank=True, null=True, verbose_name='执行进度')),
+                ('project_id', models.UUIDField(blank=True, null=True, verbose_name='项目ID')),
+                ('stage_type', models.CharField(blank=True, max_length=50, null=True, verbose_name='阶段类型')),
+                ('user_id', models.BigIntegerField(blank=True, null=True, verbose_name='提交用户ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+            ],
+            options={
+                'verbose_name': '生成任务',
+                'verbose_name_plural': '生成任务',
+                'db_table': 'generation_jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='内容哈希')),
+                ('size', models.BigIntegerField(verbose_name='文件大小(字节)')),
+                ('mime_type', models.CharField(default='application/octet-stream', max_length=100, verbose_name='MIME类型')),
+                ('original_name', models.CharField(blank=True, max_length=255, null=True, verbose_name='原始文件名')),
+                ('project_id', models.UUIDField(blank=True, null=True, verbose_name='项目ID')),
+                ('ref_count', models.IntegerField(default=1, verbose_name='引用次数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('last_referenced_at', models.DateTimeField(auto_now=True, verbose_name='最近引用时间')),
+            ],
+            options={
+                'verbose_name': '媒体文件',
+                'verbose_name_plural': '媒体文件',
+                'db_table': 'media_blobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MediaDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('preset', models.CharField(max_length=50, verbose_name='规格')),
+                ('relative_path', models.CharField(max_length=255, verbose_name='相对路径')),
+                ('mime_type', models.CharField(max_length=100, verbose_name='MIME类型')),
+                ('size', models.BigIntegerField(verbose_name='文件大小(字节)')),
+                ('width', models.IntegerField(verbose_name='宽度')),
+                ('height', models.IntegerField(verbose_name='高度')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('last_accessed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='最近访问时间')),
+            ],
+            options={
+                'verbose_name': '媒体派生文件',
+                'verbose_name_plural': '媒体派生文件',
+                'db_table': 'media_derivatives',
+            },
+        ),
+        migrations.CreateModel(
+            name='ModelUsagePayload',
+            fields=[
+                ('log', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payload', serialize=False, to='models.modelusagelog', verbose_name='使用日志')),
+                ('request_data', models.BinaryField(blank=True, null=True, verbose_name='请求数据(压缩)')),
+                ('response_data', models.BinaryField(blank=True, null=True, verbose_name='响应数据(压缩)')),
+                ('raw_size', models.IntegerField(default=0, verbose_name='原始大小(字节)')),
+                ('stored_size', models.IntegerField(default=0, verbose_name='压缩后大小(字节)')),
+            ],
+            options={
+                'verbose_name': '模型使用日志数据',
+                'verbose_name_plural': '模型使用日志数据',
+                'db_table': 'model_usage_payloads',
+            },
+        ),
+        migrations.CreateModel(
+            name='ModelUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.UUIDField(blank=True, null=True, verbose_name='项目ID')),
+                ('stage_type', models.CharField(blank=True, max_length=50, null=True, verbose_name='阶段类型')),
+                ('granularity', models.CharField(choices=[('hour', '小时'), ('day', '天')], max_length=10, verbose_name='汇总粒度')),
+                ('bucket', models.DateTimeField(verbose_name='时间桶起点')),
+                ('status', models.CharField(choices=[('success', '成功'), ('failed', '失败'), ('timeout', '超时'), ('rate_limited', '限流'), ('error', '错误'), ('budget_exceeded', '超出预算'), ('circuit_open', '熔断开启'), ('circuit_half_open', '熔断半开'), ('circuit_closed', '熔断恢复'), ('short_circuited', '熔断拒绝'), ('unpack_failed', '打包输出无法拆分')], max_length=50, verbose_name='状态')),
+                ('source', models.CharField(choices=[('upstream', '上游调用'), ('cache', '缓存命中'), ('coalesced', '合并请求'), ('reused', '复用产出'), ('local', '本地限流')], default='upstream', max_length=20, verbose_name='结果来源')),
+                ('request_count', models.IntegerField(default=0, verbose_name='调用次数')),
+                ('tokens_used', models.BigIntegerField(default=0, verbose_name='Token总数')),
+                ('latency_sum_ms', models.BigIntegerField(default=0, verbose_name='延迟总和(毫秒)')),
+                ('latency_count', models.IntegerField(default=0, verbose_name='有延迟记录的调用数')),
+                ('latency_bucket_0', models.IntegerField(default=0, verbose_name='延迟≤50ms')),
+                ('latency_bucket_1', models.IntegerField(default=0, verbose_name='延迟≤100ms')),
+                ('latency_bucket_2', models.IntegerField(default=0, verbose_name='延迟≤200ms')),
+                ('latency_bucket_3', models.IntegerField(default=0, verbose_name='延迟≤500ms')),
+                ('latency_bucket_4', models.IntegerField(default=0, verbose_name='延迟≤1000ms')),
+                ('latency_bucket_5', models.IntegerField(default=0, verbose_name='延迟≤2000ms')),
+                ('latency_bucket_6', models.IntegerField(default=0, verbose_name='延迟≤5000ms')),
+                ('latency_bucket_7', models.IntegerField(default=0, verbose_name='延迟≤10000ms')),
+                ('latency_bucket_8', models.IntegerField(default=0, verbose_name='延迟≤20000ms')),
+                ('latency_bucket_9', models.IntegerField(default=0, verbose_name='延迟≤30000ms')),
+                ('latency_bucket_10', models.IntegerField(default=0, verbose_name='延迟≤60000ms')),
+                ('latency_bucket_11', models.IntegerField(default=0, verbose_name='延迟≤120000ms')),
+                ('latency_bucket_12', models.IntegerField(default=0, verbose_name='延迟≤300000ms')),
+                ('latency_bucket_13', models.IntegerField(default=0, verbose_name='延迟>300000ms')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '模型使用汇总',
+                'verbose_name_plural': '模型使用汇总',
+                'db_table': 'model_usage_rollups',
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageBudget',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('scope', models.CharField(choices=[('project', '项目'), ('user', '用户')], max_length=20, verbose_name='范围')),
+                ('scope_id', models.CharField(max_length=64, verbose_name='项目ID/用户ID')),
+                ('token_limit', models.BigIntegerField(blank=True, null=True, verbose_name='Token上限')),
+                ('cost_limit', models.DecimalField(blank=True, decimal_places=6, max_digits=14, null=True, verbose_name='费用上限')),
+                ('request_count', models.BigIntegerField(default=0, verbose_name='调用次数')),
+                ('tokens_used', models.BigIntegerField(default=0, verbose_name='已用Token数')),
+                ('cost_used', models.DecimalField(decimal_places=6, default=0, max_digits=16, verbose_name='已用费用')),
+                ('reserved_tokens', models.BigIntegerField(default=0, verbose_name='预留Token数')),
+                ('reserved_cost', models.DecimalField(decimal_places=6, default=0, max_digits=16, verbose_name='预留费用')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '使用预算',
+                'verbose_name_plural': '使用预算',
+                'db_table': 'usage_budgets',
+            },
+        ),
+        migrations.AddField(
+            model_name='modelusagelog',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='归档时间'),
+        ),
+        migrations.AddField(
+            model_name='modelusagelog',
+            name='cost',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=14, null=True, verbose_name='费用'),
+        ),
+        migrations.AddField(
+            model_name='modelusagelog',
+            name='payload_offloaded',
+            field=models.BooleanField(default=False, verbose_name='数据是否外置'),
+        ),
+        migrations.AddField(
+            model_name='modelusagelog',
+            name='source',
+            field=models.CharField(choices=[('upstream', '上游调用'), ('cache', '缓存命中'), ('coalesced', '合并请求'), ('reused', '复用产出'), ('local', '本地限流')], default='upstream', max_length=20, verbose_name='结果来源'),
+        ),
+        migrations.AddField(
+            model_name='modelusagelog',
+            name='user_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='用户ID'),
+        ),
+        migrations.AlterField(
+            model_name='modelusagelog',
+            name='status',
+            field=models.CharField(choices=[('success', '成功'), ('failed', '失败'), ('timeout', '超时'), ('rate_limited', '限流'), ('error', '错误'), ('budget_exceeded', '超出预算'), ('circuit_open', '熔断开启'), ('circuit_half_open', '熔断半开'), ('circuit_closed', '熔断恢复'), ('short_circuited', '熔断拒绝'), ('unpack_failed', '打包输出无法拆分')], default='success', max_length=50, verbose_name='状态'),
+        ),
+        migrations.AddIndex(
+            model_name='modelusagelog',
+            index=models.Index(fields=['archived_at', 'created_at'], name='model_usage_archive_49a296_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='modelusagelog',
+            index=models.Index(fields=['-created_at', '-id'], name='model_usage_created_5dc4a7_idx'),
+        ),
+        migrations.AddField(
+            model_name='generationjob',
+            name='model_provider',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='models.modelprovider', verbose_name='模型提供商'),
+        ),
+        migrations.AddField(
+            model_name='mediablob',
+            name='model_provider',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='blobs', to='models.modelprovider', verbose_name='来源提供商'),
+        ),
+        migrations.AddField(
+            model_name='mediaderivative',
+            name='source',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='models.mediablob', verbose_name='源文件'),
+        ),
+        migrations.AddField(
+            model_name='modelusagerollup',
+            name='model_provider',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='models.modelprovider', verbose_name='模型提供商'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='usagebudget',
+            unique_together={('scope', 'scope_id')},
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['status', 'run_after'], name='generation__status_80cb4c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['model_provider', 'status'], name='generation__model_p_49ebe9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['project_id', 'stage_type'], name='generation__project_a54357_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediablob',
+            index=models.Index(fields=['project_id', '-created_at'], name='media_blobs_project_ec2239_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediablob',
+            index=models.Index(fields=['model_provider', '-created_at'], name='media_blobs_model_p_fa8887_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='mediaderivative',
+            unique_together={('source', 'preset')},
+        ),
+        migrations.AddIndex(
+            model_name='modelusagerollup',
+            index=models.Index(fields=['model_provider', 'granularity', '-bucket'], name='model_usage_model_p_9606ae_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='modelusagerollup',
+            index=models.Index(fields=['project_id', 'stage_type'], name='model_usage_project_1d17b7_idx'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from django.utils import timezone
 class ModelProvider(models.Model):
     """
     模型提供商
@@ -10,19 +11,19 @@ class ModelProvider(models.Model):
           ('text2image', '文生图模型'),
           ('image2video', '图生视频模型'),
           ]
-     # 执行器选项定义
+     # 执行器选项定义, 第一项为 executor_class 为空时的默认执行器(必须可以导入)
     LLM_EXECUTORS = [
         ('core.ai_client.openai_client.OpenAIClient', 'OpenAI兼容客户端'),
     ]
 
     TEXT2IMAGE_EXECUTORS = [
-        ('core.ai_client.text2image_client.Text2ImageClient', '文生图客户端'),
         ('core.ai_client.comfyui_client.ComfyUIClient', 'ComfyUI客户端'),
+        ('core.ai_client.text2image_client.Text2ImageClient', '文生图客户端'),
     ]
 
     IMAGE2VIDEO_EXECUTORS = [
-        ('core.ai_client.image2video_client.Image2VideoClient', '图生视频客户端'),
         ('core.ai_client.comfyui_client.ComfyUIClient', 'ComfyUI客户端'),
+        ('core.ai_client.image2video_client.Image2VideoClient', '图生视频客户端'),
     ]
 
    
@@ -86,12 +87,16 @@ class ModelProvider(models.Model):
         return ''
     def validate_executor_class(self):
         """
-        验证所选的执行器类是否有效
+        验证所选的执行器类是否有效(属于该类型的可选执行器且可以被注册表解析)
         """
+        from core.ai_client.registry import executor_registry
+
         if not self.executor_class:
             return False
         vialid_executors = [choice[0] for choice in self.get_executor_choices()]
-        return self.executor_class in vialid_executors
+        if self.executor_class not in vialid_executors:
+            return False
+        return executor_registry.is_resolvable(self.executor_class)
 
 class ModelUsageLog(models.Model):
     """
@@ -104,7 +109,31 @@ class ModelUsageLog(models.Model):
     ('timeout', '超时'),
     ('rate_limited', '限流'),
     ('error', '错误'),
+    ('budget_exceeded', '超出预算'),
+    ('circuit_open', '熔断开启'),
+    ('circuit_half_open', '熔断半开'),
+    ('circuit_closed', '熔断恢复'),
+    ('short_circuited', '熔断拒绝'),
+    ('unpack_failed', '打包输出无法拆分'),
 ]
+    # 熔断器写入的状态: 状态切换记录, 以及熔断期间未发往上游的调用
+    CIRCUIT_STATUSES = ('circuit_open', 'circuit_half_open', 'circuit_closed', 'short_circuited')
+    # 没有发往上游的记录(本地拒绝或状态记录), 不计入调用统计、健康判断和预算
+    LOCAL_STATUSES = ('budget_exceeded',) + CIRCUIT_STATUSES
+    # 上游调用成功但本地无法处理输出: 计入调用统计和预算(已产生用量), 不计入健康判断和熔断
+    RESPONSE_STATUSES = ('unpack_failed',)
+    # 结果来源: 真实调用上游, 命中响应缓存, 合并到其他相同的在途请求,
+    # 流水线阶段输入指纹未变化、直接复用了已有产出(没有调用执行器),
+    # 或者被本地限流器拒绝(status 与上游返回 429 相同, 都是 rate_limited, 按 source 区分)
+    SOURCE_CHOICES = [
+        ('upstream', '上游调用'),
+        ('cache', '缓存命中'),
+        ('coalesced', '合并请求'),
+        ('reused', '复用产出'),
+        ('local', '本地限流'),
+    ]
+    # 延迟直方图分桶上界(毫秒), 最后一个桶收纳超过最大上界的请求
+    LATENCY_BUCKETS_MS = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 30000, 60000, 120000, 300000]
     
     id=models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)   
     model_provider=models.ForeignKey(ModelProvider, on_delete=models.CASCADE,related_name='usage_logs', verbose_name="模型提供商")
@@ -117,12 +146,18 @@ class ModelUsageLog(models.Model):
     tokens_used=models.IntegerField(null=True, blank=True, verbose_name="使用Token数",default=0)
     latency_ms=models.IntegerField(null=True, blank=True, verbose_name="延迟(毫秒)",default=0)
     status=models.CharField(max_length=50, verbose_name="状态",default='success',choices=STATUS_CHOICES)  # success, failed
+    source=models.CharField(max_length=20, verbose_name="结果来源",default='upstream',choices=SOURCE_CHOICES)
     error_message=models.TextField(null=True, blank=True, verbose_name="错误信息")
+    # 按 extra_config['pricing'] 计算的费用, 提供商未配置价格时为空
+    cost=models.DecimalField(max_digits=14, decimal_places=6, null=True, blank=True, verbose_name="费用")
 
     # 关联信息
     project_id=models.UUIDField(null=True, blank=True, verbose_name="项目ID")
     stage_type=models.CharField(max_length=50, null=True, blank=True, verbose_name="阶段类型")  # e.g., 'development', 'production'
+    user_id=models.BigIntegerField(null=True, blank=True, verbose_name="用户ID")
     created_at=models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    archived_at=models.DateTimeField(null=True, blank=True, verbose_name="归档时间")  # 请求/响应数据已移入归档文件
+    payload_offloaded=models.BooleanField(default=False, verbose_name="数据是否外置")  # 为True时 request_data/response_data 只是预览
 
     class Meta:
         db_table = 'model_usage_logs'
@@ -132,6 +167,248 @@ class ModelUsageLog(models.Model):
         indexes = [
             models.Index(fields=['model_provider', '-created_at']),
             models.Index(fields=['project_id', 'stage_type']),
+            models.Index(fields=['archived_at', 'created_at']),
+            # 使用日志列表的 (created_at, id) keyset 分页
+            models.Index(fields=['-created_at', '-id']),
+        ]
+    def __str__(self):
+        return f'{self.model_provider.name} - {self.created_at}'
+
+class ModelUsagePayload(models.Model):
+    """
+    外置的使用日志请求/响应数据
+    职责: 保存超过阈值的 request_data/response_data(zlib压缩的JSON), 日志表中只保留预览, 查看详情时才读取
+    """
+    log = models.OneToOneField(
+        ModelUsageLog, on_delete=models.CASCADE, primary_key=True, related_name='payload', verbose_name="使用日志"
+    )
+    request_data = models.BinaryField(null=True, blank=True, verbose_name="请求数据(压缩)")
+    response_data = models.BinaryField(null=True, blank=True, verbose_name="响应数据(压缩)")
+    raw_size = models.IntegerField(default=0, verbose_name="原始大小(字节)")
+    stored_size = models.IntegerField(default=0, verbose_name="压缩后大小(字节)")
+
+    class Meta:
+        db_table = 'model_usage_payloads'
+        verbose_name = '模型使用日志数据'
+        verbose_name_plural = '模型使用日志数据'
+
+    def __str__(self):
+        return f'{self.log_id} ({self.raw_size} -> {self.stored_size} bytes)'
+
+class ModelUsageRollup(models.Model):
+    """
+    模型使用汇总
+    职责: 按小时/天预聚合 ModelUsageLog, 统计接口只读汇总表而不扫描原始日志
+    """
+    GRANULARITY_CHOICES = [
+        ('hour', '小时'),
+        ('day', '天'),
+    ]
+    LATENCY_BUCKET_FIELDS = tuple(
+        f'latency_bucket_{index}' for index in range(len(ModelUsageLog.LATENCY_BUCKETS_MS) + 1)
+    )
+
+    model_provider = models.ForeignKey(ModelProvider, on_delete=models.CASCADE, related_name='usage_rollups', verbose_name="模型提供商")
+    project_id = models.UUIDField(null=True, blank=True, verbose_name="项目ID")
+    stage_type = models.CharField(max_length=50, null=True, blank=True, verbose_name="阶段类型")
+    granularity = models.CharField(max_length=10, choices=GRANULARITY_CHOICES, verbose_name="汇总粒度")
+    bucket = models.DateTimeField(verbose_name="时间桶起点")
+    status = models.CharField(max_length=50, choices=ModelUsageLog.STATUS_CHOICES, verbose_name="状态")
+    source = models.CharField(max_length=20, choices=ModelUsageLog.SOURCE_CHOICES, default='upstream', verbose_name="结果来源")
+
+    # 汇总指标
+    request_count = models.IntegerField(default=0, verbose_name="调用次数")
+    tokens_used = models.BigIntegerField(default=0, verbose_name="Token总数")
+    latency_sum_ms = models.BigIntegerField(default=0, verbose_name="延迟总和(毫秒)")
+    latency_count = models.IntegerField(default=0, verbose_name="有延迟记录的调用数")
+    # 延迟直方图: 与 ModelUsageLog.LATENCY_BUCKETS_MS 对应的分桶计数, 最后一个为溢出桶
+    # 每个分桶一列, 并发落库时用 F() 原子累加
+    latency_bucket_0 = models.IntegerField(default=0, verbose_name="延迟≤50ms")
+    latency_bucket_1 = models.IntegerField(default=0, verbose_name="延迟≤100ms")
+    latency_bucket_2 = models.IntegerField(default=0, verbose_name="延迟≤200ms")
+    latency_bucket_3 = models.IntegerField(default=0, verbose_name="延迟≤500ms")
+    latency_bucket_4 = models.IntegerField(default=0, verbose_name="延迟≤1000ms")
+    latency_bucket_5 = models.IntegerField(default=0, verbose_name="延迟≤2000ms")
+    latency_bucket_6 = models.IntegerField(default=0, verbose_name="延迟≤5000ms")
+    latency_bucket_7 = models.IntegerField(default=0, verbose_name="延迟≤10000ms")
+    latency_bucket_8 = models.IntegerField(default=0, verbose_name="延迟≤20000ms")
+    latency_bucket_9 = models.IntegerField(default=0, verbose_name="延迟≤30000ms")
+    latency_bucket_10 = models.IntegerField(default=0, verbose_name="延迟≤60000ms")
+    latency_bucket_11 = models.IntegerField(default=0, verbose_name="延迟≤120000ms")
+    latency_bucket_12 = models.IntegerField(default=0, verbose_name="延迟≤300000ms")
+    latency_bucket_13 = models.IntegerField(default=0, verbose_name="延迟>300000ms")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = 'model_usage_rollups'
+        verbose_name = '模型使用汇总'
+        verbose_name_plural = '模型使用汇总'
+        ordering = ['-bucket']
+        indexes = [
+            models.Index(fields=['model_provider', 'granularity', '-bucket']),
+            models.Index(fields=['project_id', 'stage_type']),
+        ]
+
+    def __str__(self):
+        return f'{self.model_provider_id} - {self.granularity} {self.bucket} ({self.status})'
+
+    @property
+    def latency_histogram(self):
+        """各分桶计数列表"""
+        return [getattr(self, field) for field in self.LATENCY_BUCKET_FIELDS]
+
+
+class GenerationJob(models.Model):
+    """
+    生成任务
+    职责: 耗时的生成调用(图生视频、文生图等)在后台worker中执行, 请求方提交后轮询结果
+    """
+    STATUS_CHOICES = [
+        ('pending', '等待中'),
+        ('running', '执行中'),
+        ('succeeded', '成功'),
+        ('failed', '失败'),
+        ('cancelled', '已取消'),
+    ]
+    FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled')
+    # LLM任务 payload 允许的字段: prompt/system_prompt 以及可以覆盖提供商配置的参数
+    LLM_OVERRIDE_KEYS = ('max_tokens', 'temperature', 'top_p')
+    LLM_PAYLOAD_KEYS = ('prompt', 'system_prompt') + LLM_OVERRIDE_KEYS
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    model_provider = models.ForeignKey(ModelProvider, on_delete=models.CASCADE, related_name='jobs', verbose_name="模型提供商")
+    job_type = models.CharField(max_length=50, choices=ModelProvider.PROVIDER_TYPES, verbose_name="任务类型")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="状态")
+    payload = models.JSONField(default=dict, verbose_name="任务参数")
+    result = models.JSONField(null=True, blank=True, verbose_name="任务结果")
+    error_message = models.TextField(null=True, blank=True, verbose_name="错误信息")
+
+    # 重试与可见性超时
+    attempts = models.IntegerField(default=0, verbose_name="已执行次数")
+    max_attempts = models.IntegerField(default=3, verbose_name="最大执行次数")
+    run_after = models.DateTimeField(verbose_name="最早执行时间")
+    locked_by = models.CharField(max_length=255, null=True, blank=True, verbose_name="执行worker")
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name="锁定截止时间")
+    cancel_requested = models.BooleanField(default=False, verbose_name="是否请求取消")
+    # 执行器上报的最新进度, 如 ComfyUI 的 {"type", "node", "value", "max"}
+    progress = models.JSONField(null=True, blank=True, verbose_name="执行进度")
+
+    # 关联信息
+    project_id = models.UUIDField(null=True, blank=True, verbose_name="项目ID")
+    stage_type = models.CharField(max_length=50, null=True, blank=True, verbose_name="阶段类型")
+    user_id = models.BigIntegerField(null=True, blank=True, verbose_name="提交用户ID")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="结束时间")
+
+    class Meta:
+        db_table = 'generation_jobs'
+        verbose_name = '生成任务'
+        verbose_name_plural = '生成任务'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['model_provider', 'status']),
+            models.Index(fields=['project_id', 'stage_type']),
+        ]
+
+    def __str__(self):
+        return f'{self.get_job_type_display()} - {self.get_status_display()} ({self.id})'
+
+
+class MediaBlob(models.Model):
+    """
+    生成产物的内容寻址存储索引
+    职责: 记录 STORAGE_ROOT 下按内容哈希存放的图片/视频文件的元数据, 相同内容只保存一份
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True, verbose_name="内容哈希")
+    size = models.BigIntegerField(verbose_name="文件大小(字节)")
+    mime_type = models.CharField(max_length=100, default='application/octet-stream', verbose_name="MIME类型")
+    original_name = models.CharField(max_length=255, null=True, blank=True, verbose_name="原始文件名")
+    model_provider = models.ForeignKey(
+        ModelProvider, on_delete=models.SET_NULL, null=True, blank=True, related_name='blobs', verbose_name="来源提供商"
+    )
+    project_id = models.UUIDField(null=True, blank=True, verbose_name="项目ID")
+    ref_count = models.IntegerField(default=1, verbose_name="引用次数")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    last_referenced_at = models.DateTimeField(auto_now=True, verbose_name="最近引用时间")
+
+    class Meta:
+        db_table = 'media_blobs'
+        verbose_name = '媒体文件'
+        verbose_name_plural = '媒体文件'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['project_id', '-created_at']),
+            models.Index(fields=['model_provider', '-created_at']),
         ]
+
+    def __str__(self):
+        return f'{self.sha256[:12]} ({self.mime_type}, {self.size} bytes)'
+
+
+class MediaDerivative(models.Model):
+    """
+    媒体文件的派生文件(缩略图、预览图、视频封面帧)
+    职责: 记录派生缓存中的文件及最近访问时间, 用于按LRU淘汰以控制磁盘占用
+    """
+    source = models.ForeignKey(MediaBlob, on_delete=models.CASCADE, related_name='derivatives', verbose_name="源文件")
+    preset = models.CharField(max_length=50, verbose_name="规格")
+    relative_path = models.CharField(max_length=255, verbose_name="相对路径")
+    mime_type = models.CharField(max_length=100, verbose_name="MIME类型")
+    size = models.BigIntegerField(verbose_name="文件大小(字节)")
+    width = models.IntegerField(verbose_name="宽度")
+    height = models.IntegerField(verbose_name="高度")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    last_accessed_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="最近访问时间")
+
+    class Meta:
+        db_table = 'media_derivatives'
+        verbose_name = '媒体派生文件'
+        verbose_name_plural = '媒体派生文件'
+        unique_together = [('source', 'preset')]
+
+    def __str__(self):
+        return f'{self.source_id[:12]} - {self.preset}'
+
+
+class UsageBudget(models.Model):
+    """
+    使用预算账本
+    职责: 按项目/用户累计调用次数、Token 数和费用(每次调用原子递增), 并保存可选的额度上限;
+    调用前据此拒绝会超出预算的请求, 统计接口直接读取这里的计数而不是聚合原始日志
+    """
+    SCOPE_CHOICES = [
+        ('project', '项目'),
+        ('user', '用户'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES, verbose_name="范围")
+    scope_id = models.CharField(max_length=64, verbose_name="项目ID/用户ID")
+
+    # 额度上限, 为空表示不限制
+    token_limit = models.BigIntegerField(null=True, blank=True, verbose_name="Token上限")
+    cost_limit = models.DecimalField(max_digits=14, decimal_places=6, null=True, blank=True, verbose_name="费用上限")
+
+    # 累计用量
+    request_count = models.BigIntegerField(default=0, verbose_name="调用次数")
+    tokens_used = models.BigIntegerField(default=0, verbose_name="已用Token数")
+    cost_used = models.DecimalField(max_digits=16, decimal_places=6, default=0, verbose_name="已用费用")
+
+    # 在途调用预留的估算用量, 调用结束后按实际用量结算
+    reserved_tokens = models.BigIntegerField(default=0, verbose_name="预留Token数")
+    reserved_cost = models.DecimalField(max_digits=16, decimal_places=6, default=0, verbose_name="预留费用")
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = 'usage_budgets'
+        verbose_name = '使用预算'
+        verbose_name_plural = '使用预算'
+        unique_together = [('scope', 'scope_id')]
+
     def __str__(self):
-        return f'{self.model_provider.name} - {self.created_at}'
\ No newline at end of file
+        return f'{self.get_scope_display()} {self.scope_id}'
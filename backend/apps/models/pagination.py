@@ -0,0 +1,80 @@
+"""模型管理分页器"""
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class UsageLogCursorPagination(CursorPagination):
+    """
+    使用日志游标分页
+    按 (created_at, id) 倒序做 keyset 分页: 游标保存上一页边界行的 (created_at, id),
+    下一页条件为 created_at < c OR (created_at = c AND id < i), 由 (created_at, id) 索引直接定位;
+    批量写入产生的相同 created_at 不会退化成 OFFSET 扫描, 也不执行 COUNT(*)
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    @staticmethod
+    def encode_position(log) -> str:
+        return f'{log.created_at.isoformat()}|{log.pk}'
+
+    def decode_position(self, position: str):
+        """
+        Returns:
+            (created_at, id)
+
+        Raises:
+            NotFound: 游标无效
+        """
+        created_at, _, pk = position.partition('|')
+        created_at = parse_datetime(created_at)
+        if created_at is None or not pk:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.reverse)
+
+        if reverse:
+            queryset = queryset.order_by('created_at', 'id')
+        else:
+            queryset = queryset.order_by('-created_at', '-id')
+        if self.cursor and self.cursor.position:
+            created_at, pk = self.decode_position(self.cursor.position)
+            if reverse:
+                boundary = Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            else:
+                boundary = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            queryset = queryset.filter(boundary)
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+        if reverse:
+            # 向前翻页按正序取出, 返回前恢复倒序
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, bool(self.cursor and self.cursor.position)
+        if self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.encode_position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.encode_position(self.page[0])))
@@ -0,0 +1,143 @@
+"""
+使用日志请求/响应数据外置
+职责: 超过阈值的 request_data/response_data 压缩后写入 model_usage_payloads 表,
+日志行中只保留一段预览, 列表和统计查询不再读取大块JSON; 查看详情时再按需加载
+"""
+import json
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import ModelUsageLog, ModelUsagePayload
+
+PAYLOAD_FIELDS = ('request_data', 'response_data')
+
+
+class PayloadStore:
+    """
+    日志数据外置存储
+
+    外置后日志行中的字段变为 {"_offloaded": true, "size": 原始字节数, "preview": "前N个字符"},
+    并设置 payload_offloaded=True
+    """
+
+    def __init__(self, threshold: int = 8192, preview_chars: int = 200, compression_level: int = 6,
+                 enabled: bool = True):
+        self.threshold = threshold
+        self.preview_chars = preview_chars
+        self.compression_level = compression_level
+        self.enabled = enabled
+
+    @classmethod
+    def from_settings(cls) -> 'PayloadStore':
+        config = getattr(settings, 'USAGE_LOG_PAYLOADS', {})
+        return cls(
+            threshold=config.get('OFFLOAD_THRESHOLD', 8192),
+            preview_chars=config.get('PREVIEW_CHARS', 200),
+            compression_level=config.get('COMPRESSION_LEVEL', 6),
+            enabled=config.get('ENABLED', True),
+        )
+
+    @staticmethod
+    def encode(value: Any) -> bytes:
+        return json.dumps(value, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8')
+
+    def preview(self, raw: bytes) -> Dict[str, Any]:
+        return {
+            '_offloaded': True,
+            'size': len(raw),
+            'preview': raw[:self.preview_chars * 4].decode('utf-8', errors='ignore')[:self.preview_chars],
+        }
+
+    def split(self, log: ModelUsageLog) -> Optional[ModelUsagePayload]:
+        """
+        把日志中超过阈值的字段移到外置记录, 原地替换为预览
+
+        Returns:
+            需要和日志一起保存的外置记录, 没有字段超过阈值时返回 None
+        """
+        if not self.enabled:
+            return None
+        if log.payload_offloaded:
+            # 写入失败后重试时, 字段已被替换为预览, 使用上次拆出的外置记录
+            return getattr(log, '_pending_payload', None)
+        payload = ModelUsagePayload(log=log)
+        for field in PAYLOAD_FIELDS:
+            raw = self.encode(getattr(log, field))
+            if len(raw) < self.threshold:
+                continue
+            compressed = zlib.compress(raw, self.compression_level)
+            setattr(payload, field, compressed)
+            setattr(log, field, self.preview(raw))
+            payload.raw_size += len(raw)
+            payload.stored_size += len(compressed)
+        if not payload.raw_size:
+            return None
+        log.payload_offloaded = True
+        log._pending_payload = payload
+        return payload
+
+    def save_log(self, log: ModelUsageLog) -> None:
+        """保存单条日志(触发 post_save 信号)"""
+        payload = self.split(log)
+        with transaction.atomic():
+            log.save()
+            if payload is not None:
+                payload.save()
+
+    def save_logs(self, logs: List[ModelUsageLog], batch_size: Optional[int] = None) -> None:
+        """批量保存日志及其外置数据(同一事务)"""
+        payloads = [payload for payload in (self.split(log) for log in logs) if payload is not None]
+        with transaction.atomic():
+            ModelUsageLog.objects.bulk_create(logs, batch_size=batch_size)
+            if payloads:
+                ModelUsagePayload.objects.bulk_create(payloads, batch_size=batch_size)
+
+    @staticmethod
+    def decode(data) -> Any:
+        return json.loads(zlib.decompress(bytes(data)))
+
+    def load(self, log_ids: Iterable) -> Dict[str, Dict[str, Any]]:
+        """
+        读取外置数据
+
+        Returns:
+            日志ID -> {字段名: 原始数据}, 只包含被外置的字段
+        """
+        loaded = {}
+        for log_id, *values in ModelUsagePayload.objects.filter(log_id__in=list(log_ids)).values_list(
+            'log_id', *PAYLOAD_FIELDS
+        ):
+            loaded[str(log_id)] = {
+                field: self.decode(value) for field, value in zip(PAYLOAD_FIELDS, values) if value is not None
+            }
+        return loaded
+
+    def hydrate(self, log: ModelUsageLog) -> ModelUsageLog:
+        """把外置数据放回日志实例(不保存), 供详情接口返回完整内容"""
+        if log.payload_offloaded:
+            for field, value in self.load([log.pk]).get(str(log.pk), {}).items():
+                setattr(log, field, value)
+        return log
+
+    def restore_rows(self, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List]:
+        """
+        把 values() 取出的日志行中的预览替换为完整数据(归档时使用)
+
+        Returns:
+            (完整的日志行, 有外置数据的日志ID)
+        """
+        offloaded = [row['id'] for row in rows if row.get('payload_offloaded')]
+        if not offloaded:
+            return rows, []
+        loaded = self.load(offloaded)
+        for row in rows:
+            row.update(loaded.get(str(row['id']), {}))
+        return rows, offloaded
+
+
+# 进程级单例
+payload_store = PayloadStore.from_settings()
@@ -0,0 +1,136 @@
+"""
+模型提供商配置快照缓存
+职责: 在进程内缓存全部提供商配置(按 provider_type 分组), 生成调用不再逐次查询数据库;
+提供商保存/删除时通过信号递增版本号使快照失效
+"""
+import threading
+import time
+from typing import Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import ModelProvider
+
+
+class ProviderSnapshot:
+    """某一版本的提供商配置, 加载后只读"""
+
+    def __init__(self, providers: List[ModelProvider], version: int):
+        self.version = version
+        self.by_id: Dict[str, ModelProvider] = {str(provider.id): provider for provider in providers}
+        self.active_by_type: Dict[str, List[ModelProvider]] = {}
+        for provider in providers:
+            if provider.is_active:
+                self.active_by_type.setdefault(provider.provider_type, []).append(provider)
+
+
+class ProviderCache:
+    """
+    提供商快照缓存
+
+    版本号保存在 Django 缓存中: 信号处理时递增, 读取时最多每 version_check_interval 秒比较一次,
+    版本变化即重新加载。多进程部署需要把 CACHE_ALIAS 指向共享缓存(如 Redis),
+    使用本地内存缓存时其他进程的修改最迟在 max_age 秒后生效。
+
+    快照中的 ModelProvider 实例被多个请求共享, 调用方不应修改或保存它们。
+    """
+    VERSION_KEY = 'model_providers:version'
+
+    def __init__(self, cache_alias: str = 'default', version_check_interval: float = 1.0, max_age: float = 300.0):
+        self.cache_alias = cache_alias
+        self.version_check_interval = version_check_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ProviderSnapshot] = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    @classmethod
+    def from_settings(cls) -> 'ProviderCache':
+        """根据 settings.PROVIDER_CACHE 创建缓存"""
+        config = getattr(settings, 'PROVIDER_CACHE', {})
+        return cls(
+            cache_alias=config.get('CACHE_ALIAS', 'default'),
+            version_check_interval=config.get('VERSION_CHECK_INTERVAL', 1.0),
+            max_age=config.get('MAX_AGE', 300.0),
+        )
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def current_version(self) -> int:
+        """共享缓存中的版本号"""
+        return self.cache.get_or_set(self.VERSION_KEY, 1, timeout=None)
+
+    def bump_version(self) -> int:
+        """递增版本号, 所有进程的快照随之失效"""
+        try:
+            version = self.cache.incr(self.VERSION_KEY)
+        except ValueError:
+            # 缓存中还没有版本号(或已被清除)
+            self.cache.add(self.VERSION_KEY, 1, timeout=None)
+            version = self.cache.incr(self.VERSION_KEY)
+        with self._lock:
+            self._snapshot = None
+        return version
+
+    def _expired(self, now: float) -> bool:
+        """快照超过 max_age 后必须重新加载, 即使版本号未变化(其他进程的修改可能未递增本地缓存中的版本)"""
+        return now - self._loaded_at >= self.max_age
+
+    def _fresh_snapshot(self) -> Optional[ProviderSnapshot]:
+        """不需要查询数据库即可使用的快照, 没有时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or self._expired(now):
+                return None
+            if now - self._checked_at < self.version_check_interval:
+                return snapshot
+        if self.current_version() != snapshot.version:
+            return None
+        with self._lock:
+            self._checked_at = now
+        return snapshot
+
+    def snapshot(self) -> ProviderSnapshot:
+        """当前快照, 过期时从数据库重新加载"""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot
+        # 先读版本号再查询, 加载期间发生的修改会让下次检查重新加载
+        version = self.current_version()
+        providers = list(ModelProvider.objects.order_by('-priority', 'created_at'))
+        snapshot = ProviderSnapshot(providers, version)
+        now = time.monotonic()
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_at = self._checked_at = now
+        return snapshot
+
+    async def asnapshot(self) -> ProviderSnapshot:
+        """异步版本, 只有需要访问缓存或数据库时才切换到线程"""
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and not self._expired(now) and now - self._checked_at < self.version_check_interval:
+                return snapshot
+        return await sync_to_async(self.snapshot)()
+
+    def get(self, provider_id) -> Optional[ModelProvider]:
+        """按ID获取提供商(包括未激活的), 不存在时返回 None"""
+        return self.snapshot().by_id.get(str(provider_id))
+
+    async def aget(self, provider_id) -> Optional[ModelProvider]:
+        return (await self.asnapshot()).by_id.get(str(provider_id))
+
+    def get_active(self, provider_type: str) -> List[ModelProvider]:
+        """某类型的激活提供商(按优先级倒序)"""
+        return self.snapshot().active_by_type.get(provider_type, [])
+
+
+# 进程级单例
+provider_cache = ProviderCache.from_settings()
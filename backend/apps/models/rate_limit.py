@@ -0,0 +1,242 @@
+"""
+模型提供商限流
+职责: 按提供商ID执行 rate_limit_rpm / rate_limit_rpd, 在请求发往上游之前就给出"等待多久"或"直接限流"的结果
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .models import ModelProvider
+
+# (限流键, 周期内允许的请求数, 周期秒数)
+Limit = Tuple[str, int, int]
+
+
+class RateLimitDecision(NamedTuple):
+    """限流判断结果"""
+    allowed: bool
+    # 被限流时预计还需等待的秒数
+    retry_after: float = 0.0
+    # 触发限流的规则: rpm / rpd
+    limit: Optional[str] = None
+
+    @property
+    def status(self) -> Optional[str]:
+        """被限流时的 ModelUsageLog 状态, 与上游返回 429 相同(使用日志以 source='local' 区分)"""
+        return None if self.allowed else 'rate_limited'
+
+
+class InMemoryRateLimitBackend:
+    """
+    进程内令牌桶
+    桶容量为周期内的请求数, 按 limit/period 的速率匀速补充令牌; 只对单进程生效
+    """
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        # key -> (剩余令牌数, 上次补充时间)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def _refill(self, key: str, limit: int, period: int, now: float) -> float:
+        tokens, updated_at = self._buckets.get(key, (float(limit), now))
+        return min(float(limit), tokens + (now - updated_at) * limit / period)
+
+    def acquire(self, limits: List[Limit]) -> Tuple[float, Optional[str]]:
+        """
+        所有规则都有令牌时一起扣减
+
+        Returns:
+            (需要等待的秒数, 触发限流的键); 放行时为 (0, None)
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait, blocked_by = 0.0, None
+            refilled = {}
+            for key, limit, period in limits:
+                tokens = self._refill(key, limit, period, now)
+                refilled[key] = tokens
+                needed = (1 - tokens) * period / limit if tokens < 1 else 0.0
+                if needed > wait:
+                    wait, blocked_by = needed, key
+            if blocked_by is not None:
+                return wait, blocked_by
+            for key, _, _ in limits:
+                self._buckets[key] = (refilled[key] - 1, now)
+            return 0.0, None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheRateLimitBackend:
+    """
+    基于 Django 缓存的滑动窗口计数器, 多进程共享
+    缓存后端配置为 Redis 等共享缓存时跨进程生效; 默认的 LocMemCache 可作为本地替身
+    当前窗口计数 + 上一窗口计数 × 未过去的比例 作为滑动窗口内的请求数估计
+
+    先原子地 incr 当前窗口计数再判断是否超限, 超限时 decr 回滚,
+    并发请求不会在"读取计数"和"写入计数"之间同时通过
+    """
+
+    def __init__(self, cache_alias: str = 'default', key_prefix: str = 'rate_limit', **options):
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+
+    def _window_key(self, key: str, window: int) -> str:
+        return f'{self.key_prefix}:{key}:{window}'
+
+    def _increment(self, window_key: str, period: int) -> int:
+        """原子地为窗口计数加一, 返回加一后的计数"""
+        # 两个周期后过期, 保证下一窗口还能读到本窗口计数
+        self.cache.add(window_key, 0, timeout=period * 2)
+        try:
+            return self.cache.incr(window_key)
+        except ValueError:
+            # add 之后键恰好过期
+            self.cache.set(window_key, 1, timeout=period * 2)
+            return 1
+
+    def acquire(self, limits: List[Limit]) -> Tuple[float, Optional[str]]:
+        now = time.time()
+        wait, blocked_by = 0.0, None
+        incremented = []
+        for key, limit, period in limits:
+            window = int(now // period)
+            elapsed = (now % period) / period
+            window_key = self._window_key(key, window)
+            current = self._increment(window_key, period)
+            incremented.append(window_key)
+            previous = self.cache.get(self._window_key(key, window - 1), 0)
+            estimated = current + previous * (1 - elapsed)
+            if estimated > limit:
+                if previous:
+                    # 上一窗口的权重衰减到可以再放行一个请求所需的时间
+                    needed = (estimated - limit) / previous * period
+                else:
+                    needed = period - now % period
+                if needed > wait:
+                    wait, blocked_by = needed, key
+        if blocked_by is not None:
+            # 回滚本次占用的计数
+            for window_key in incremented:
+                try:
+                    self.cache.decr(window_key)
+                except ValueError:
+                    pass
+            return wait, blocked_by
+        return 0.0, None
+
+    def reset(self) -> None:
+        """缓存后端不支持按前缀删除, 由键的过期时间回收"""
+
+
+class RateLimiter:
+    """
+    提供商限流器
+
+    用法:
+        decision = rate_limiter.acquire(provider, max_wait=5)
+        if not decision.allowed:
+            # 已经写入一条 status='rate_limited', source='local' 的使用日志
+            ...
+    """
+    PERIODS = (
+        ('rpm', 'rate_limit_rpm', 60),
+        ('rpd', 'rate_limit_rpd', 86400),
+    )
+
+    def __init__(self, backend=None):
+        self.backend = backend or InMemoryRateLimitBackend()
+
+    @classmethod
+    def from_settings(cls) -> 'RateLimiter':
+        """根据 settings.RATE_LIMIT 创建限流器"""
+        config = getattr(settings, 'RATE_LIMIT', {})
+        backend_class = import_string(config.get('BACKEND', 'apps.models.rate_limit.InMemoryRateLimitBackend'))
+        return cls(backend_class(**config.get('OPTIONS', {})))
+
+    def get_limits(self, provider: ModelProvider) -> List[Limit]:
+        """提供商配置的限流规则, 未配置或<=0的规则不生效"""
+        limits = []
+        for name, field, period in self.PERIODS:
+            limit = getattr(provider, field)
+            if limit and limit > 0:
+                limits.append((f'{provider.id}:{name}', limit, period))
+        return limits
+
+    def check(self, provider: ModelProvider) -> RateLimitDecision:
+        """
+        尝试占用一次调用配额, 不等待
+
+        Returns:
+            放行时 allowed=True; 否则给出 retry_after 和触发的规则
+        """
+        limits = self.get_limits(provider)
+        if not limits:
+            return RateLimitDecision(True)
+        wait, blocked_by = self.backend.acquire(limits)
+        if blocked_by is None:
+            return RateLimitDecision(True)
+        return RateLimitDecision(False, wait, blocked_by.rsplit(':', 1)[1])
+
+    def acquire(self, provider: ModelProvider, max_wait: float = 0.0, **log_fields) -> RateLimitDecision:
+        """
+        占用一次调用配额, 最多等待 max_wait 秒
+
+        超过等待上限时写入一条 status='rate_limited', source='local' 的使用日志(log_fields 可补充 project_id 等)
+        并立即返回被限流的结果
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            decision = self.check(provider)
+            if decision.allowed:
+                return decision
+            remaining = deadline - time.monotonic()
+            if decision.retry_after > remaining:
+                self.record_rate_limited(provider, decision, **log_fields)
+                return decision
+            time.sleep(decision.retry_after)
+
+    async def aacquire(self, provider: ModelProvider, max_wait: float = 0.0, **log_fields) -> RateLimitDecision:
+        """
+        acquire 的异步版本, 等待期间不阻塞事件循环
+        限流后端(缓存)和使用日志的访问在线程池中执行
+        """
+        if not self.get_limits(provider):
+            return RateLimitDecision(True)
+        deadline = time.monotonic() + max_wait
+        while True:
+            decision = await sync_to_async(self.check)(provider)
+            if decision.allowed:
+                return decision
+            remaining = deadline - time.monotonic()
+            if decision.retry_after > remaining:
+                await sync_to_async(self.record_rate_limited)(provider, decision, **log_fields)
+                return decision
+            await asyncio.sleep(decision.retry_after)
+
+    @staticmethod
+    def record_rate_limited(provider: ModelProvider, decision: RateLimitDecision, **log_fields) -> None:
+        """记录一次本地限流"""
+        from .usage_buffer import usage_log_buffer
+
+        log_fields.setdefault('error_message', f'触发 {decision.limit} 限流, 预计 {decision.retry_after:.1f} 秒后可重试')
+        usage_log_buffer.record(
+            model_provider=provider,
+            status=decision.status,
+            source='local',
+            tokens_used=0,
+            latency_ms=0,
+            **log_fields,
+        )
+
+
+# 进程级共享的限流器
+rate_limiter = RateLimiter.from_settings()
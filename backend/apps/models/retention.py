@@ -0,0 +1,183 @@
+"""
+模型使用日志保留策略
+职责: 把超过保留期的日志完整写入压缩的 JSONL 归档文件, 清空库中的请求/响应数据(保留指标列),
+并可删除更早的日志行; 所有操作分批执行, 每批一个短事务, 避免长时间锁住 SQLite
+"""
+import gzip
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ModelUsageLog, ModelUsagePayload
+from .payloads import payload_store
+
+try:
+    import zstandard
+except ImportError:  # 只能使用 gzip 格式
+    zstandard = None
+
+ARCHIVE_FIELDS = [
+    'id', 'model_provider_id', 'request_data', 'response_data', 'tokens_used', 'latency_ms',
+    'status', 'source', 'error_message', 'cost', 'project_id', 'stage_type', 'user_id', 'created_at',
+    'payload_offloaded',
+]
+FORMAT_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+
+def get_retention_settings() -> dict:
+    config = {
+        'ARCHIVE_AFTER_DAYS': 30,
+        'DELETE_AFTER_DAYS': None,
+        'ARCHIVE_ROOT': Path(settings.BASE_DIR).parent / 'archives' / 'usage_logs',
+        'FORMAT': 'gzip',
+        'BATCH_SIZE': 500,
+        'BATCH_PAUSE': 0.05,
+    }
+    config.update(getattr(settings, 'USAGE_LOG_RETENTION', {}))
+    return config
+
+
+class UsageLogArchiver:
+    """
+    使用日志归档器
+
+    归档文件按日志创建日期分文件: <ARCHIVE_ROOT>/YYYY/MM/usage_logs_YYYYMMDD.jsonl.gz,
+    每批追加一个新的 gzip member / zstd frame, 标准解压工具可以直接读取整个文件。
+    先写入并 fsync 归档文件、再清空库中数据, 中途崩溃最多导致归档中出现重复行(按 id 去重即可)。
+    """
+
+    def __init__(self, archive_root, compression: str = 'gzip', batch_size: int = 500, batch_pause: float = 0.05):
+        if compression not in FORMAT_EXTENSIONS:
+            raise ValueError(f'不支持的压缩格式: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('使用 zstd 格式需要安装 zstandard')
+        self.archive_root = Path(archive_root)
+        self.compression = compression
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+
+    @classmethod
+    def from_settings(cls, **overrides) -> 'UsageLogArchiver':
+        config = get_retention_settings()
+        return cls(
+            archive_root=overrides.get('archive_root') or config['ARCHIVE_ROOT'],
+            compression=overrides.get('compression') or config['FORMAT'],
+            batch_size=overrides.get('batch_size') or config['BATCH_SIZE'],
+            batch_pause=config['BATCH_PAUSE'] if overrides.get('batch_pause') is None else overrides['batch_pause'],
+        )
+
+    def archive_path(self, day: datetime) -> Path:
+        extension = FORMAT_EXTENSIONS[self.compression]
+        return self.archive_root / f'{day:%Y}' / f'{day:%m}' / f'usage_logs_{day:%Y%m%d}.jsonl.{extension}'
+
+    def compress(self, data: bytes) -> bytes:
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    def write_rows(self, rows: List[Dict]) -> Dict[Path, int]:
+        """
+        把一批日志追加到各自日期的归档文件
+
+        Returns:
+            归档文件 -> 写入行数
+        """
+        by_path: Dict[Path, List[bytes]] = {}
+        for row in rows:
+            line = json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+            path = self.archive_path(timezone.localtime(row['created_at']))
+            by_path.setdefault(path, []).append(line.encode('utf-8'))
+        for path, lines in by_path.items():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'ab') as archive:
+                archive.write(self.compress(b''.join(lines)))
+                archive.flush()
+                os.fsync(archive.fileno())
+        return {path: len(lines) for path, lines in by_path.items()}
+
+    def batches(self, queryset) -> Iterator[List]:
+        """
+        按 (created_at, id) 顺序分批取出主键
+        每批处理后这些行会被更新或删除, 因此总是重新查询第一页
+        """
+        while True:
+            ids = list(queryset.order_by('created_at', 'id').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                return
+            yield ids
+            if len(ids) < self.batch_size:
+                return
+            if self.batch_pause:
+                # 让出数据库写锁给在线请求
+                time.sleep(self.batch_pause)
+
+    def archive(self, before: datetime, dry_run: bool = False) -> int:
+        """
+        归档 before 之前尚未归档的日志并清空其请求/响应数据
+
+        Returns:
+            归档的日志数
+        """
+        pending = ModelUsageLog.objects.filter(created_at__lt=before, archived_at__isnull=True)
+        if dry_run:
+            return pending.count()
+        archived = 0
+        for ids in self.batches(pending):
+            rows = list(ModelUsageLog.objects.filter(id__in=ids).values(*ARCHIVE_FIELDS))
+            # 外置的数据一并归档
+            rows, offloaded = payload_store.restore_rows(rows)
+            for row in rows:
+                row.pop('payload_offloaded')
+            self.write_rows(rows)
+            with transaction.atomic():
+                archived += ModelUsageLog.objects.filter(id__in=ids, archived_at__isnull=True).update(
+                    request_data={}, response_data={}, payload_offloaded=False, archived_at=timezone.now(),
+                )
+                if offloaded:
+                    ModelUsagePayload.objects.filter(log_id__in=offloaded).delete()
+        return archived
+
+    def delete(self, before: datetime, dry_run: bool = False) -> int:
+        """
+        删除 before 之前且已归档的日志行(汇总表中的统计不受影响)
+
+        Returns:
+            删除的日志数
+        """
+        expired = ModelUsageLog.objects.filter(created_at__lt=before, archived_at__isnull=False)
+        if dry_run:
+            return expired.count()
+        deleted = 0
+        for ids in self.batches(expired):
+            # 已归档的日志没有外置数据, 级联删除只多一次查询
+            deleted += ModelUsageLog.objects.filter(id__in=ids).delete()[0]
+        return deleted
+
+
+def read_archive(path) -> Iterator[Dict]:
+    """逐行读取归档文件"""
+    path = Path(path)
+    if path.suffix == '.zst':
+        if zstandard is None:
+            raise ValueError('读取 zstd 归档需要安装 zstandard')
+        with open(path, 'rb') as raw:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                yield json.loads(line)
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            yield json.loads(line)
+
+
+def cutoff(days: Optional[int]) -> Optional[datetime]:
+    return None if days is None else timezone.now() - timedelta(days=days)
@@ -0,0 +1,254 @@
+"""
+模型提供商路由
+职责: 在同类型的多个激活提供商之间分配请求(负载均衡), 并临时摘除不健康的提供商
+"""
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .circuit_breaker import circuit_breaker
+from .models import ModelProvider, ModelUsageLog
+from .provider_cache import provider_cache
+
+
+class NoAvailableProviderError(Exception):
+    """没有可用的模型提供商"""
+
+
+class ProviderHealth:
+    """
+    单个提供商的健康状态
+    保存最近 window_seconds 秒内的调用结果, 失败率或平均延迟超过阈值时摘除 eject_seconds 秒
+    """
+    # 计为失败的 ModelUsageLog 状态(只统计上游调用, source='local' 的本地限流不计入)
+    FAILURE_STATUSES = ('failed', 'timeout', 'error', 'rate_limited')
+
+    def __init__(self):
+        self.samples: Deque[Tuple[float, bool, Optional[int]]] = deque()
+        self.ejected_until = 0.0
+        self.outstanding = 0
+        # 平滑加权轮询的当前权重
+        self.current_weight = 0
+
+    def prune(self, now: float, window_seconds: float) -> None:
+        """丢弃窗口外的样本"""
+        while self.samples and self.samples[0][0] < now - window_seconds:
+            self.samples.popleft()
+
+    def failure_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, failed, _ in self.samples if failed) / len(self.samples)
+
+    def avg_latency_ms(self) -> Optional[float]:
+        latencies = [latency for _, _, latency in self.samples if latency is not None]
+        if not latencies:
+            return None
+        return sum(latencies) / len(latencies)
+
+
+class ProviderRouter:
+    """
+    提供商路由器
+
+    用法:
+        with provider_router.acquire('llm') as provider:
+            ...
+        # 异步代码中:
+        async with provider_router.aacquire('llm') as provider:
+            ...
+
+    调用期间计入提供商的并发数, least_outstanding 策略据此选择; 只调用 select() 不会计入。
+
+    调用结果通过 record_result()/observe_log() 回报, usage_log_buffer 记录日志时会自动回报。
+    """
+    STRATEGY_WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+    STRATEGY_LEAST_OUTSTANDING = 'least_outstanding'
+
+    def __init__(self, strategy: str = STRATEGY_WEIGHTED_ROUND_ROBIN,
+                 window_seconds: float = 300.0, min_samples: int = 10, max_failure_rate: float = 0.5,
+                 max_avg_latency_ms: Optional[float] = None, eject_seconds: float = 30.0):
+        if strategy not in (self.STRATEGY_WEIGHTED_ROUND_ROBIN, self.STRATEGY_LEAST_OUTSTANDING):
+            raise ValueError(f'未知的路由策略: {strategy}')
+        self.strategy = strategy
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.max_failure_rate = max_failure_rate
+        self.max_avg_latency_ms = max_avg_latency_ms
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._health: Dict[str, ProviderHealth] = {}
+
+    @classmethod
+    def from_settings(cls) -> 'ProviderRouter':
+        """根据 settings.PROVIDER_ROUTER 创建路由器"""
+        config = getattr(settings, 'PROVIDER_ROUTER', {})
+        return cls(
+            strategy=config.get('STRATEGY', cls.STRATEGY_WEIGHTED_ROUND_ROBIN),
+            window_seconds=config.get('HEALTH_WINDOW_SECONDS', 300.0),
+            min_samples=config.get('HEALTH_MIN_SAMPLES', 10),
+            max_failure_rate=config.get('MAX_FAILURE_RATE', 0.5),
+            max_avg_latency_ms=config.get('MAX_AVG_LATENCY_MS'),
+            eject_seconds=config.get('EJECT_SECONDS', 30.0),
+        )
+
+    def get_providers(self, provider_type: str) -> List[ModelProvider]:
+        """获取某类型的激活提供商(按优先级倒序), 来自 provider_cache 快照"""
+        return provider_cache.get_active(provider_type)
+
+    def forget(self, provider_id) -> None:
+        """丢弃已删除提供商的健康状态"""
+        with self._lock:
+            self._health.pop(str(provider_id), None)
+
+    @staticmethod
+    def weight(provider: ModelProvider) -> int:
+        """提供商权重, 优先级越高分配越多, 优先级0的提供商权重为1"""
+        return max(provider.priority, 0) + 1
+
+    def is_healthy(self, provider_id: str, now: Optional[float] = None) -> bool:
+        """提供商当前是否未被摘除"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            health = self._health.get(str(provider_id))
+            return health is None or health.ejected_until <= now
+
+    def select(self, provider_type: str, exclude: Optional[List[str]] = None) -> ModelProvider:
+        """
+        为一次调用选择提供商
+
+        Args:
+            provider_type: llm / text2image / image2video
+            exclude: 需要跳过的提供商ID(如重试时排除刚失败的)
+
+        Returns:
+            选中的模型提供商
+
+        Raises:
+            NoAvailableProviderError: 没有激活的提供商
+        """
+        providers = self.get_providers(provider_type)
+        if exclude:
+            excluded = {str(provider_id) for provider_id in exclude}
+            providers = [provider for provider in providers if str(provider.id) not in excluded]
+        if not providers:
+            raise NoAvailableProviderError(f'没有可用的 {provider_type} 模型提供商')
+
+        now = time.monotonic()
+        with self._lock:
+            # 跳过被摘除或熔断中的提供商
+            candidates = [
+                provider for provider in providers
+                if self._get_health(provider.id).ejected_until <= now
+                and not circuit_breaker.is_open(provider.id, now)
+            ]
+            if not candidates:
+                # 全部被摘除时退回到最早恢复的那个, 而不是直接拒绝请求
+                candidates = [min(providers, key=lambda p: self._get_health(p.id).ejected_until)]
+            if self.strategy == self.STRATEGY_LEAST_OUTSTANDING:
+                return min(
+                    candidates,
+                    key=lambda p: (self._get_health(p.id).outstanding / self.weight(p), -p.priority),
+                )
+            return self._smooth_weighted_pick(candidates)
+
+    def _smooth_weighted_pick(self, candidates: List[ModelProvider]) -> ModelProvider:
+        """平滑加权轮询(调用方需持有锁)"""
+        total_weight = 0
+        best = None
+        best_health = None
+        for provider in candidates:
+            health = self._get_health(provider.id)
+            weight = self.weight(provider)
+            health.current_weight += weight
+            total_weight += weight
+            if best_health is None or health.current_weight > best_health.current_weight:
+                best, best_health = provider, health
+        best_health.current_weight -= total_weight
+        return best
+
+    @contextmanager
+    def acquire(self, provider_type: str, exclude: Optional[List[str]] = None):
+        """选择提供商并在调用期间计入并发数(供 least_outstanding 策略使用)"""
+        provider = self.select(provider_type, exclude=exclude)
+        with self.track(provider.id):
+            yield provider
+
+    @asynccontextmanager
+    async def aacquire(self, provider_type: str, exclude: Optional[List[str]] = None):
+        """acquire 的异步版本, 选择提供商(可能读取数据库)在线程池中执行"""
+        provider = await sync_to_async(self.select)(provider_type, exclude=exclude)
+        with self.track(provider.id):
+            yield provider
+
+    @contextmanager
+    def track(self, provider_id):
+        """
+        把一次调用计入提供商的并发数
+        提供商在别处选定、稍后才调用时使用(如生成任务提交时选择提供商, 由 worker 执行)
+        """
+        with self._lock:
+            self._get_health(provider_id).outstanding += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                health = self._get_health(provider_id)
+                health.outstanding = max(health.outstanding - 1, 0)
+
+    def outstanding(self, provider_id) -> int:
+        """提供商当前的并发调用数"""
+        with self._lock:
+            health = self._health.get(str(provider_id))
+            return health.outstanding if health else 0
+
+    def record_result(self, provider_id, status: str, latency_ms: Optional[int] = None) -> None:
+        """
+        回报一次调用结果, 用于健康判断
+
+        Args:
+            provider_id: 提供商ID
+            status: ModelUsageLog.STATUS_CHOICES 中的状态
+            latency_ms: 调用延迟
+        """
+        now = time.monotonic()
+        with self._lock:
+            health = self._get_health(provider_id)
+            health.samples.append((now, status in ProviderHealth.FAILURE_STATUSES, latency_ms))
+            health.prune(now, self.window_seconds)
+            if health.ejected_until > now or len(health.samples) < self.min_samples:
+                return
+            avg_latency = health.avg_latency_ms()
+            too_slow = (
+                self.max_avg_latency_ms is not None
+                and avg_latency is not None
+                and avg_latency > self.max_avg_latency_ms
+            )
+            if health.failure_rate() > self.max_failure_rate or too_slow:
+                health.ejected_until = now + self.eject_seconds
+                # 恢复后重新积累样本, 避免旧样本导致反复摘除
+                health.samples.clear()
+
+    def observe_log(self, log) -> None:
+        """
+        从一条 ModelUsageLog 回报调用结果
+        只统计真实发往上游的调用: 缓存命中、合并请求、复用产出、本地拒绝(本地限流/预算/熔断)
+        和本地无法处理的输出(RESPONSE_STATUSES)不代表提供商的健康状况
+        """
+        if log.source != 'upstream' or log.status in ModelUsageLog.LOCAL_STATUSES \
+                or log.status in ModelUsageLog.RESPONSE_STATUSES:
+            return
+        self.record_result(log.model_provider_id, log.status, log.latency_ms)
+
+    def _get_health(self, provider_id) -> ProviderHealth:
+        """获取提供商健康状态(调用方需持有锁)"""
+        return self._health.setdefault(str(provider_id), ProviderHealth())
+
+
+# 进程级共享的路由器
+provider_router = ProviderRouter.from_settings()
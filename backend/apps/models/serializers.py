@@ -2,7 +2,25 @@
 模型管理序列化器
 """
 from rest_framework import serializers
-from .models import ModelProvider,ModelUsageLog
+from .models import ModelProvider,ModelUsageLog,GenerationJob,UsageBudget
+from .budgets import PRICING_KEYS
+from .provider_cache import provider_cache
+from .services import ModelProviderStatsService
+
+def validate_pricing(extra_config):
+    """校验 extra_config['pricing']: 只允许已知的计价项, 价格为非负数"""
+    pricing = (extra_config or {}).get('pricing')
+    if pricing is None:
+        return extra_config
+    if not isinstance(pricing, dict):
+        raise serializers.ValidationError("pricing必须是JSON对象")
+    unknown = set(pricing) - set(PRICING_KEYS)
+    if unknown:
+        raise serializers.ValidationError(f"未知的计价项: {', '.join(sorted(unknown))}")
+    for key, value in pricing.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise serializers.ValidationError(f"{key} 必须是非负数")
+    return extra_config
 
 class ModelProviderListSerializer(serializers.ModelSerializer):
     provider_type_display=serializers.CharField(
@@ -13,9 +31,9 @@ class ModelProviderListSerializer(serializers.ModelSerializer):
 # 规则只有一条：
 # 字段名 = xxx
 # 方法名 = get_xxx(self, obj)
-    #统计信息
-    total_usage_count=serializers.SerializerMethodField()
-    recent_usage_count=serializers.SerializerMethodField()
+    #统计信息 (由 ModelProviderViewSet.get_queryset 注解, 不再逐条查询)
+    total_usage_count=serializers.IntegerField(read_only=True)
+    recent_usage_count=serializers.IntegerField(read_only=True)
 
     class Meta:
         model=ModelProvider
@@ -26,16 +44,6 @@ class ModelProviderListSerializer(serializers.ModelSerializer):
             'created_at', 'updated_at'   
         ]
         read_only_fields=['id','created_at','updated_at']
-    def get_total_usage_count(self,obj):
-        """获取总使用次数"""
-        return obj.usage_logs.count()
-    
-    def get_recent_usage_count(self,obj):
-        """获取最近7天使用次数"""
-        from django.utils import timezone
-        from datetime import timedelta
-        seven_day_age=timezone.now()-timedelta(days=7)
-        return obj.usage_logs.filter(created_at__gte=seven_day_age).count()
     
 class ModelProviderDetailSerializer(serializers.ModelSerializer):
     print("进入ModelProviderDetailSerializer")
@@ -45,13 +53,18 @@ class ModelProviderDetailSerializer(serializers.ModelSerializer):
         read_only=True
     )
 
-    #统计信息
+    #统计信息 (由 ModelProviderStatsService 一次聚合得到)
     total_usage_count=serializers.SerializerMethodField()
     success_count=serializers.SerializerMethodField()
     failed_count=serializers.SerializerMethodField()
     success_rate=serializers.SerializerMethodField()
     avg_latency_ms=serializers.SerializerMethodField()
     total_tokens_used=serializers.SerializerMethodField()
+    p50_latency_ms=serializers.SerializerMethodField()
+    p95_latency_ms=serializers.SerializerMethodField()
+    p99_latency_ms=serializers.SerializerMethodField()
+    cache_hit_count=serializers.SerializerMethodField()
+    coalesced_count=serializers.SerializerMethodField()
 
     class Meta:
         model=ModelProvider
@@ -69,6 +82,8 @@ class ModelProviderDetailSerializer(serializers.ModelSerializer):
             # 统计信息
             'total_usage_count', 'success_count', 'failed_count',
             'success_rate', 'avg_latency_ms', 'total_tokens_used',
+            'p50_latency_ms', 'p95_latency_ms', 'p99_latency_ms',
+            'cache_hit_count', 'coalesced_count',
             'created_at', 'updated_at'  
         ]
         read_only_fields=['id','created_at','updated_at']
@@ -83,33 +98,52 @@ class ModelProviderDetailSerializer(serializers.ModelSerializer):
         # if api_key:
         #     data['api_key'] = f"{api_key[:4]}****{api_key[-4:]}"
         return data
+    def get_stats(self,obj):
+        """
+        获取统计信息, 每个实例只聚合一次
+        调用方可以通过 context['stats'] 直接传入(如刚创建的提供商没有任何日志)
+        """
+        if 'stats' in self.context:
+            return self.context['stats']
+        if not hasattr(self,'_stats_cache'):
+            self._stats_cache={}
+        if obj.pk not in self._stats_cache:
+            self._stats_cache[obj.pk]=ModelProviderStatsService.get_provider_stats(obj)
+        return self._stats_cache[obj.pk]
     def get_total_usage_count(self,obj):
         """获取总使用次数"""
-        return obj.usage_logs.count()
+        return self.get_stats(obj)['total_usage_count']
     def get_success_count(self,obj):
         """获取成功调用次数"""
-        return obj.usage_logs.filter(status = 'success').count()
+        return self.get_stats(obj)['success_count']
 # 这是拿到数据库的数据进行计算，给前端展示的
     def get_failed_count(self,obj):
         """获取失败调用次数"""
-        return obj.usage_logs.filter(status = 'failed').count()
+        return self.get_stats(obj)['failed_count']
     def get_success_rate(self,obj):
         """获取成功率"""
-        total=obj.usage_logs.count()
-        if total==0:
-            return 0.0
-        success=obj.usage_logs.filter(status = 'success').count()
-        return round((success/total)*100,2)
+        return self.get_stats(obj)['success_rate']
     def get_avg_latency_ms(self, obj):
         """获取平均延迟"""
-        from django.db.models import Avg
-        result = obj.usage_logs.aggregate(avg_latency=Avg('latency_ms'))
-        return 
+        return self.get_stats(obj)['avg_latency_ms']
     def get_total_tokens_used(self,obj):
         """获取总使用的令牌数"""
-        from django.db.models import Sum
-        result = obj.usage_logs.aggregate(total_tokens=Sum('tokens_used'))
-        return result['total_tokens'] or 0
+        return self.get_stats(obj)['total_tokens_used']
+    def get_p50_latency_ms(self,obj):
+        """获取p50延迟"""
+        return self.get_stats(obj)['p50_latency_ms']
+    def get_p95_latency_ms(self,obj):
+        """获取p95延迟"""
+        return self.get_stats(obj)['p95_latency_ms']
+    def get_p99_latency_ms(self,obj):
+        """获取p99延迟"""
+        return self.get_stats(obj)['p99_latency_ms']
+    def get_cache_hit_count(self,obj):
+        """获取响应缓存命中次数"""
+        return self.get_stats(obj)['cache_hit_count']
+    def get_coalesced_count(self,obj):
+        """获取合并到在途请求的调用次数"""
+        return self.get_stats(obj)['coalesced_count']
 
 # 创建的时候需要对字段进行校验
 class ModelProviderCreateSerializer(serializers.ModelSerializer):
@@ -169,6 +203,9 @@ class ModelProviderCreateSerializer(serializers.ModelSerializer):
         if value < 0:
             raise serializers.ValidationError("优先级必须是非负整数")
         return value
+    def validate_extra_config(self, value):
+        """验证价格配置"""
+        return validate_pricing(value)
     def validate(self, attrs):
         """交叉验证"""
         provider_type = attrs.get('provider_type', None)
@@ -244,6 +281,9 @@ class ModelProviderUpdateSerializer(serializers.ModelSerializer):
         if value < 0:
             raise serializers.ValidationError("优先级必须是非负整数")
         return value
+    def validate_extra_config(self, value):
+        """验证价格配置"""
+        return validate_pricing(value)
 
 
 
@@ -255,7 +295,19 @@ class ModelProviderSimpleSerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
         read_only_fields = ['id', 'name']
 class ModelUsageLogSerializer(serializers.ModelSerializer):
-    """模型使用日志序列化器"""
+    """
+    模型使用日志序列化器
+    支持传入 fields 参数只输出部分字段, 如列表页跳过 request_data/response_data
+    """
+    # 体积较大的JSON字段, 未被请求时查询集可以 defer 掉
+    HEAVY_FIELDS = ('request_data', 'response_data')
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
 
     model_provider_name = serializers.CharField(
         source='model_provider.name',
@@ -271,11 +323,11 @@ class ModelUsageLogSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'model_provider', 'model_provider_name', 'model_provider_type',
             'request_data', 'response_data',
-            'tokens_used', 'latency_ms', 'status', 'error_message',
-            'project_id', 'stage_type',
-            'created_at'
+            'tokens_used', 'latency_ms', 'status', 'source', 'error_message', 'cost',
+            'project_id', 'stage_type', 'user_id', 'payload_offloaded',
+            'created_at', 'archived_at'
         ]
-        read_only_fields = ['id', 'created_at']
+        read_only_fields = ['id', 'payload_offloaded', 'created_at', 'archived_at']
 
 class ModelProviderTestSerializer(serializers.Serializer):
     """模型提供商测试连接序列化器"""
@@ -289,11 +341,169 @@ class ModelProviderTestSerializer(serializers.Serializer):
         provider_id=self.context.get('provider_id')
         if not provider_id:
             raise serializers.ValidationError("缺少模型提供商ID")
-        try:
-            provider=ModelProvider.objects.get(id=provider_id)
-        except ModelProvider.DoesNotExist:
+        provider=provider_cache.get(provider_id)
+        if provider is None:
             raise serializers.ValidationError("模型提供商不存在")
         if not provider.is_active:
             raise serializers.ValidationError("模型提供商未激活")
         attrs['provider']=provider
-        return attrs
\ No newline at end of file
+        return attrs
+
+class BatchGenerateSerializer(serializers.Serializer):
+    """批量文本生成序列化器"""
+    prompts = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        help_text="提示语列表, 结果按相同顺序返回"
+    )
+    system_prompt = serializers.CharField(required=False, allow_blank=True, default='')
+    project_id = serializers.UUIDField(required=False, allow_null=True)
+    stage_type = serializers.CharField(required=False, allow_null=True, max_length=50)
+    concurrency = serializers.IntegerField(required=False, min_value=1, max_value=32)
+    pack_size = serializers.IntegerField(required=False, min_value=1, help_text="每次上游调用打包的提示语数")
+    use_cache = serializers.BooleanField(required=False, default=True)
+    max_tokens = serializers.IntegerField(required=False, min_value=1, help_text="单条提示语的最大输出Token数")
+    temperature = serializers.FloatField(required=False, min_value=0, max_value=2)
+
+    def validate_prompts(self, value):
+        from .generation import get_batch_settings
+
+        max_items = get_batch_settings()['MAX_ITEMS']
+        if len(value) > max_items:
+            raise serializers.ValidationError(f"一次最多提交 {max_items} 条提示语")
+        return value
+
+    def validate_pack_size(self, value):
+        from .generation import get_batch_settings
+
+        max_pack_size = get_batch_settings()['MAX_PACK_SIZE']
+        if value > max_pack_size:
+            raise serializers.ValidationError(f"打包条数不能超过 {max_pack_size}")
+        return value
+
+
+class GenerationJobSerializer(serializers.ModelSerializer):
+    """生成任务序列化器"""
+    model_provider_name = serializers.CharField(
+        source='model_provider.name',
+        read_only=True
+    )
+    status_display = serializers.CharField(
+        source='get_status_display',
+        read_only=True
+    )
+
+    class Meta:
+        model = GenerationJob
+        fields = [
+            'id', 'model_provider', 'model_provider_name', 'job_type',
+            'status', 'status_display', 'payload', 'result', 'error_message', 'progress',
+            'attempts', 'max_attempts', 'run_after', 'cancel_requested',
+            'project_id', 'stage_type', 'user_id',
+            'created_at', 'updated_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+
+
+class GenerationJobCreateSerializer(serializers.Serializer):
+    """
+    生成任务提交序列化器
+    未指定 model_provider 时按 job_type 由路由器选择提供商
+    """
+    model_provider = serializers.PrimaryKeyRelatedField(
+        queryset=ModelProvider.objects.all(),
+        required=False,
+        help_text="模型提供商ID"
+    )
+    job_type = serializers.ChoiceField(
+        choices=ModelProvider.PROVIDER_TYPES,
+        required=False,
+        help_text="任务类型, 未指定提供商时必填"
+    )
+    payload = serializers.JSONField(help_text="任务参数, LLM任务需包含prompt")
+    project_id = serializers.UUIDField(required=False, allow_null=True)
+    stage_type = serializers.CharField(required=False, allow_null=True, max_length=50)
+    max_attempts = serializers.IntegerField(required=False, min_value=1, max_value=10)
+
+    def validate_payload(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("任务参数必须是JSON对象")
+        return value
+
+    def validate(self, attrs):
+        """校验提供商与任务类型"""
+        from .router import NoAvailableProviderError, provider_router
+
+        provider = attrs.get('model_provider')
+        job_type = attrs.get('job_type')
+        if provider is None:
+            if not job_type:
+                raise serializers.ValidationError({'job_type': "未指定模型提供商时必须指定任务类型"})
+            try:
+                # 提交时只选择提供商, 任务执行期间由 worker 计入其并发数(provider_router.track)
+                attrs['model_provider'] = provider_router.select(job_type)
+            except NoAvailableProviderError as exc:
+                raise serializers.ValidationError({'model_provider': str(exc)})
+        else:
+            if not provider.is_active:
+                raise serializers.ValidationError({'model_provider': "模型提供商未激活"})
+            if job_type and job_type != provider.provider_type:
+                raise serializers.ValidationError({'job_type': "任务类型与模型提供商类型不一致"})
+        if attrs['model_provider'].provider_type == 'llm':
+            attrs['payload'] = self.validate_llm_payload(attrs['payload'])
+        return attrs
+
+    @staticmethod
+    def validate_llm_payload(payload):
+        """LLM任务只接受 prompt/system_prompt 和 GenerationJob.LLM_OVERRIDE_KEYS 中的覆盖参数"""
+        unknown = sorted(set(payload) - set(GenerationJob.LLM_PAYLOAD_KEYS))
+        if unknown:
+            raise serializers.ValidationError({'payload': f"LLM任务不支持的参数: {', '.join(unknown)}"})
+        if not isinstance(payload.get('prompt'), str) or not payload['prompt']:
+            raise serializers.ValidationError({'payload': "LLM任务必须包含prompt"})
+        if payload.get('system_prompt') is not None and not isinstance(payload['system_prompt'], str):
+            raise serializers.ValidationError({'payload': "system_prompt必须是字符串"})
+        for key in GenerationJob.LLM_OVERRIDE_KEYS:
+            value = payload.get(key)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise serializers.ValidationError({'payload': f"{key}必须是数字"})
+        return payload
+
+
+class UsageBudgetSerializer(serializers.ModelSerializer):
+    """
+    使用预算序列化器
+    用量计数由调用日志累加, 只允许修改额度上限
+    """
+    scope_display = serializers.CharField(source='get_scope_display', read_only=True)
+    remaining_tokens = serializers.SerializerMethodField()
+    remaining_cost = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UsageBudget
+        fields = [
+            'id', 'scope', 'scope_display', 'scope_id', 'token_limit', 'cost_limit',
+            'request_count', 'tokens_used', 'cost_used', 'reserved_tokens', 'reserved_cost',
+            'remaining_tokens', 'remaining_cost', 'created_at', 'updated_at'
+        ]
+        read_only_fields = [
+            'id', 'request_count', 'tokens_used', 'cost_used', 'reserved_tokens', 'reserved_cost',
+            'created_at', 'updated_at'
+        ]
+
+    def get_remaining_tokens(self, obj):
+        if obj.token_limit is None:
+            return None
+        return max(obj.token_limit - obj.tokens_used - obj.reserved_tokens, 0)
+
+    def get_remaining_cost(self, obj):
+        if obj.cost_limit is None:
+            return None
+        return str(max(obj.cost_limit - obj.cost_used - obj.reserved_cost, 0))
+
+    def validate(self, attrs):
+        if self.instance is not None and ('scope' in attrs or 'scope_id' in attrs):
+            if attrs.get('scope', self.instance.scope) != self.instance.scope or \
+                    str(attrs.get('scope_id', self.instance.scope_id)) != self.instance.scope_id:
+                raise serializers.ValidationError("不能修改预算的范围")
+        return attrs
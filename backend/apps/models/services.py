@@ -1,6 +1,13 @@
-from .models import ModelProvider
+from .models import ModelProvider, ModelUsageLog, ModelUsageRollup
+from asgiref.sync import sync_to_async
+from bisect import bisect_left
+import time
+from datetime import timedelta
 from typing import Dict, Any, Optional, List
 from django.db import transaction
+from django.db.models import Count, F, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDay, TruncHour
+from django.utils import timezone
 class ModelProviderService:
     """
     模型提供商服务
@@ -21,3 +28,382 @@ class ModelProviderService:
         print("Creating model provider with data:", data)
         provider = ModelProvider.objects.create(**data)
         return provider
+
+    @staticmethod
+    async def test_provider_connection(provider_id: str, test_prompt: str) -> Dict[str, Any]:
+        """
+        测试模型提供商连接: 用提供商的执行器发送一次测试请求并记录使用日志
+
+        Args:
+            provider_id: 提供商ID
+            test_prompt: 测试提示语
+
+        Returns:
+            {'success', 'latency_ms', 'response', 'data'} 或 {'success': False, 'error', 'latency_ms'}
+        """
+        from core.ai_client.base import AIClientError
+        from core.ai_client.registry import ExecutorImportError, executor_registry
+        from .usage_buffer import usage_log_buffer
+
+        from .provider_cache import provider_cache
+
+        provider = await provider_cache.aget(provider_id)
+        if provider is None:
+            raise ModelProvider.DoesNotExist(provider_id)
+        try:
+            client = executor_registry.get_client(provider)
+        except ExecutorImportError as exc:
+            return {'success': False, 'error': str(exc), 'latency_ms': 0}
+        if not hasattr(client, 'generate'):
+            return {'success': False, 'error': f'{type(client).__name__} 不支持文本测试', 'latency_ms': 0}
+
+        request_data = {'prompt': test_prompt}
+        started = time.monotonic()
+        try:
+            with executor_registry.lease(provider) as client:
+                result = await client.generate(test_prompt)
+        except AIClientError as exc:
+            latency_ms = int((time.monotonic() - started) * 1000)
+            await sync_to_async(usage_log_buffer.record)(
+                model_provider=provider, request_data=request_data, latency_ms=latency_ms, status=exc.status,
+                error_message=str(exc), stage_type='connection_test',
+            )
+            return {'success': False, 'error': str(exc), 'latency_ms': latency_ms}
+
+        await sync_to_async(usage_log_buffer.record)(
+            model_provider=provider, request_data=request_data, response_data=result['response'],
+            tokens_used=result['tokens_used'], latency_ms=result['latency_ms'], status='success',
+            stage_type='connection_test',
+        )
+        return {
+            'success': True,
+            'latency_ms': result['latency_ms'],
+            'response': result['content'],
+            'data': {'tokens_used': result['tokens_used'], 'model': provider.model_name},
+        }
+
+
+class ModelProviderStatsService:
+    """
+    模型提供商统计服务
+    职责: 在一次查询中根据使用汇总表计算提供商的调用统计
+    """
+    PERCENTILES = (50, 95, 99)
+
+    @staticmethod
+    def empty_stats() -> Dict[str, Any]:
+        """没有任何调用记录时的统计结果"""
+        stats = {
+            'total_usage_count': 0,
+            'success_count': 0,
+            'failed_count': 0,
+            'success_rate': 0.0,
+            'avg_latency_ms': None,
+            'total_tokens_used': 0,
+            'cache_hit_count': 0,
+            'coalesced_count': 0,
+        }
+        for p in ModelProviderStatsService.PERCENTILES:
+            stats[f'p{p}_latency_ms'] = None
+        return stats
+
+    @staticmethod
+    def latency_histogram_aggregates(field: str = 'latency_ms') -> Dict[str, Any]:
+        """生成延迟直方图的条件计数表达式, 每个分桶一个COUNT"""
+        aggregates = {}
+        lower = None
+        for index, upper in enumerate(ModelUsageLog.LATENCY_BUCKETS_MS):
+            condition = Q(**{f'{field}__lte': upper})
+            if lower is not None:
+                condition &= Q(**{f'{field}__gt': lower})
+            aggregates[f'latency_bucket_{index}'] = Count('id', filter=condition)
+            lower = upper
+        aggregates[f'latency_bucket_{len(ModelUsageLog.LATENCY_BUCKETS_MS)}'] = Count(
+            'id', filter=Q(**{f'{field}__gt': lower})
+        )
+        return aggregates
+
+    @staticmethod
+    def estimate_percentile(histogram: List[int], percentile: float) -> Optional[float]:
+        """
+        根据延迟直方图估算百分位延迟(桶内线性插值)
+
+        Args:
+            histogram: 与 LATENCY_BUCKETS_MS 对应的各分桶计数(最后一个为溢出桶)
+            percentile: 百分位, 如 95
+
+        Returns:
+            估算的延迟毫秒数, 没有数据时返回 None
+        """
+        total = sum(histogram)
+        if total == 0:
+            return None
+        bounds = ModelUsageLog.LATENCY_BUCKETS_MS
+        rank = total * percentile / 100
+        cumulative = 0
+        for index, count in enumerate(histogram):
+            if count and cumulative + count >= rank:
+                if index >= len(bounds):
+                    # 溢出桶没有上界, 只能返回最大上界
+                    return float(bounds[-1])
+                lower = bounds[index - 1] if index > 0 else 0
+                fraction = (rank - cumulative) / count
+                return round(lower + (bounds[index] - lower) * fraction, 2)
+            cumulative += count
+        return float(bounds[-1])
+
+    @staticmethod
+    def build_stats(total: int, success: int, failed: int, avg_latency: Optional[float],
+                    total_tokens: Optional[int], histogram: List[int], cache_hits: int = 0,
+                    coalesced: int = 0) -> Dict[str, Any]:
+        """把聚合结果整理成接口返回的统计字段"""
+        stats = {
+            'total_usage_count': total,
+            'success_count': success,
+            'failed_count': failed,
+            'success_rate': round(success / total * 100, 2) if total else 0.0,
+            'avg_latency_ms': round(avg_latency, 2) if avg_latency is not None else None,
+            'total_tokens_used': total_tokens or 0,
+            'cache_hit_count': cache_hits,
+            'coalesced_count': coalesced,
+        }
+        for p in ModelProviderStatsService.PERCENTILES:
+            stats[f'p{p}_latency_ms'] = ModelProviderStatsService.estimate_percentile(histogram, p)
+        return stats
+
+    @staticmethod
+    def get_provider_stats(provider: ModelProvider) -> Dict[str, Any]:
+        """
+        获取单个提供商的调用统计(读取天级汇总表, 不扫描原始日志)
+        调用统计只计真实发往上游的调用, 除 success 以外的状态(失败、超时、上游限流、输出无法拆分等)都计为失败;
+        缓存命中和合并请求单独计数, 复用产出和本地拒绝不计入
+
+        Args:
+            provider: 模型提供商实例
+
+        Returns:
+            总数/成功/失败/成功率/平均延迟/Token总数/p50/p95/p99 延迟
+        """
+        upstream = Q(source='upstream') & ~Q(status__in=ModelUsageLog.LOCAL_STATUSES)
+
+        def total(field: str, condition: Q) -> Coalesce:
+            return Coalesce(Sum(field, filter=condition), 0)
+
+        row = ModelUsageRollup.objects.filter(model_provider=provider, granularity='day').aggregate(
+            total=total('request_count', upstream),
+            success=total('request_count', upstream & Q(status='success')),
+            failed=total('request_count', upstream & ~Q(status='success')),
+            tokens=total('tokens_used', upstream),
+            latency_sum=total('latency_sum_ms', upstream),
+            latency_count=total('latency_count', upstream),
+            cache_hits=total('request_count', Q(source='cache')),
+            coalesced=total('request_count', Q(source='coalesced')),
+            **{field: total(field, upstream) for field in ModelUsageRollup.LATENCY_BUCKET_FIELDS},
+        )
+        histogram = [row[field] for field in ModelUsageRollup.LATENCY_BUCKET_FIELDS]
+        avg_latency = row['latency_sum'] / row['latency_count'] if row['latency_count'] else None
+        return ModelProviderStatsService.build_stats(
+            row['total'], row['success'], row['failed'], avg_latency, row['tokens'], histogram,
+            row['cache_hits'], row['coalesced'],
+        )
+
+
+class ModelUsageRollupService:
+    """
+    模型使用汇总服务
+    职责: 把使用日志增量累加到小时/天汇总表, 以及从原始日志重建、压缩汇总表
+
+    汇总行的唯一性不由数据库约束保证(project_id/stage_type 可为空),
+    读取方总是对匹配的行求和, 因此并发写入产生的重复行不影响结果,
+    可通过 rebuild_usage_rollups --compact 合并。
+    """
+    GRANULARITIES = ('hour', 'day')
+
+    @staticmethod
+    def truncate(value, granularity: str):
+        """把时间截断到所在时间桶的起点(按当前时区)"""
+        value = timezone.localtime(value)
+        if granularity == 'hour':
+            return value.replace(minute=0, second=0, microsecond=0)
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def latency_bucket_index(latency_ms: int) -> int:
+        """获取延迟所在的直方图分桶下标"""
+        return bisect_left(ModelUsageLog.LATENCY_BUCKETS_MS, latency_ms)
+
+    @staticmethod
+    def empty_histogram() -> List[int]:
+        """空的延迟直方图"""
+        return [0] * len(ModelUsageRollup.LATENCY_BUCKET_FIELDS)
+
+    @staticmethod
+    def apply_logs(logs) -> None:
+        """
+        把一批使用日志增量累加到汇总表
+
+        Args:
+            logs: ModelUsageLog 实例列表(需已设置 created_at)
+        """
+        grouped: Dict[tuple, Dict[str, Any]] = {}
+        for log in logs:
+            for granularity in ModelUsageRollupService.GRANULARITIES:
+                key = (
+                    log.model_provider_id, log.project_id, log.stage_type,
+                    granularity, ModelUsageRollupService.truncate(log.created_at, granularity),
+                    log.status, log.source,
+                )
+                delta = grouped.setdefault(key, {
+                    'request_count': 0, 'tokens_used': 0, 'latency_sum_ms': 0,
+                    'latency_count': 0, 'latency_histogram': ModelUsageRollupService.empty_histogram(),
+                })
+                delta['request_count'] += 1
+                delta['tokens_used'] += log.tokens_used or 0
+                if log.latency_ms is not None:
+                    delta['latency_sum_ms'] += log.latency_ms
+                    delta['latency_count'] += 1
+                    delta['latency_histogram'][ModelUsageRollupService.latency_bucket_index(log.latency_ms)] += 1
+
+        with transaction.atomic():
+            for (provider_id, project_id, stage_type, granularity, bucket, status, source), delta in grouped.items():
+                histogram = dict(zip(ModelUsageRollup.LATENCY_BUCKET_FIELDS, delta.pop('latency_histogram')))
+                rows = ModelUsageRollup.objects.filter(
+                    model_provider_id=provider_id, project_id=project_id, stage_type=stage_type,
+                    granularity=granularity, bucket=bucket, status=status, source=source,
+                )
+                # 单条 UPDATE 语句累加到匹配的第一行: 所有计数(包括各延迟分桶)都用 F() 在数据库中累加,
+                # 不先读后写, 并发落库不会丢失增量(SQLite 上也不会因读锁升级为写锁而死锁)
+                updated = ModelUsageRollup.objects.filter(
+                    pk=Subquery(rows.order_by('pk').values('pk')[:1])
+                ).update(
+                    **{field: F(field) + value for field, value in delta.items()},
+                    **{field: F(field) + value for field, value in histogram.items() if value},
+                    updated_at=timezone.now(),
+                )
+                if not updated:
+                    ModelUsageRollup.objects.create(
+                        model_provider_id=provider_id, project_id=project_id, stage_type=stage_type,
+                        granularity=granularity, bucket=bucket, status=status, source=source,
+                        **delta, **histogram,
+                    )
+
+    @staticmethod
+    def next_bucket(bucket, granularity: str):
+        """下一个时间桶的起点(跨夏令时切换的一天可能是23或25小时)"""
+        step = timedelta(hours=1) if granularity == 'hour' else timedelta(hours=26)
+        return ModelUsageRollupService.truncate(bucket + step, granularity)
+
+    @staticmethod
+    def retained_since(granularity: str):
+        """
+        原始日志仍完整保留的第一个时间桶
+
+        archive_usage_logs 删除日志行后, 更早的统计只存在于汇总表中;
+        最早一条日志所在的时间桶也可能只剩一部分, 因此从它的下一个时间桶开始。
+
+        Returns:
+            时间桶起点; 没有日志被归档过(也就不可能被删除)时返回 None
+        """
+        oldest = ModelUsageLog.objects.order_by('created_at').values_list('created_at', flat=True).first()
+        rollups = ModelUsageRollup.objects.filter(granularity=granularity)
+        if oldest is None:
+            # 日志已全部删除: 没有可以重建的时间桶
+            return ModelUsageRollupService.next_bucket(timezone.now(), granularity) if rollups.exists() else None
+        first_bucket = ModelUsageRollupService.truncate(oldest, granularity)
+        if (not ModelUsageLog.objects.filter(archived_at__isnull=False).exists()
+                and not rollups.filter(bucket__lt=first_bucket).exists()):
+            return None
+        return ModelUsageRollupService.next_bucket(first_bucket, granularity)
+
+    @staticmethod
+    @transaction.atomic
+    def rebuild(granularity: str, since=None) -> int:
+        """
+        从原始日志重建汇总表(删除时间范围内的旧汇总后按 GROUP BY 重新聚合)
+
+        只重建原始日志完整保留的时间桶(见 retained_since), 已删除日志的历史汇总不受影响
+
+        Args:
+            granularity: 'hour' 或 'day'
+            since: 只重建该时间之后的时间桶, 为空时重建整个保留期
+
+        Returns:
+            写入的汇总行数
+        """
+        trunc = TruncHour if granularity == 'hour' else TruncDay
+        logs = ModelUsageLog.objects.all()
+        rollups = ModelUsageRollup.objects.filter(granularity=granularity)
+        if since is not None:
+            since = ModelUsageRollupService.truncate(since, granularity)
+        retained = ModelUsageRollupService.retained_since(granularity)
+        if retained is not None:
+            since = retained if since is None else max(since, retained)
+        if since is not None:
+            logs = logs.filter(created_at__gte=since)
+            rollups = rollups.filter(bucket__gte=since)
+        rollups.delete()
+
+        rows = (
+            logs.order_by()
+            .annotate(bucket=trunc('created_at'))
+            .values('model_provider_id', 'project_id', 'stage_type', 'bucket', 'status', 'source')
+            .annotate(
+                request_count=Count('id'),
+                tokens_used=Sum('tokens_used'),
+                latency_sum_ms=Sum('latency_ms'),
+                latency_count=Count('latency_ms'),
+                **ModelProviderStatsService.latency_histogram_aggregates(),
+            )
+        )
+        created = ModelUsageRollup.objects.bulk_create([
+            ModelUsageRollup(
+                model_provider_id=row['model_provider_id'],
+                project_id=row['project_id'],
+                stage_type=row['stage_type'],
+                granularity=granularity,
+                bucket=row['bucket'],
+                status=row['status'],
+                source=row['source'],
+                request_count=row['request_count'],
+                tokens_used=row['tokens_used'] or 0,
+                latency_sum_ms=row['latency_sum_ms'] or 0,
+                latency_count=row['latency_count'],
+                **{field: row[field] for field in ModelUsageRollup.LATENCY_BUCKET_FIELDS},
+            )
+            for row in rows.iterator()
+        ], batch_size=500)
+        return len(created)
+
+    @staticmethod
+    @transaction.atomic
+    def compact(granularity: str, since=None) -> int:
+        """
+        合并同一维度下的重复汇总行(不读取原始日志)
+
+        Returns:
+            被合并掉的行数
+        """
+        rollups = ModelUsageRollup.objects.filter(granularity=granularity)
+        if since is not None:
+            rollups = rollups.filter(bucket__gte=ModelUsageRollupService.truncate(since, granularity))
+        merged: Dict[tuple, ModelUsageRollup] = {}
+        dirty = set()
+        duplicates = []
+        for row in rollups.order_by('id').iterator():
+            key = (row.model_provider_id, row.project_id, row.stage_type, row.bucket, row.status, row.source)
+            keeper = merged.get(key)
+            if keeper is None:
+                merged[key] = row
+                continue
+            keeper.request_count += row.request_count
+            keeper.tokens_used += row.tokens_used
+            keeper.latency_sum_ms += row.latency_sum_ms
+            keeper.latency_count += row.latency_count
+            for field in ModelUsageRollup.LATENCY_BUCKET_FIELDS:
+                setattr(keeper, field, getattr(keeper, field) + getattr(row, field))
+            dirty.add(key)
+            duplicates.append(row.pk)
+        for key in dirty:
+            merged[key].save()
+        ModelUsageRollup.objects.filter(pk__in=duplicates).delete()
+        return len(duplicates)
@@ -0,0 +1,35 @@
+"""模型管理信号处理"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.ai_client.registry import executor_registry
+
+from .budgets import budget_ledger
+from .circuit_breaker import circuit_breaker
+from .models import ModelProvider, ModelUsageLog
+from .provider_cache import provider_cache
+from .router import provider_router
+from .services import ModelUsageRollupService
+
+
+@receiver(post_save, sender=ModelUsageLog)
+def update_usage_rollups(sender, instance, created, **kwargs):
+    """新写入的使用日志增量累加到汇总表和预算账本"""
+    if created:
+        ModelUsageRollupService.apply_logs([instance])
+        budget_ledger.apply_logs([instance])
+
+
+@receiver(post_save, sender=ModelProvider)
+def invalidate_provider_cache_on_save(sender, instance, **kwargs):
+    """提供商配置变更后使所有进程的快照失效"""
+    provider_cache.bump_version()
+    executor_registry.invalidate(instance.id)
+
+
+@receiver(post_delete, sender=ModelProvider)
+def invalidate_provider_cache_on_delete(sender, instance, **kwargs):
+    provider_cache.bump_version()
+    executor_registry.invalidate(instance.id)
+    provider_router.forget(instance.id)
+    circuit_breaker.reset(instance.id)
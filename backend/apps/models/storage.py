@@ -0,0 +1,225 @@
+"""
+内容寻址的媒体文件存储
+文件按 sha256 保存在 STORAGE_ROOT/blobs/ab/cd/<sha256>, 相同内容只落盘一次
+元数据(大小、MIME类型、来源提供商、项目)记录在 MediaBlob 表中, 查询不需要扫描文件系统
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple, Union
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import MediaBlob
+
+CHUNK_SIZE = 1024 * 1024
+# 访问签名的 salt, 与其他用途的 SECRET_KEY 签名隔离
+SIGNATURE_SALT = 'apps.models.storage.blob'
+
+# 文件头 -> MIME类型, 文件名无法判断类型时使用
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+]
+
+
+def sniff_mime_type(head: bytes, filename: Optional[str] = None) -> str:
+    """根据文件名或文件头推断MIME类型"""
+    if filename:
+        mime_type, _ = mimetypes.guess_type(filename)
+        if mime_type:
+            return mime_type
+    for magic, mime_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+    return 'application/octet-stream'
+
+
+class BlobStore:
+    """
+    内容寻址存储
+    职责: 计算内容哈希、按哈希前缀分目录、以临时文件+rename的方式原子写入, 并维护 MediaBlob 索引
+    """
+
+    def __init__(self, root: Union[str, Path], shard_depth: int = 2, shard_width: int = 2):
+        self.root = Path(root)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+
+    @classmethod
+    def from_settings(cls) -> 'BlobStore':
+        config = getattr(settings, 'BLOB_STORAGE', {})
+        return cls(
+            root=config.get('ROOT') or Path(settings.STORAGE_ROOT) / 'blobs',
+            shard_depth=config.get('SHARD_DEPTH', 2),
+            shard_width=config.get('SHARD_WIDTH', 2),
+        )
+
+    @property
+    def tmp_dir(self) -> Path:
+        """临时文件目录, 与正式文件在同一文件系统上, 保证 rename 是原子的"""
+        return self.root / 'tmp'
+
+    def relative_path(self, sha256: str) -> str:
+        """哈希对应的相对路径, 如 ab/cd/abcd..."""
+        shards = [sha256[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return '/'.join([*shards, sha256])
+
+    def path(self, sha256: str) -> Path:
+        return self.root / self.relative_path(sha256)
+
+    @staticmethod
+    def signature(sha256: str) -> str:
+        """
+        文件的访问签名, 同时用于原文件和它的缩略图/封面帧
+        签名不过期: URL 会随任务结果保存, 内容哈希本身也不可猜测
+        """
+        return signing.Signer(salt=SIGNATURE_SALT).signature(sha256)
+
+    def url(self, sha256: str) -> Optional[str]:
+        """文件的签名访问URL(STORAGE_URL下), 存储目录不在 STORAGE_ROOT 内时返回 None"""
+        try:
+            relative = self.root.relative_to(Path(settings.STORAGE_ROOT))
+        except ValueError:
+            return None
+        path = '/'.join(part.strip('/') for part in (settings.STORAGE_URL, relative.as_posix(), self.relative_path(sha256)))
+        return f'/{path}?sig={self.signature(sha256)}'
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).is_file()
+
+    def _write_temp(self, source: BinaryIO) -> Tuple[str, str, int, bytes]:
+        """
+        把数据流写入临时文件并同时计算哈希
+
+        Returns:
+            (临时文件路径, sha256, 大小, 文件头)
+        """
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), size, head
+
+    def _commit_temp(self, tmp_path: str, sha256: str) -> None:
+        """把临时文件移动到最终位置; 已存在相同内容时丢弃临时文件"""
+        target = self.path(sha256)
+        if target.is_file():
+            os.unlink(tmp_path)
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, target)
+
+    def put_stream(self, source: BinaryIO, filename: Optional[str] = None, mime_type: Optional[str] = None,
+                   provider=None, project_id=None) -> MediaBlob:
+        """
+        保存一个文件, 内容已存在时只增加引用次数
+
+        Args:
+            source: 二进制数据流
+            filename: 原始文件名, 用于推断MIME类型
+            mime_type: 明确指定的MIME类型
+            provider: 来源模型提供商
+            project_id: 所属项目ID
+
+        Returns:
+            MediaBlob 索引记录
+        """
+        tmp_path, sha256, size, head = self._write_temp(source)
+        try:
+            with transaction.atomic():
+                blob, created = MediaBlob.objects.select_for_update().get_or_create(
+                    sha256=sha256,
+                    defaults={
+                        'size': size,
+                        'mime_type': mime_type or sniff_mime_type(head, filename),
+                        'original_name': os.path.basename(filename)[:255] if filename else None,
+                        'model_provider': provider,
+                        'project_id': project_id,
+                    },
+                )
+                if not created:
+                    MediaBlob.objects.filter(sha256=sha256).update(
+                        ref_count=F('ref_count') + 1, last_referenced_at=timezone.now(),
+                    )
+                    blob.ref_count += 1
+                # 持有行锁时落盘, 与 release 删除文件互斥; 索引存在但文件丢失时也会补写
+                self._commit_temp(tmp_path, sha256)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return blob
+
+    def put_bytes(self, content: bytes, **kwargs) -> MediaBlob:
+        """保存一段二进制内容, 参数同 put_stream"""
+        return self.put_stream(BytesIO(content), **kwargs)
+
+    def put_file(self, source_path: Union[str, Path], **kwargs) -> MediaBlob:
+        """保存一个本地文件(复制), 参数同 put_stream"""
+        kwargs.setdefault('filename', os.path.basename(str(source_path)))
+        with open(source_path, 'rb') as source:
+            return self.put_stream(source, **kwargs)
+
+    def get(self, sha256: str) -> Optional[MediaBlob]:
+        return MediaBlob.objects.filter(sha256=sha256).first()
+
+    def open(self, sha256: str) -> BinaryIO:
+        return open(self.path(sha256), 'rb')
+
+    def release(self, sha256: str) -> bool:
+        """
+        释放一次引用, 引用次数归零时删除文件和索引
+
+        Returns:
+            文件是否被删除
+        """
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(sha256=sha256).first()
+            if blob is None:
+                return False
+            if blob.ref_count > 1:
+                MediaBlob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') - 1)
+                return False
+            # 在持有行锁时删除文件, 并发写入同一内容的请求会等待锁释放后重新落盘
+            try:
+                os.unlink(self.path(sha256))
+            except FileNotFoundError:
+                pass
+            blob.delete()
+        return True
+
+
+# 进程级单例
+blob_store = BlobStore.from_settings()
@@ -0,0 +1,184 @@
+"""
+流式生成视图
+ASGI 原生异步视图, 把 OpenAI 兼容执行器的增量输出以 Server-Sent Events 转发给前端,
+流结束后写入一条带 Token 数和延迟的使用日志
+"""
+import asyncio
+import json
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from apps.projects.models import Project
+from core.ai_client.base import AIClientError
+from core.ai_client.registry import ExecutorImportError, executor_registry
+
+from .budgets import BudgetExceededError, budget_ledger, estimate_tokens
+from .circuit_breaker import CircuitOpenError, circuit_breaker
+from .generation import GenerationService, RateLimitedError
+from .provider_cache import provider_cache
+from .usage_buffer import usage_log_buffer
+
+
+def authenticate(request):
+    """使用 REST_FRAMEWORK 配置的认证类认证请求(JWT/Session)"""
+    drf_request = Request(
+        request,
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    return drf_request.user
+
+
+def sse_event(event: str, data: dict) -> str:
+    """格式化一条 SSE 消息"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@csrf_exempt
+async def stream_generate(request, pk):
+    """
+    流式文本生成
+    POST /models/providers/{id}/stream/
+    Body: {"prompt": "...", "system_prompt": "...", "project_id": "...", "stage_type": "..."}
+
+    事件:
+        token: {"content": "..."}
+        done:  {"tokens_used", "latency_ms", "first_token_ms"}
+        error: {"error", "status"}
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': '只支持POST请求'}, status=405)
+    try:
+        user = await sync_to_async(authenticate)(request)
+    except APIException as exc:
+        return JsonResponse({'success': False, 'message': str(exc.detail)}, status=exc.status_code)
+    if not user or not user.is_authenticated:
+        return JsonResponse({'success': False, 'message': '身份认证信息未提供'}, status=401)
+
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'success': False, 'message': '请求体必须是JSON'}, status=400)
+    prompt = body.get('prompt')
+    if not prompt:
+        return JsonResponse({'success': False, 'message': 'prompt不能为空'}, status=400)
+    project_id = body.get('project_id')
+    if project_id not in (None, ''):
+        try:
+            project_id = str(uuid.UUID(str(project_id)))
+        except ValueError:
+            return JsonResponse({'success': False, 'message': 'project_id必须是有效的UUID'}, status=400)
+        # 使用日志和项目预算按 project_id 归属, 只能关联自己的项目
+        if not user.is_staff and not await sync_to_async(
+                Project.objects.filter(pk=project_id, user=user).exists)():
+            return JsonResponse({'success': False, 'message': '项目不存在'}, status=404)
+    else:
+        project_id = None
+
+    provider = await provider_cache.aget(pk)
+    if provider is None or not provider.is_active:
+        return JsonResponse({'success': False, 'message': '模型提供商不存在或未激活'}, status=404)
+    try:
+        client = executor_registry.get_client(provider)
+    except ExecutorImportError as exc:
+        return JsonResponse({'success': False, 'message': str(exc)}, status=400)
+    if not hasattr(client, 'stream_generate'):
+        return JsonResponse({'success': False, 'message': f'{type(client).__name__} 不支持流式生成'}, status=400)
+
+    log_fields = {
+        'project_id': project_id,
+        'stage_type': body.get('stage_type'),
+        'user_id': user.id,
+    }
+    # 与 GenerationService.generate_text 相同的准入顺序: 预算 -> 限流 -> 熔断
+    try:
+        reservation = await GenerationService.admit(
+            provider, estimate_tokens([body.get('system_prompt'), prompt], provider.max_tokens), **log_fields
+        )
+    except BudgetExceededError as exc:
+        return JsonResponse({
+            'success': False,
+            'message': str(exc),
+            'status': exc.status,
+        }, status=402)
+    except RateLimitedError as exc:
+        return JsonResponse({
+            'success': False,
+            'message': '请求过于频繁',
+            'status': exc.status,
+            'retry_after': round(exc.retry_after, 2),
+        }, status=429)
+    try:
+        timeout = await circuit_breaker.abefore_call(provider, **log_fields)
+    except CircuitOpenError as exc:
+        await budget_ledger.arelease(reservation)
+        return JsonResponse({
+            'success': False,
+            'message': str(exc),
+            'status': exc.status,
+            'retry_after': round(exc.retry_after, 2),
+        }, status=503)
+    except BaseException:
+        await budget_ledger.arelease(reservation)
+        raise
+
+    async def event_stream():
+        request_data = {'prompt': prompt, 'system_prompt': body.get('system_prompt')}
+        started = time.monotonic()
+        parts = []
+        try:
+            # 流式输出期间持有执行器实例, 提供商配置更新时旧实例等流结束后再关闭
+            with executor_registry.lease(provider) as client:
+                async for event in client.stream_generate(
+                        prompt, system_prompt=body.get('system_prompt'), timeout=timeout):
+                    if event['type'] == 'delta':
+                        parts.append(event['content'])
+                        yield sse_event('token', {'content': event['content']})
+                        continue
+                    await sync_to_async(usage_log_buffer.record)(
+                        model_provider=provider,
+                        request_data=event['request'],
+                        response_data={'content': event['content'], 'first_token_ms': event['first_token_ms']},
+                        tokens_used=event['tokens_used'],
+                        latency_ms=event['latency_ms'],
+                        status='success',
+                        reservation=reservation,
+                        **log_fields,
+                    )
+                    yield sse_event('done', {
+                        'tokens_used': event['tokens_used'],
+                        'latency_ms': event['latency_ms'],
+                        'first_token_ms': event['first_token_ms'],
+                    })
+        except AIClientError as exc:
+            await sync_to_async(usage_log_buffer.record)(
+                model_provider=provider, request_data=request_data,
+                response_data={'content': ''.join(parts)},
+                latency_ms=int((time.monotonic() - started) * 1000),
+                status=exc.status, error_message=str(exc), reservation=reservation, **log_fields,
+            )
+            yield sse_event('error', {'error': str(exc), 'status': exc.status})
+        except asyncio.CancelledError:
+            # 客户端断开连接, 日志写入仍放到线程池中执行, 不阻塞事件循环
+            await sync_to_async(usage_log_buffer.record)(
+                model_provider=provider, request_data=request_data,
+                response_data={'content': ''.join(parts)},
+                latency_ms=int((time.monotonic() - started) * 1000),
+                status='error', error_message='客户端断开连接', reservation=reservation, **log_fields,
+            )
+            raise
+        finally:
+            # 流未开始或以其他方式结束时归还预留(已随日志结算时不做任何事)
+            await budget_ledger.arelease(reservation)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # 关闭 Nginx 的代理缓冲, 让每个片段立即下发
+    response['X-Accel-Buffering'] = 'no'
+    return response
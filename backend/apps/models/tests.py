@@ -0,0 +1,1132 @@
+"""模型管理测试"""
+import asyncio
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from apps.projects.models import Project
+from core.ai_client.base import AIClientError
+from core.ai_client.comfyui_client import ComfyUIClient
+from core.ai_client.http_pool import HTTPPoolManager, http_pool
+from core.ai_client.openai_client import OpenAIClient
+from core.ai_client.registry import ExecutorImportError, ExecutorRegistry, executor_registry
+from core.ai_client.single_flight import SingleFlight, single_flight
+
+from .budgets import BudgetExceededError, budget_ledger
+from .derivatives import derivative_cache
+from .generation import GenerationService, RateLimitedError
+from .jobs import JobService, progress_reporter
+from .models import (
+    GenerationJob, MediaBlob, ModelProvider, ModelUsageLog, ModelUsagePayload, ModelUsageRollup, UsageBudget,
+)
+from .payloads import PayloadStore
+from .provider_cache import ProviderCache, provider_cache
+from .rate_limit import CacheRateLimitBackend, RateLimitDecision, RateLimiter
+from .router import ProviderRouter
+from .services import ModelProviderService, ModelProviderStatsService, ModelUsageRollupService
+from .storage import BlobStore, blob_store
+from .usage_buffer import UsageLogBuffer, usage_log_buffer
+
+
+class ModelProviderListQueryTests(TestCase):
+    """提供商列表的统计字段由一条带注解的查询得到, 查询数不随提供商数量增长"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user('tester', password='x'))
+
+    def create_providers(self, prefix, count):
+        now = timezone.now()
+        for index in range(count):
+            provider = ModelProvider.objects.create(
+                name=f'{prefix}-{index}', provider_type='llm', api_url='http://example.com/v1',
+                api_key='key', model_name='model',
+            )
+            # 天级汇总计入总数, 最近的小时汇总计入最近使用次数
+            for granularity, bucket, count in (
+                ('day', now - timedelta(days=30), 10 * (index + 1)),
+                ('hour', now, index + 1),
+            ):
+                ModelUsageRollup.objects.create(
+                    model_provider=provider, granularity=granularity,
+                    bucket=ModelUsageRollupService.truncate(bucket, granularity),
+                    status='success', source='upstream', request_count=count,
+                )
+
+    def test_list_uses_single_query(self):
+        self.create_providers('a', 3)
+        with self.assertNumQueries(1):
+            response = self.client.get('/models/providers/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 3)
+
+        self.create_providers('b', 5)
+        with self.assertNumQueries(1):
+            response = self.client.get('/models/providers/')
+        data = {item['name']: item for item in response.json()['data']}
+        self.assertEqual(len(data), 8)
+        self.assertEqual(data['b-2']['total_usage_count'], 30)
+        self.assertEqual(data['b-2']['recent_usage_count'], 3)
+
+
+class ModelUsageRollupTests(TestCase):
+    """汇总表增量累加与调用统计"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+
+    def make_log(self, status='success', source='upstream', latency_ms=80):
+        return ModelUsageLog(
+            model_provider=self.provider, status=status, source=source,
+            tokens_used=10, latency_ms=latency_ms, created_at=timezone.now(),
+        )
+
+    def test_apply_logs_accumulates_histogram(self):
+        ModelUsageRollupService.apply_logs([self.make_log(latency_ms=80), self.make_log(latency_ms=400)])
+        ModelUsageRollupService.apply_logs([self.make_log(latency_ms=90)])
+        row = ModelUsageRollup.objects.get(granularity='day')
+        self.assertEqual(row.request_count, 3)
+        self.assertEqual(row.latency_histogram[1], 2)
+        self.assertEqual(row.latency_histogram[3], 1)
+
+    def test_stats_count_upstream_calls_only(self):
+        ModelUsageRollupService.apply_logs([
+            self.make_log(), self.make_log(status='failed'),
+            self.make_log(source='cache', latency_ms=1), self.make_log(source='coalesced', latency_ms=1),
+            self.make_log(status='budget_exceeded', latency_ms=0),
+            self.make_log(status='circuit_open', latency_ms=0),
+        ])
+        stats = ModelProviderStatsService.get_provider_stats(self.provider)
+        self.assertEqual(stats['total_usage_count'], 2)
+        self.assertEqual(stats['success_rate'], 50.0)
+        self.assertEqual(stats['cache_hit_count'], 1)
+        self.assertEqual(stats['coalesced_count'], 1)
+        self.assertEqual(stats['total_tokens_used'], 20)
+
+    def test_stats_count_every_non_success_upstream_status_as_failed(self):
+        ModelUsageRollupService.apply_logs([
+            self.make_log(latency_ms=80), self.make_log(latency_ms=400),
+            self.make_log(status='failed'), self.make_log(status='timeout'),
+            self.make_log(status='rate_limited'), self.make_log(status='unpack_failed'),
+            self.make_log(status='rate_limited', source='local', latency_ms=0),
+            self.make_log(source='reused', latency_ms=0),
+        ])
+        with self.assertNumQueries(1):
+            stats = ModelProviderStatsService.get_provider_stats(self.provider)
+        self.assertEqual(
+            (stats['total_usage_count'], stats['success_count'], stats['failed_count']), (6, 2, 4),
+        )
+        self.assertEqual(stats['success_rate'], 33.33)
+        self.assertEqual(stats['avg_latency_ms'], 133.33)
+        self.assertIsNotNone(stats['p99_latency_ms'])
+
+    def test_stats_without_rollups(self):
+        self.assertEqual(
+            ModelProviderStatsService.get_provider_stats(self.provider), ModelProviderStatsService.empty_stats(),
+        )
+
+    def test_rebuild_keeps_rollups_of_deleted_logs(self):
+        old = self.make_log()
+        old.save()
+        ModelUsageLog.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=3))
+        self.make_log().save()
+        ModelUsageRollupService.rebuild('day')
+        self.assertEqual(ModelUsageRollup.objects.filter(granularity='day').count(), 2)
+
+        # 日志被 archive_usage_logs 删除后, 重建不能清掉它的汇总
+        ModelUsageLog.objects.filter(pk=old.pk).delete()
+        ModelUsageRollupService.rebuild('day')
+        rows = ModelUsageRollup.objects.filter(granularity='day').order_by('bucket')
+        self.assertEqual([row.request_count for row in rows], [1, 1])
+
+
+class UsageLogPaginationTests(TestCase):
+    """使用日志按 (created_at, id) keyset 分页, created_at 相同的行不会重复或遗漏"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user('tester', password='x', is_staff=True))
+        provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        ModelUsageLog.objects.bulk_create([ModelUsageLog(model_provider=provider) for _ in range(25)])
+        now = timezone.now()
+        logs = list(ModelUsageLog.objects.values_list('pk', flat=True))
+        # 大部分日志共享同一个 created_at(批量落库), 少数早于或晚于它
+        ModelUsageLog.objects.filter(pk__in=logs[:21]).update(created_at=now)
+        ModelUsageLog.objects.filter(pk__in=logs[21:23]).update(created_at=now - timedelta(seconds=1))
+        ModelUsageLog.objects.filter(pk__in=logs[23:]).update(created_at=now + timedelta(seconds=1))
+        self.expected = [
+            str(pk) for pk in ModelUsageLog.objects.order_by('-created_at', '-id').values_list('pk', flat=True)
+        ]
+
+    def walk(self, url, link):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            pages.append([item['id'] for item in data['results']])
+            url = data[link]
+        return pages
+
+    def test_pages_cover_duplicate_timestamps_in_order(self):
+        pages = self.walk('/models/usage-logs/?page_size=4&fields=id', 'next')
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 4, 4, 4, 1])
+        self.assertEqual(sum(pages, []), self.expected)
+
+        # 从最后一页向前翻回第一页
+        last = self.client.get('/models/usage-logs/?page_size=4&fields=id')
+        for _ in range(6):
+            last = self.client.get(last.json()['next'])
+        backwards = self.walk(last.json()['previous'], 'previous')
+        self.assertEqual(sum(reversed(backwards), []), self.expected[:24])
+        self.assertIsNone(self.client.get('/models/usage-logs/?page_size=4').json()['previous'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/models/usage-logs/?cursor=bad').status_code, 404)
+
+
+class PayloadStoreTests(TestCase):
+    """超过阈值的请求/响应数据压缩外置, 列表只返回预览, 详情接口按需加载完整内容"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user('tester', password='x', is_staff=True))
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.store = PayloadStore(threshold=100, preview_chars=10)
+        self.large = {'prompt': '长' * 200}
+
+    def make_log(self, request_data, response_data=None):
+        return ModelUsageLog(model_provider=self.provider, request_data=request_data, response_data=response_data or {})
+
+    def test_only_fields_over_threshold_are_offloaded(self):
+        log = self.make_log(self.large, {'content': 'short'})
+        self.store.save_log(log)
+        log.refresh_from_db()
+        self.assertTrue(log.payload_offloaded)
+        raw = PayloadStore.encode(self.large)
+        self.assertEqual(log.request_data, {'_offloaded': True, 'size': len(raw), 'preview': raw.decode()[:10]})
+        self.assertEqual(log.response_data, {'content': 'short'})
+        payload = ModelUsagePayload.objects.get(log=log)
+        self.assertIsNone(payload.response_data)
+        self.assertEqual(payload.raw_size, len(raw))
+        self.assertLess(payload.stored_size, payload.raw_size)
+
+        small = self.make_log({'prompt': 'hi'})
+        self.store.save_log(small)
+        self.assertFalse(ModelUsageLog.objects.get(pk=small.pk).payload_offloaded)
+        self.assertFalse(ModelUsagePayload.objects.filter(log=small).exists())
+
+    def test_bulk_save_and_restore_rows(self):
+        logs = [self.make_log(self.large), self.make_log({'prompt': 'hi'}, self.large)]
+        self.store.save_logs(logs)
+        self.assertEqual(ModelUsagePayload.objects.count(), 2)
+        rows = list(ModelUsageLog.objects.order_by('created_at', 'id').values('id', 'request_data', 'response_data',
+                                                                             'payload_offloaded'))
+        rows, offloaded = self.store.restore_rows(rows)
+        self.assertEqual(len(offloaded), 2)
+        restored = {str(row['id']): row for row in rows}
+        self.assertEqual(restored[str(logs[0].pk)]['request_data'], self.large)
+        self.assertEqual(restored[str(logs[1].pk)]['request_data'], {'prompt': 'hi'})
+        self.assertEqual(restored[str(logs[1].pk)]['response_data'], self.large)
+
+    def test_detail_endpoint_loads_offloaded_payload(self):
+        log = self.make_log(self.large, self.large)
+        self.store.save_log(log)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/models/usage-logs/')
+        self.assertEqual(response.status_code, 200)
+        item = response.json()['results'][0]
+        self.assertTrue(item['payload_offloaded'])
+        self.assertTrue(item['request_data']['_offloaded'])
+        # 列表不读取外置表
+        self.assertFalse(any(ModelUsagePayload._meta.db_table in query['sql'] for query in queries))
+
+        response = self.client.get(f'/models/usage-logs/{log.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['request_data'], self.large)
+        self.assertEqual(response.json()['response_data'], self.large)
+
+
+class UsageLogBufferTests(TestCase):
+    """写缓冲落库: 一条坏数据不会连累整批日志"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.buffer = UsageLogBuffer(flush_interval=3600)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_invalid_field_is_normalized(self):
+        for _ in range(5):
+            self.buffer.record(model_provider=self.provider, status='success', tokens_used=1, latency_ms=10)
+        log = self.buffer.record(model_provider=self.provider, status='success', project_id='not-a-uuid')
+        self.assertIsNone(log.project_id)
+        self.assertEqual(self.buffer.flush(), 6)
+        self.assertEqual(ModelUsageLog.objects.count(), 6)
+
+    def test_failed_batch_falls_back_to_single_rows(self):
+        logs = [
+            self.buffer.record(model_provider=self.provider, status='success', tokens_used=1, latency_ms=10)
+            for _ in range(3)
+        ]
+        # 主键冲突的日志只影响它自己
+        ModelUsageLog.objects.create(id=logs[1].id, model_provider=self.provider)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.pending_count(), 0)
+        self.assertEqual(ModelUsageLog.objects.count(), 3)
+        self.assertEqual(
+            ModelUsageRollup.objects.get(granularity='day', status='success').request_count, 3,
+        )
+
+
+class ProviderRouterHealthTests(TestCase):
+    """健康统计只采样真实的上游调用"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.router = ProviderRouter(min_samples=3, max_failure_rate=0.5)
+
+    def observe(self, status, source='upstream'):
+        self.router.observe_log(ModelUsageLog(
+            model_provider=self.provider, status=status, source=source, latency_ms=10,
+        ))
+
+    def test_local_refusals_do_not_eject(self):
+        for status in ('budget_exceeded', 'short_circuited', 'circuit_open', 'unpack_failed'):
+            self.observe(status)
+        for source in ('cache', 'coalesced', 'reused'):
+            self.observe('success', source=source)
+        for _ in range(3):
+            self.observe('rate_limited', source='local')
+        self.assertNotIn(str(self.provider.id), self.router._health)
+        self.assertTrue(self.router.is_healthy(self.provider.id))
+
+    def test_upstream_rate_limits_eject(self):
+        for _ in range(3):
+            self.observe('rate_limited')
+        self.assertFalse(self.router.is_healthy(self.provider.id))
+
+    def test_least_outstanding_counts_acquired_calls(self):
+        other = ModelProvider.objects.create(
+            name='llm-2', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        router = ProviderRouter(strategy=ProviderRouter.STRATEGY_LEAST_OUTSTANDING)
+        with router.acquire('llm') as first:
+            with router.acquire('llm') as second:
+                self.assertNotEqual(first.id, second.id)
+                self.assertEqual((router.outstanding(self.provider.id), router.outstanding(other.id)), (1, 1))
+            with router.track(first.id):
+                # first 有两个在途调用, 新的调用分配给 second
+                self.assertEqual(router.select('llm').id, second.id)
+        self.assertEqual((router.outstanding(self.provider.id), router.outstanding(other.id)), (0, 0))
+
+
+class ProviderCacheTests(TestCase):
+    """提供商快照由信号递增版本号失效, 同步与异步读取都遵守 max_age"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+
+    def test_save_and_delete_signals_bump_version(self):
+        cache = ProviderCache(version_check_interval=0)
+        version = cache.snapshot().version
+        self.provider.model_name = 'model-2'
+        self.provider.save()
+        snapshot = cache.snapshot()
+        self.assertGreater(snapshot.version, version)
+        self.assertEqual(snapshot.by_id[str(self.provider.id)].model_name, 'model-2')
+
+        provider_id = self.provider.id
+        self.provider.delete()
+        self.assertIsNone(cache.get(provider_id))
+        self.assertEqual(cache.get_active('llm'), [])
+
+    def test_local_snapshot_invalidated_without_waiting_for_version_check(self):
+        self.assertEqual(provider_cache.get(self.provider.id).model_name, 'model')
+        self.provider.is_active = False
+        self.provider.save()
+        # 本进程的快照在信号处理时直接丢弃, 不受 version_check_interval 限制
+        self.assertEqual(provider_cache.get_active('llm'), [])
+        self.assertFalse(async_to_sync(provider_cache.aget)(self.provider.id).is_active)
+
+    def test_version_checked_after_interval(self):
+        cache = ProviderCache(version_check_interval=60)
+        cache.snapshot()
+        # 模拟其他进程递增版本号
+        cache.cache.incr(cache.VERSION_KEY)
+        ModelProvider.objects.filter(pk=self.provider.pk).update(model_name='model-2')
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get(self.provider.id).model_name, 'model')
+        with mock.patch('apps.models.provider_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(cache.get(self.provider.id).model_name, 'model-2')
+
+    def test_async_fast_path_respects_max_age(self):
+        # 版本号未变化(如本地缓存不共享), 快照只能依靠 max_age 过期
+        cache = ProviderCache(version_check_interval=60, max_age=30)
+        async_to_sync(cache.asnapshot)()
+        ModelProvider.objects.filter(pk=self.provider.pk).update(model_name='model-2')
+        now = time.monotonic()
+        with mock.patch('apps.models.provider_cache.time.monotonic', return_value=now + 10):
+            self.assertEqual(async_to_sync(cache.aget)(self.provider.id).model_name, 'model')
+        with mock.patch('apps.models.provider_cache.time.monotonic', return_value=now + 31):
+            # 距上次版本检查不足 version_check_interval, 但快照已超过 max_age
+            self.assertEqual(async_to_sync(cache.aget)(self.provider.id).model_name, 'model-2')
+
+
+class CacheRateLimitBackendTests(TestCase):
+    """共享缓存限流: 并发请求不会超过配额"""
+
+    def setUp(self):
+        self.backend = CacheRateLimitBackend(key_prefix=f'rate_limit_test_{id(self)}')
+
+    def test_concurrent_acquire_respects_limit(self):
+        limits = [('provider:rpm', 5, 60)]
+        results = []
+        barrier = threading.Barrier(20)
+
+        def worker():
+            barrier.wait()
+            results.append(self.backend.acquire(limits))
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        allowed = [blocked_by for _, blocked_by in results if blocked_by is None]
+        self.assertEqual(len(allowed), 5)
+        # 被拒绝的请求回滚了计数, 不会继续挤占配额
+        window_key = self.backend._window_key('provider:rpm', int(time.time() // 60))
+        self.assertEqual(self.backend.cache.get(window_key), 5)
+
+    def test_async_acquire_records_local_rate_limited_log(self):
+        provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key',
+            model_name='model', rate_limit_rpm=1,
+        )
+        limiter = RateLimiter(self.backend)
+        self.assertTrue(async_to_sync(limiter.aacquire)(provider).allowed)
+        decision = async_to_sync(limiter.aacquire)(provider)
+        self.assertFalse(decision.allowed)
+        self.assertEqual(decision.status, 'rate_limited')
+        usage_log_buffer.flush()
+        self.assertTrue(
+            ModelUsageLog.objects.filter(model_provider=provider, status='rate_limited', source='local').exists()
+        )
+
+
+class ExecutorRegistryTests(TestCase):
+    """执行器类解析与客户端实例缓存"""
+
+    def test_default_executors_are_resolvable(self):
+        for provider_type, _ in ModelProvider.PROVIDER_TYPES:
+            provider = ModelProvider(provider_type=provider_type)
+            self.assertTrue(executor_registry.is_resolvable(provider.get_default_executor()), provider_type)
+
+    def make_provider(self, updated_at):
+        return ModelProvider(
+            id=1, name='p', provider_type='llm', api_url='http://example.com/v1', api_key='key',
+            model_name='model', updated_at=updated_at,
+        )
+
+    def test_resolve_caches_class_and_rejects_invalid_paths(self):
+        registry = ExecutorRegistry()
+        path = 'core.ai_client.openai_client.OpenAIClient'
+        with mock.patch('core.ai_client.registry.import_string', return_value=OpenAIClient) as importer:
+            self.assertIs(registry.resolve(path), OpenAIClient)
+            self.assertIs(registry.resolve(path), OpenAIClient)
+        self.assertEqual(importer.call_count, 1)
+        with self.assertRaises(ExecutorImportError):
+            registry.resolve('core.ai_client.missing.Client')
+        with self.assertRaises(ExecutorImportError):
+            registry.resolve('apps.models.models.ModelProvider')
+
+    def test_rebuilds_only_for_newer_config(self):
+        registry = ExecutorRegistry()
+        now = timezone.now()
+        with mock.patch.object(OpenAIClient, 'close') as close:
+            client = registry.get_client(self.make_provider(now))
+            self.assertIs(registry.get_client(self.make_provider(now)), client)
+            # 旧快照(例如缓存中尚未刷新的提供商)不会替换按新配置创建的实例
+            self.assertIs(registry.get_client(self.make_provider(now - timedelta(seconds=5))), client)
+            close.assert_not_called()
+            rebuilt = registry.get_client(self.make_provider(now + timedelta(seconds=5)))
+        self.assertIsNot(rebuilt, client)
+        self.assertEqual(rebuilt.provider.updated_at, now + timedelta(seconds=5))
+        close.assert_called_once_with()
+
+    def test_replaced_client_closed_after_outstanding_calls(self):
+        registry = ExecutorRegistry()
+        now = timezone.now()
+        closed = []
+        with mock.patch.object(OpenAIClient, 'close', autospec=True, side_effect=closed.append):
+            with registry.lease(self.make_provider(now)) as client:
+                with registry.lease(self.make_provider(now)) as same:
+                    self.assertIs(same, client)
+                    registry.get_client(self.make_provider(now + timedelta(seconds=1)))
+                self.assertEqual(closed, [])
+            self.assertEqual(closed, [client])
+            # 没有进行中调用的实例失效时立即关闭
+            current = registry.get_client(self.make_provider(now + timedelta(seconds=1)))
+            registry.invalidate(1)
+            self.assertEqual(closed, [client, current])
+
+
+class HTTPPoolTests(TestCase):
+    """连接池跨同步调用复用, 事件循环结束时关闭"""
+
+    def setUp(self):
+        self.pool = HTTPPoolManager()
+
+    def test_sync_calls_share_client(self):
+        ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+
+        async def call():
+            # ORM 访问仍在调用线程执行, 能看到测试事务中的数据
+            count = await sync_to_async(ModelProvider.objects.count)()
+            return self.pool.get_client('http://example.com/v1/chat/completions'), count
+
+        first, count = self.pool.async_to_sync(call)()
+        second, _ = self.pool.async_to_sync(call)()
+        self.assertIs(first, second)
+        self.assertEqual(count, 1)
+
+    def test_clients_closed_with_loop(self):
+        async def call():
+            return self.pool.get_client('http://example.com/v1')
+
+        client = asyncio.run(call())
+        self.assertTrue(client.is_closed)
+        self.assertEqual(self.pool._clients, {})
+
+
+class OpenAIClientResponseTests(TestCase):
+    """上游返回非法JSON时抛出 AIClientError"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+
+    def call(self, handler, method):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        async def run():
+            executor = OpenAIClient(self.provider)
+            if method == 'chat':
+                return await executor.generate('hi')
+            return [event async for event in executor.stream_generate('hi')]
+
+        with mock.patch.object(http_pool, 'get_client', return_value=client):
+            return asyncio.run(run())
+
+    def test_invalid_json_body(self):
+        with self.assertRaises(AIClientError):
+            self.call(lambda request: httpx.Response(200, text='<html>bad gateway</html>'), 'chat')
+
+    def test_invalid_stream_chunk(self):
+        with self.assertRaises(AIClientError):
+            self.call(lambda request: httpx.Response(200, text='data: {"choices": [\n\n'), 'stream')
+
+    def test_timeout_is_per_call(self):
+        seen = {}
+
+        async def handler(request):
+            await asyncio.sleep(0.01)
+            prompt = json.loads(request.content)['messages'][0]['content']
+            seen[prompt] = request.extensions['timeout']['read']
+            return httpx.Response(200, json={'choices': [{'message': {'content': 'ok'}}]})
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        executor = OpenAIClient(self.provider)
+
+        async def run():
+            # 共享同一个执行器的并发调用各自使用自己的超时, 且不超过配置的 timeout
+            await asyncio.gather(executor.generate('a', timeout=5), executor.generate('b', timeout=500))
+
+        with mock.patch.object(http_pool, 'get_client', return_value=client):
+            asyncio.run(run())
+        self.assertEqual(seen, {'a': 5.0, 'b': 60.0})
+
+
+class StreamGenerateTests(TestCase):
+    """流式生成接口的参数校验和准入顺序"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        user = get_user_model().objects.create_user('tester', password='x')
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def test_invalid_project_id(self):
+        response = self.client.post(
+            f'/models/providers/{self.provider.id}/stream/',
+            {'prompt': 'hi', 'project_id': 'not-a-uuid'},
+            content_type='application/json', headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ModelUsageLog.objects.exists())
+
+    def stream(self, **body):
+        return self.client.post(
+            f'/models/providers/{self.provider.id}/stream/', {'prompt': 'hi', **body},
+            content_type='application/json', headers=self.headers,
+        )
+
+    def test_other_users_project_rejected(self):
+        other = get_user_model().objects.create_user('other', password='x')
+        project = Project.objects.create(user=other, name='p', story_idea='x')
+        self.assertEqual(self.stream(project_id=str(project.id)).status_code, 404)
+        self.assertFalse(ModelUsageLog.objects.exists())
+
+    def test_rate_limit_checked_before_circuit(self):
+        denied = RateLimitDecision(allowed=False, retry_after=1.5, limit='rpm')
+        with mock.patch('apps.models.generation.rate_limiter.aacquire', return_value=denied), \
+                mock.patch('apps.models.streaming.circuit_breaker.abefore_call') as before_call:
+            response = self.stream()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.content)['retry_after'], 1.5)
+        before_call.assert_not_called()
+
+
+class SingleFlightTests(TestCase):
+    """请求合并: leader 或等待者被取消都不会影响其他调用者"""
+
+    def test_cancelled_leader_reelects(self):
+        flight = SingleFlight()
+        calls = []
+
+        def make_call(name, delay):
+            async def call():
+                calls.append(name)
+                await asyncio.sleep(delay)
+                return name
+            return call
+
+        async def run():
+            leader = asyncio.create_task(flight.do('key', make_call('leader', 10)))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(flight.do('key', make_call('follower', 0)))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(run()), ('follower', False))
+        self.assertEqual(calls, ['leader', 'follower'])
+        self.assertEqual(flight.inflight_count(), 0)
+
+    def test_cancelled_follower_keeps_leader(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            leader = asyncio.create_task(flight.do('key', call))
+            await asyncio.sleep(0)
+            followers = [asyncio.create_task(flight.do('key', call)) for _ in range(2)]
+            await asyncio.sleep(0)
+            followers[0].cancel()
+            return await leader, await followers[1]
+
+        self.assertEqual(asyncio.run(run()), (('result', False), ('result', True)))
+
+
+class GenerationServiceTests(TestCase):
+    """批量生成: 打包调用按 id 拆分, 无法拆分时逐条重试; 准入顺序与单条生成一致; 失败日志带延迟"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.calls = []
+
+    def generate(self, chat, prompts, **kwargs):
+        with mock.patch.object(OpenAIClient, 'chat', autospec=True, side_effect=chat):
+            return async_to_sync(GenerationService.generate_batch)(
+                self.provider, prompts, use_cache=False, **kwargs
+            )
+
+    async def chat(self, client, messages, timeout=None, **overrides):
+        packed = messages[0]['content'].startswith(OpenAIClient.PACKED_INSTRUCTION)
+        self.calls.append('packed' if packed else messages[-1]['content'])
+        if packed:
+            items = json.loads(messages[-1]['content'])
+            content = json.dumps({'results': [{'id': item['id'], 'content': f"R:{item['prompt']}"} for item in items]})
+        else:
+            content = f"R:{messages[-1]['content']}"
+        return {
+            'content': content, 'tokens_used': 9, 'latency_ms': 5,
+            'request': {'messages': messages}, 'response': {'usage': {'total_tokens': 9}},
+        }
+
+    def test_packed_response_split(self):
+        results = self.generate(self.chat, ['a', 'b', 'c'], pack_size=3)
+        self.assertEqual(self.calls, ['packed'])
+        self.assertEqual([item['content'] for item in results], ['R:a', 'R:b', 'R:c'])
+        self.assertTrue(all(item['success'] and item['packed'] for item in results))
+        logs = ModelUsageLog.objects.filter(model_provider=self.provider)
+        self.assertEqual(sorted(logs.values_list('tokens_used', flat=True)), [3, 3, 3])
+        self.assertEqual(set(logs.values_list('status', flat=True)), {'success'})
+
+    def test_unsplittable_packed_response_falls_back_per_item(self):
+        async def chat(client, messages, timeout=None, **overrides):
+            result = await self.chat(client, messages, timeout, **overrides)
+            if self.calls[-1] == 'packed':
+                result['content'] = '不是JSON'
+            return result
+
+        results = self.generate(chat, ['a', 'b'], pack_size=2)
+        self.assertEqual(self.calls[0], 'packed')
+        self.assertEqual(sorted(self.calls[1:]), ['a', 'b'])
+        self.assertEqual([(item['content'], item['packed']) for item in results], [('R:a', False), ('R:b', False)])
+        statuses = list(ModelUsageLog.objects.filter(model_provider=self.provider).values_list('status', 'tokens_used'))
+        # 打包调用的用量按条分摊记为 unpack_failed, 逐条重试各记一条成功日志
+        self.assertEqual(sorted(statuses), [('success', 9), ('success', 9), ('unpack_failed', 4), ('unpack_failed', 5)])
+
+    def test_failed_call_logs_latency(self):
+        async def chat(client, messages, timeout=None, **overrides):
+            await asyncio.sleep(0.05)
+            raise AIClientError('上游返回 500')
+
+        with mock.patch.object(OpenAIClient, 'chat', autospec=True, side_effect=chat):
+            with self.assertRaises(AIClientError):
+                async_to_sync(GenerationService.generate_text)(self.provider, 'hi', use_cache=False)
+        usage_log_buffer.flush()
+        log = ModelUsageLog.objects.get(model_provider=self.provider)
+        self.assertEqual(log.status, 'failed')
+        self.assertGreaterEqual(log.latency_ms, 50)
+
+    def test_rate_limit_checked_before_circuit(self):
+        denied = RateLimitDecision(allowed=False, retry_after=1.0, limit='rpm')
+        with mock.patch('apps.models.generation.rate_limiter.aacquire', return_value=denied), \
+                mock.patch('apps.models.generation.circuit_breaker.abefore_call') as before_call:
+            results = self.generate(self.chat, ['a', 'b'], pack_size=2)
+        before_call.assert_not_called()
+        self.assertEqual(self.calls, [])
+        self.assertEqual({item['status'] for item in results}, {RateLimitedError.status})
+
+
+class GenerationCoalescingTests(TestCase):
+    """相同的并发生成请求只调用一次上游, 其余调用者各写一条 source='coalesced' 日志"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.calls = 0
+
+    async def chat(self, client, messages, timeout=None, **overrides):
+        self.calls += 1
+        call = self.calls
+        # 所有调用者都进入 single_flight 后才返回, 保证它们的调用重叠
+        await self.wait_joined(self.callers)
+        await asyncio.sleep(0.01)
+        return {
+            'content': f'R{call}', 'tokens_used': 9, 'latency_ms': 50,
+            'request': {'messages': messages}, 'response': {'usage': {'total_tokens': 9}},
+        }
+
+    def run_concurrently(self, run, callers):
+        self.callers = callers
+        self.joined = 0
+        do = single_flight.do
+
+        async def counting_do(key, call):
+            self.joined += 1
+            return await do(key, call)
+
+        with mock.patch.object(OpenAIClient, 'chat', autospec=True, side_effect=self.chat), \
+                mock.patch.object(single_flight, 'do', side_effect=counting_do):
+            results = async_to_sync(run)()
+        usage_log_buffer.flush()
+        return results
+
+    async def wait_joined(self, count):
+        """等待 count 个调用者进入 single_flight"""
+        while self.joined < count:
+            await asyncio.sleep(0.001)
+
+    def generate(self):
+        return GenerationService.generate_text(self.provider, 'hi', use_cache=False)
+
+    def test_identical_calls_are_coalesced(self):
+        async def run():
+            return await asyncio.gather(*(self.generate() for _ in range(3)))
+
+        results = self.run_concurrently(run, callers=3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual({item['content'] for item in results}, {'R1'})
+        self.assertEqual(sorted(item['coalesced'] for item in results), [False, True, True])
+        logs = ModelUsageLog.objects.filter(model_provider=self.provider)
+        self.assertEqual(
+            sorted(logs.values_list('source', 'tokens_used')),
+            [('coalesced', 0), ('coalesced', 0), ('upstream', 9)],
+        )
+        for log in logs.filter(source='coalesced'):
+            self.assertEqual(log.status, 'success')
+            self.assertEqual(log.response_data, {'shared_tokens': 9})
+            self.assertGreater(log.latency_ms, 0)
+
+    def test_cancelled_leader_reelects(self):
+        async def run():
+            leader = asyncio.create_task(self.generate())
+            await self.wait_joined(1)
+            follower = asyncio.create_task(self.generate())
+            await self.wait_joined(2)
+            await asyncio.sleep(0)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        result = self.run_concurrently(run, callers=2)
+        # 等待者重新当选 leader, 自己请求上游, 不会收到 leader 的取消
+        self.assertEqual(self.calls, 2)
+        self.assertEqual((result['content'], result['coalesced']), ('R2', False))
+        logs = ModelUsageLog.objects.filter(model_provider=self.provider)
+        self.assertEqual(list(logs.values_list('source', 'status')), [('upstream', 'success')])
+
+
+class ProviderConnectionTests(TestCase):
+    """连接测试失败时记录实际耗时"""
+
+    def test_failed_connection_reports_latency(self):
+        provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+
+        async def generate(client, prompt, **kwargs):
+            await asyncio.sleep(0.05)
+            raise AIClientError('连接被拒绝')
+
+        with mock.patch.object(OpenAIClient, 'generate', autospec=True, side_effect=generate):
+            result = async_to_sync(ModelProviderService.test_provider_connection)(provider.id, 'ping')
+        self.assertFalse(result['success'])
+        self.assertGreaterEqual(result['latency_ms'], 50)
+        usage_log_buffer.flush()
+        log = ModelUsageLog.objects.get(model_provider=provider, stage_type='connection_test')
+        self.assertEqual(log.latency_ms, result['latency_ms'])
+
+
+class UsageBudgetTests(TestCase):
+    """预算预留与结算、账本访问权限"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key', model_name='model',
+        )
+        self.user = get_user_model().objects.create_user('owner', password='x')
+        UsageBudget.objects.create(scope='user', scope_id=str(self.user.id), token_limit=100)
+
+    def budget(self):
+        return UsageBudget.objects.get(scope='user', scope_id=str(self.user.id))
+
+    def test_reservation_is_settled_by_the_call_log(self):
+        reservation = budget_ledger.enforce(self.provider, 60, user_id=self.user.id)
+        with self.assertRaises(BudgetExceededError):
+            budget_ledger.enforce(self.provider, 60, user_id=self.user.id)
+        usage_log_buffer.record(
+            model_provider=self.provider, status='success', tokens_used=30, latency_ms=10,
+            user_id=self.user.id, reservation=reservation,
+        )
+        usage_log_buffer.flush()
+        budget = self.budget()
+        self.assertEqual((budget.tokens_used, budget.reserved_tokens), (30, 0))
+        # 已被日志认领的预留不会再次归还
+        budget_ledger.release(reservation)
+        self.assertEqual(self.budget().reserved_tokens, 0)
+        self.assertIsNotNone(budget_ledger.enforce(self.provider, 60, user_id=self.user.id))
+
+    def test_local_and_coalesced_logs_only_release(self):
+        for status, source in (('budget_exceeded', 'upstream'), ('rate_limited', 'local'), ('success', 'coalesced')):
+            reservation = budget_ledger.enforce(self.provider, 40, user_id=self.user.id)
+            usage_log_buffer.record(
+                model_provider=self.provider, status=status, source=source, tokens_used=0, latency_ms=0,
+                user_id=self.user.id, reservation=reservation,
+            )
+            usage_log_buffer.flush()
+        budget = self.budget()
+        self.assertEqual((budget.request_count, budget.tokens_used, budget.reserved_tokens), (0, 0, 0))
+
+    def test_writes_require_admin_and_reads_are_scoped(self):
+        other = get_user_model().objects.create_user('other', password='x')
+        project = Project.objects.create(user=self.user, name='p', story_idea='idea')
+        UsageBudget.objects.create(scope='user', scope_id=str(other.id), token_limit=10)
+        UsageBudget.objects.create(scope='project', scope_id=str(project.id), token_limit=10)
+        self.client.force_login(self.user)
+        response = self.client.get('/models/budgets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(self.client.get(f'/models/usage-logs/summary/?user_id={other.id}').status_code, 403)
+        data = {'scope': 'user', 'scope_id': str(other.id), 'token_limit': 1000}
+        self.assertEqual(
+            self.client.patch(f'/models/budgets/{self.budget().id}/', {'token_limit': 1000},
+                              content_type='application/json').status_code, 403,
+        )
+        admin = get_user_model().objects.create_user('admin', password='x', is_staff=True)
+        self.client.force_login(admin)
+        self.assertEqual(self.client.get('/models/budgets/').json()['count'], 3)
+        self.assertEqual(
+            self.client.post('/models/budgets/', {**data, 'scope_id': 'new'},
+                             content_type='application/json').status_code, 201,
+        )
+
+
+class GenerationJobTests(TestCase):
+    """任务提交参数、访问范围和领取"""
+
+    def setUp(self):
+        self.provider = ModelProvider.objects.create(
+            name='llm', provider_type='llm', api_url='http://example.com/v1', api_key='key',
+            model_name='model', extra_config={'max_concurrency': 1},
+        )
+        self.user = get_user_model().objects.create_user('tester', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def submit(self, payload):
+        return self.client.post(
+            '/models/jobs/', {'model_provider': str(self.provider.id), 'payload': payload}, format='json',
+        )
+
+    def test_llm_payload_whitelist(self):
+        self.assertEqual(self.submit({'prompt': 'hi', 'use_cache': False}).status_code, 400)
+        self.assertEqual(self.submit({'prompt': 'hi', 'max_tokens': 'many'}).status_code, 400)
+        self.assertEqual(self.submit({'prompt': 'hi', 'max_tokens': 100}).status_code, 202)
+
+    def test_jobs_scoped_to_user(self):
+        other = get_user_model().objects.create_user('other', password='x')
+        job = JobService.submit(self.provider, {'prompt': 'hi'}, user_id=other.id)
+        self.assertEqual(self.client.get(f'/models/jobs/{job.id}/').status_code, 404)
+        self.assertEqual(self.client.get('/models/jobs/').json()['count'], 0)
+
+    def test_inactive_provider_jobs_are_not_unfinished(self):
+        JobService.submit(self.provider, {'prompt': 'hi'})
+        self.assertTrue(JobService.has_unfinished())
+        ModelProvider.objects.filter(pk=self.provider.pk).update(is_active=False)
+        self.assertFalse(JobService.has_unfinished())
+
+    def test_claim_one_respects_provider_concurrency(self):
+        now = timezone.now()
+        GenerationJob.objects.create(
+            model_provider=self.provider, job_type='llm', payload={'prompt': 'a'}, status='running',
+            run_after=now, locked_by='other-worker', locked_until=now + timedelta(minutes=5), attempts=1,
+        )
+        job = JobService.submit(self.provider, {'prompt': 'b'})
+        locked_until = now + timedelta(minutes=5)
+        self.assertFalse(JobService.claim_one(job, self.provider, 1, 'worker', locked_until, now))
+        self.assertTrue(JobService.claim_one(job, self.provider, 2, 'worker', locked_until, now))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.attempts), ('running', 'worker', 1))
+
+
+class JobProgressTests(TestCase):
+    """执行器进度写入任务, 且按间隔节流"""
+
+    def test_progress_is_throttled(self):
+        provider = ModelProvider.objects.create(
+            name='comfyui', provider_type='text2image', api_url='http://example.com', api_key='',
+            model_name='workflow',
+        )
+        job = GenerationJob.objects.create(
+            model_provider=provider, job_type='text2image', payload={}, status='running',
+            run_after=timezone.now(), locked_by='worker',
+        )
+        report = progress_reporter(job)
+
+        async def run():
+            await report({'type': 'progress', 'node': 's0_3', 'value': 1, 'max': 20, 'prompt_id': 'p'})
+            await report({'type': 'progress', 'node': 's0_3', 'value': 2, 'max': 20, 'prompt_id': 'p'})
+
+        async_to_sync(run)()
+        job.refresh_from_db()
+        self.assertEqual(job.progress, {'type': 'progress', 'node': 's0_3', 'value': 1, 'max': 20})
+
+    def test_history_errors_are_client_errors(self):
+        provider = ModelProvider(name='comfyui', provider_type='text2image', api_url='http://example.com')
+
+        def handler(request):
+            raise httpx.ConnectError('connection refused', request=request)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch.object(http_pool, 'get_client', return_value=client):
+            with self.assertRaises(AIClientError):
+                asyncio.run(ComfyUIClient(provider).fetch_history('prompt'))
+            with self.assertRaises(AIClientError):
+                asyncio.run(ComfyUIClient(provider).download({'filename': 'a.png'}))
+
+
+class BlobStoreTests(TestCase):
+    """内容寻址存储: 相同内容只落盘一次并计数引用, 引用归零时删除"""
+
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        settings_override = override_settings(STORAGE_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.store = BlobStore(root / 'blobs')
+
+    def test_identical_content_is_deduplicated(self):
+        first = self.store.put_bytes(b'frame', filename='a.png')
+        second = self.store.put_bytes(b'frame', filename='b.png')
+        self.assertEqual(first.sha256, second.sha256)
+        self.assertEqual(second.ref_count, 2)
+        self.assertEqual(MediaBlob.objects.get(sha256=first.sha256).ref_count, 2)
+        self.assertEqual(MediaBlob.objects.count(), 1)
+        sha256 = first.sha256
+        path = self.store.path(sha256)
+        self.assertEqual(path.relative_to(self.store.root).as_posix(), f'{sha256[:2]}/{sha256[2:4]}/{sha256}')
+        self.assertEqual(path.read_bytes(), b'frame')
+        self.assertEqual(first.size, 5)
+        self.assertEqual(first.mime_type, 'image/png')
+        # 临时文件已全部移走
+        self.assertEqual(list(self.store.tmp_dir.iterdir()), [])
+
+    def test_release_deletes_at_zero(self):
+        blob = self.store.put_bytes(b'frame')
+        self.store.put_bytes(b'frame')
+        self.assertFalse(self.store.release(blob.sha256))
+        self.assertEqual(MediaBlob.objects.get(sha256=blob.sha256).ref_count, 1)
+        self.assertTrue(self.store.exists(blob.sha256))
+        self.assertTrue(self.store.release(blob.sha256))
+        self.assertFalse(self.store.exists(blob.sha256))
+        self.assertFalse(MediaBlob.objects.filter(sha256=blob.sha256).exists())
+        self.assertFalse(self.store.release(blob.sha256))
+
+    def test_missing_file_is_rewritten(self):
+        blob = self.store.put_bytes(b'frame')
+        self.store.path(blob.sha256).unlink()
+        self.store.put_bytes(b'frame')
+        self.assertEqual(self.store.path(blob.sha256).read_bytes(), b'frame')
+
+    def test_signed_url(self):
+        blob = self.store.put_bytes(b'frame')
+        path, _, query = self.store.url(blob.sha256).partition('?')
+        self.assertEqual(path, f'/storage/blobs/{self.store.relative_path(blob.sha256)}')
+        self.assertEqual(query, f'sig={BlobStore.signature(blob.sha256)}')
+        self.assertNotEqual(BlobStore.signature(blob.sha256), BlobStore.signature('0' * 64))
+        # 存储目录不在 STORAGE_ROOT 下时没有可访问的URL
+        self.assertIsNone(BlobStore(Path(tempfile.gettempdir()) / 'elsewhere').url(blob.sha256))
+
+
+class StorageServingTests(TestCase):
+    """STORAGE_URL 只开放内容寻址文件和派生文件, 且需要登录或签名"""
+
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        settings_override = override_settings(STORAGE_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(blob_store, 'root', root / 'blobs')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blob = blob_store.put_bytes(b'hello', filename='a.txt')
+        (root / 'archives').mkdir()
+        (root / 'archives' / 'logs.jsonl').write_text('{}')
+        blob_store.tmp_dir.mkdir(parents=True, exist_ok=True)
+        (blob_store.tmp_dir / 'upload').write_text('partial')
+
+    def test_only_blob_paths_are_served(self):
+        self.assertEqual(self.client.get('/storage/archives/logs.jsonl').status_code, 404)
+        self.assertEqual(self.client.get('/storage/blobs/tmp/upload').status_code, 404)
+
+    def test_requires_signature_or_login(self):
+        url = blob_store.url(self.blob.sha256)
+        path = url.split('?', 1)[0]
+        self.assertEqual(self.client.get(path).status_code, 403)
+        self.assertEqual(self.client.get(path + '?sig=forged').status_code, 403)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'hello')
+        self.client.force_login(get_user_model().objects.create_user('tester', password='x'))
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_undecodable_source_is_unsupported(self):
+        blob = blob_store.put_bytes(b'not a png', mime_type='image/png')
+        signature = blob_store.signature(blob.sha256)
+        with mock.patch.object(derivative_cache, 'root', blob_store.root.parent / 'derivatives'):
+            response = self.client.get(f'/models/media/{blob.sha256}/thumb/?sig={signature}')
+        self.assertEqual(response.status_code, 415)
+
+    def test_range_requests(self):
+        url = blob_store.url(self.blob.sha256)
+        response = self.client.get(url, HTTP_RANGE='bytes=1-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1-3/5')
+        self.assertEqual(response['Content-Length'], '3')
+        self.assertEqual(b''.join(response.streaming_content), b'ell')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-2')
+        self.assertEqual(b''.join(response.streaming_content), b'lo')
+        response = self.client.get(url, HTTP_RANGE='bytes=3-')
+        self.assertEqual(response['Content-Range'], 'bytes 3-4/5')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=5-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */5')
+        # 无法识别的 Range 按整个文件返回
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1,3-4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'hello')
+
+    def test_if_range_and_etag(self):
+        url = blob_store.url(self.blob.sha256)
+        etag = f'"{self.blob.sha256}"'
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('immutable', response['Cache-Control'])
+        # ETag 不匹配时忽略 Range, 返回整个文件
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'hello')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_path_traversal_is_not_found(self):
+        blob_path = blob_store.url(self.blob.sha256).split('?', 1)[0]
+        self.client.force_login(get_user_model().objects.create_user('tester', password='x'))
+        self.assertEqual(self.client.get('/storage/blobs/../archives/logs.jsonl').status_code, 404)
+        self.assertEqual(self.client.get(blob_path.replace('/blobs/', '/blobs/../blobs/')).status_code, 404)
+
+        media_root = blob_store.root.parent / 'media'
+        media_root.mkdir()
+        (media_root / 'upload.txt').write_text('ok')
+        with override_settings(MEDIA_ROOT=media_root):
+            self.assertEqual(self.client.get('/media/upload.txt').status_code, 200)
+            self.assertEqual(self.client.get('/media/../archives/logs.jsonl').status_code, 404)
+            self.assertEqual(self.client.get('/media/%2e%2e/archives/logs.jsonl').status_code, 404)
@@ -1,13 +1,21 @@
 """模型管理URL路由"""
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ModelProviderViewSet, ModelUsageLogViewSet
+from .views import ModelProviderViewSet, ModelUsageLogViewSet, GenerationJobViewSet, UsageBudgetViewSet
+from .streaming import stream_generate
+from .media import serve_derivative
 
 # 创建路由器
 router = DefaultRouter()
 router.register(r'providers', ModelProviderViewSet, basename='model-provider')
 router.register(r'usage-logs', ModelUsageLogViewSet, basename='usage-log')
+router.register(r'jobs', GenerationJobViewSet, basename='generation-job')
+router.register(r'budgets', UsageBudgetViewSet, basename='usage-budget')
 
 urlpatterns = [
+    # 流式生成(ASGI异步视图, SSE)
+    path('providers/<uuid:pk>/stream/', stream_generate, name='model-provider-stream'),
+    # 缩略图/视频封面帧
+    path('media/<str:sha256>/<str:preset>/', serve_derivative, name='media-derivative'),
     path('', include(router.urls)),
 ]
@@ -0,0 +1,251 @@
+"""
+模型使用日志写缓冲
+职责: 在进程内收集使用日志, 由后台线程按批量大小或时间间隔 bulk_create 落库,
+让日志记录不再占用生成请求的耗时
+"""
+import atexit
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, close_old_connections, transaction
+
+from .budgets import budget_ledger, usage_cost
+from .circuit_breaker import circuit_breaker
+from .models import ModelUsageLog
+from .payloads import payload_store
+from .router import provider_router
+
+logger = logging.getLogger(__name__)
+
+
+class UsageLogBuffer:
+    """
+    使用日志写缓冲区
+
+    - record(): 只在内存中追加一条日志, 不访问数据库
+    - 达到 max_batch_size 或距上次落库超过 flush_interval 秒时由后台线程批量写入
+    - 进程退出时(atexit)自动 close(), 把剩余日志全部写入
+    - flush(): 立即同步落库, 供测试和关停流程使用
+
+    注意: bulk_create 会在落库时填充 created_at(auto_now_add),
+    因此 created_at 与实际调用时间最多相差 flush_interval 秒。
+    """
+
+    def __init__(self, max_batch_size: int = 100, flush_interval: float = 1.0, enabled: bool = True,
+                 max_retries: int = 3):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.max_retries = max_retries
+        self._pending: List[ModelUsageLog] = []
+        self._lock = threading.Lock()
+        # 保证同一时刻只有一个线程在落库, 避免批次乱序
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_registered = False
+
+    @classmethod
+    def from_settings(cls) -> 'UsageLogBuffer':
+        """根据 settings.USAGE_LOG_BUFFER 创建缓冲区"""
+        config = getattr(settings, 'USAGE_LOG_BUFFER', {})
+        return cls(
+            max_batch_size=config.get('MAX_BATCH_SIZE', 100),
+            flush_interval=config.get('FLUSH_INTERVAL', 1.0),
+            enabled=config.get('ENABLED', True),
+            max_retries=config.get('MAX_RETRIES', 3),
+        )
+
+    @staticmethod
+    def normalize(log: ModelUsageLog) -> None:
+        """
+        入队前把字段值转换成数据库类型, 一条非法的值不会在落库时连累整批日志
+
+        可为空的字段值非法时置空(并记录警告), 字符串超长时截断
+
+        Raises:
+            ValidationError: 不可为空的字段值非法
+        """
+        for field in log._meta.concrete_fields:
+            if field.primary_key or field.is_relation:
+                continue
+            value = getattr(log, field.attname)
+            if value is None:
+                continue
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                if not field.null:
+                    raise
+                logger.warning('使用日志字段 %s 的值非法, 已置空: %r', field.name, value)
+                value = None
+            if isinstance(value, str) and field.max_length and len(value) > field.max_length:
+                value = value[:field.max_length]
+            setattr(log, field.attname, value)
+
+    @staticmethod
+    def build(fields: Dict[str, Any]) -> ModelUsageLog:
+        """
+        创建日志实例, 转换字段值并计算费用
+        fields 中的 reservation(预算预留)由日志认领, 落库时与用量一起结算
+        """
+        fields = dict(fields)
+        reservation = fields.pop('reservation', None)
+        log = ModelUsageLog(**fields)
+        UsageLogBuffer.normalize(log)
+        if log.cost is None:
+            # 在数据外置之前计算, 需要完整的 response_data
+            log.cost = usage_cost(log)
+        if reservation is not None and reservation.claim():
+            log._budget_reservation = reservation
+        return log
+
+    @staticmethod
+    def observe(log: ModelUsageLog) -> None:
+        """
+        调用结果同步回报给路由器和熔断器, 不必等待落库
+        在日志入队之后回报, 熔断器由此写入的状态切换日志排在触发它的日志之后
+        """
+        provider_router.observe_log(log)
+        circuit_breaker.observe_log(log)
+
+    def record(self, **fields: Any) -> ModelUsageLog:
+        """
+        记录一条使用日志
+
+        Args:
+            fields: ModelUsageLog 字段, 如 model_provider/tokens_used/latency_ms/status;
+                reservation 为本次调用的预算预留(BudgetReservation)
+
+        Returns:
+            日志实例(缓冲模式下尚未落库)
+        """
+        log = self.build(fields)
+        if not self.enabled:
+            payload_store.save_log(log)
+            self.observe(log)
+            return log
+        self._ensure_worker()
+        with self._lock:
+            self._pending.append(log)
+            pending = len(self._pending)
+        self.observe(log)
+        if pending >= self.max_batch_size:
+            self._wakeup.set()
+        return log
+
+    def record_many(self, entries: List[Dict[str, Any]]) -> List[ModelUsageLog]:
+        """
+        一次写入一批使用日志(批量生成接口使用), 不经过缓冲, 一次 bulk_create 落库
+
+        Args:
+            entries: 每条日志的 ModelUsageLog 字段
+
+        Returns:
+            已落库的日志实例
+        """
+        logs = [self.build(fields) for fields in entries]
+        if logs:
+            self.write(logs, batch_size=len(logs))
+        for log in logs:
+            self.observe(log)
+        return logs
+
+    def pending_count(self) -> int:
+        """尚未落库的日志数量"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        立即把缓冲中的日志批量写入数据库
+
+        整批写入失败时改为逐条写入: 数据库暂时不可用(如 SQLite 的 database is locked)的日志放回缓冲,
+        下次落库时重试, 最多重试 max_retries 次; 其余写入失败的日志单独丢弃并记录错误
+
+        Returns:
+            写入的日志条数
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                self.write(batch, batch_size=self.max_batch_size)
+                return len(batch)
+            except Exception:
+                logger.warning('批量写入 %d 条模型使用日志失败, 改为逐条写入', len(batch), exc_info=True)
+            written = 0
+            retry = []
+            for log in batch:
+                try:
+                    self.write([log])
+                    written += 1
+                except OperationalError:
+                    log._write_attempts = getattr(log, '_write_attempts', 0) + 1
+                    if log._write_attempts <= self.max_retries:
+                        retry.append(log)
+                    else:
+                        logger.exception('写入模型使用日志 %s 失败(已重试 %d 次), 丢弃', log.pk, self.max_retries)
+                except Exception:
+                    logger.exception('写入模型使用日志 %s 失败, 丢弃', log.pk)
+            if retry:
+                with self._lock:
+                    self._pending[:0] = retry
+            return written
+
+    @staticmethod
+    def write(logs: List[ModelUsageLog], batch_size: Optional[int] = None) -> None:
+        """
+        批量插入日志, 并累加汇总表和预算账本(bulk_create 不触发 post_save)
+        三者在同一事务中, 失败时全部回滚, 可以原样重试
+        """
+        from .services import ModelUsageRollupService
+
+        with transaction.atomic():
+            payload_store.save_logs(logs, batch_size=batch_size)
+            ModelUsageRollupService.apply_logs(logs)
+            budget_ledger.apply_logs(logs)
+
+    def close(self) -> None:
+        """停止后台线程并写入剩余日志"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=max(self.flush_interval * 5, 5))
+        self.flush()
+
+    def _ensure_worker(self) -> None:
+        """按需启动后台落库线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='usage-log-buffer', daemon=True
+            )
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+
+    def _run(self) -> None:
+        """后台线程: 定时或被唤醒时落库"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+# 进程级共享的写缓冲
+usage_log_buffer = UsageLogBuffer.from_settings()
@@ -1,9 +1,15 @@
-from asgiref.sync import async_to_sync
-from rest_framework import viewsets, status
+import os
+import uuid
+from rest_framework import mixins, permissions, viewsets, status
 from rest_framework.response import Response
-from .models import ModelUsageLog,ModelProvider
+from .models import ModelUsageLog,ModelProvider,GenerationJob,UsageBudget
 from rest_framework.decorators import action
-from django.db.models import Value, CharField, IntegerField
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from django.db.models import Value, CharField, IntegerField, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
 from .serializers import (
     ModelProviderListSerializer,
     ModelProviderDetailSerializer,
@@ -11,9 +17,22 @@ from .serializers import (
     ModelProviderUpdateSerializer,
     ModelUsageLogSerializer,
     ModelProviderTestSerializer,
+    BatchGenerateSerializer,
     ModelProviderSimpleSerializer,
+    GenerationJobSerializer,
+    GenerationJobCreateSerializer,
+    UsageBudgetSerializer,
 )
-from .services import ModelProviderService
+from apps.projects.models import Project
+from core.ai_client.http_pool import http_pool
+from core.ai_client.registry import ExecutorImportError, executor_registry
+from .budgets import budget_ledger
+from .circuit_breaker import circuit_breaker, recent_transitions
+from .generation import GenerationService
+from .jobs import JobService
+from .pagination import UsageLogCursorPagination
+from .payloads import payload_store
+from .services import ModelProviderService, ModelProviderStatsService, ModelUsageRollupService
 class ModelProviderViewSet(viewsets.ModelViewSet):
     
     """
@@ -21,9 +40,33 @@ class ModelProviderViewSet(viewsets.ModelViewSet):
     提供模型使用日志的增删改查接口
     """
 
+    # 列表页"最近使用次数"的统计窗口
+    RECENT_USAGE_DAYS = 7
+
     def get_queryset(self):
         """获取所有模型提供商"""
-        return ModelProvider.objects.all().prefetch_related('usage_logs')
+        queryset = ModelProvider.objects.all()
+        if self.action == 'list':
+            # 用一条带条件聚合的查询从汇总表读取, 不扫描原始日志
+            recent_since = ModelUsageRollupService.truncate(
+                timezone.now() - timedelta(days=self.RECENT_USAGE_DAYS), 'hour'
+            )
+            # 只统计真实发往上游的调用(与 ModelProviderStatsService 一致)
+            upstream_calls = Q(usage_rollups__source='upstream') & ~Q(
+                usage_rollups__status__in=ModelUsageLog.LOCAL_STATUSES
+            )
+            queryset = queryset.annotate(
+                total_usage_count=Coalesce(Sum(
+                    'usage_rollups__request_count',
+                    filter=upstream_calls & Q(usage_rollups__granularity='day')
+                ), 0),
+                recent_usage_count=Coalesce(Sum(
+                    'usage_rollups__request_count',
+                    filter=upstream_calls & Q(usage_rollups__granularity='hour',
+                                              usage_rollups__bucket__gte=recent_since)
+                ), 0),
+            )
+        return queryset
     def get_serializer_class(self):
         """根据动作选择序列化器"""
         if(self.action=='list'):
@@ -43,7 +86,11 @@ class ModelProviderViewSet(viewsets.ModelViewSet):
         print(serializer.validated_data)
         provider=ModelProviderService.create_provider(serializer.validated_data)
         print(provider)
-        response_serializer=ModelProviderDetailSerializer(provider)
+        # 新建的提供商还没有调用日志, 无需再查询日志表
+        response_serializer=ModelProviderDetailSerializer(
+            provider,
+            context={'stats': ModelProviderStatsService.empty_stats()}
+        )
         return Response(
             response_serializer.data,
             status=status.HTTP_201_CREATED
@@ -81,8 +128,8 @@ class ModelProviderViewSet(viewsets.ModelViewSet):
             'Hello, this is a test.'
         )
 
-        # 异步测试转同步执行
-        result = async_to_sync(ModelProviderService.test_provider_connection)(
+        # 异步测试转同步执行, 在连接池的常驻事件循环中运行以复用连接
+        result = http_pool.async_to_sync(ModelProviderService.test_provider_connection)(
             str(instance.id),
             test_prompt
         )
@@ -103,7 +150,82 @@ class ModelProviderViewSet(viewsets.ModelViewSet):
                 'latency_ms': result.get('latency_ms', 0)
             }, status=status.HTTP_400_BAD_REQUEST)
 
-    
+    @action(detail=True, methods=['get'])
+    def circuit(self, request, pk=None):
+        """
+        熔断状态
+        GET /models/providers/{id}/circuit/
+
+        state/consecutive_failures/adaptive_timeout 为处理本请求的进程(pid)内的状态,
+        transitions 来自使用日志, 包含所有进程的状态切换
+        """
+        instance = self.get_object()
+        return Response({
+            'success': True,
+            'data': {
+                'pid': os.getpid(),
+                **circuit_breaker.snapshot(instance.id),
+                'configured_timeout': circuit_breaker.configured_timeout(instance),
+                'timeout': circuit_breaker.timeout_for(instance),
+                'transitions': [
+                    {'status': log_status, 'message': message, 'created_at': created_at}
+                    for log_status, message, created_at in recent_transitions(instance.id)
+                ],
+            }
+        })
+
+    @action(detail=True, methods=['post'])
+    def batch_generate(self, request, pk=None):
+        """
+        批量文本生成
+        POST /models/providers/{id}/batch_generate/
+        Body: {"prompts": ["...", "..."], "system_prompt": "...", "concurrency": 4, "pack_size": 5}
+
+        返回与 prompts 顺序一致的逐条结果, 部分失败时 HTTP 状态仍为200, 由每条的 success/error 区分
+        """
+        instance = self.get_object()
+        if instance.provider_type != 'llm' or not instance.is_active:
+            return Response({
+                'success': False,
+                'message': '只有已激活的LLM提供商支持批量生成'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            client = executor_registry.get_client(instance)
+        except ExecutorImportError as exc:
+            return Response({'success': False, 'message': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if not hasattr(client, 'chat_packed'):
+            return Response({
+                'success': False,
+                'message': f'{type(client).__name__} 不支持批量生成'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        serializer = BatchGenerateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        overrides = {field: data[field] for field in ('max_tokens', 'temperature') if field in data}
+        results = http_pool.async_to_sync(GenerationService.generate_batch)(
+            instance,
+            data['prompts'],
+            system_prompt=data['system_prompt'] or None,
+            concurrency=data.get('concurrency'),
+            pack_size=data.get('pack_size'),
+            project_id=data.get('project_id'),
+            stage_type=data.get('stage_type'),
+            user_id=request.user.id,
+            use_cache=data['use_cache'],
+            **overrides,
+        )
+        succeeded = sum(1 for item in results if item['success'])
+        return Response({
+            'success': succeeded == len(results),
+            'message': f'完成 {succeeded}/{len(results)} 条',
+            'data': {
+                'results': results,
+                'succeeded': succeeded,
+                'failed': len(results) - succeeded,
+                'tokens_used': sum(item['tokens_used'] for item in results if not item['cached']),
+            }
+        })
+
 
 class ModelUsageLogViewSet(viewsets.ModelViewSet):
     """
@@ -112,17 +234,215 @@ class ModelUsageLogViewSet(viewsets.ModelViewSet):
     """
     queryset = ModelUsageLog.objects.all()
     serializer_class = ModelUsageLogSerializer
+    pagination_class = UsageLogCursorPagination
+
+    def get_requested_fields(self):
+        """
+        解析 ?fields=id,status,latency_ms 投影参数
+        未传时返回 None, 输出全部字段
+        """
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        requested = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = set(requested) - set(ModelUsageLogSerializer.Meta.fields)
+        if unknown:
+            raise ValidationError({'fields': f"未知字段: {', '.join(sorted(unknown))}"})
+        return requested
+
+    def get_serializer(self, *args, **kwargs):
+        """把字段投影传给序列化器"""
+        if self.request is not None and self.request.method == 'GET':
+            kwargs.setdefault('fields', self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def parse_datetime_param(self, name):
+        """解析ISO格式的时间过滤参数"""
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValidationError({name: '时间格式无效, 请使用ISO 8601格式'})
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
 
     def get_queryset(self):
         """
         根据请求参数过滤查询集
-        支持按模型提供商ID和项目ID过滤
+        支持按模型提供商ID、项目ID、状态、阶段类型和时间范围过滤
+        (provider_id / project_id+stage_type 过滤命中已有的联合索引)
         """
-        queryset = super().get_queryset()
-        provider_id = self.request.query_params.get('provider_id')
-        project_id = self.request.query_params.get('project_id')
+        queryset = super().get_queryset().select_related('model_provider')
+        params = self.request.query_params
+        provider_id = params.get('provider_id')
+        project_id = params.get('project_id')
+        stage_type = params.get('stage_type')
+        user_id = params.get('user_id')
+        log_status = params.get('status')
         if provider_id:
             queryset = queryset.filter(model_provider_id=provider_id)
         if project_id:
             queryset = queryset.filter(project_id=project_id)
-        return queryset
\ No newline at end of file
+        if stage_type:
+            queryset = queryset.filter(stage_type=stage_type)
+        if user_id:
+            queryset = queryset.filter(user_id=user_id)
+        if log_status:
+            valid_statuses = [choice[0] for choice in ModelUsageLog.STATUS_CHOICES]
+            if log_status not in valid_statuses:
+                raise ValidationError({'status': f"状态必须是: {', '.join(valid_statuses)}"})
+            queryset = queryset.filter(status=log_status)
+        created_after = self.parse_datetime_param('created_after')
+        created_before = self.parse_datetime_param('created_before')
+        if created_after:
+            queryset = queryset.filter(created_at__gte=created_after)
+        if created_before:
+            queryset = queryset.filter(created_at__lt=created_before)
+
+        if self.request.method == 'GET':
+            requested = self.get_requested_fields()
+            if requested is not None:
+                skipped = [name for name in ModelUsageLogSerializer.HEAVY_FIELDS if name not in requested]
+                if skipped:
+                    queryset = queryset.defer(*skipped)
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        """详情接口返回完整的请求/响应数据(外置的数据在这里才加载)"""
+        instance = payload_store.hydrate(self.get_object())
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
+        """
+        用量汇总(读取预算账本中的累计计数, 不聚合原始日志)
+        GET /models/usage-logs/summary/?project_id=...&user_id=...
+        未指定时返回当前用户的汇总
+        """
+        params = request.query_params
+        project_id = params.get('project_id')
+        if project_id:
+            try:
+                project_id = uuid.UUID(project_id)
+            except ValueError:
+                raise ValidationError({'project_id': '项目ID格式无效'})
+        keys = budget_ledger.scope_keys(project_id, params.get('user_id'))
+        if not keys:
+            keys = budget_ledger.scope_keys(user_id=request.user.id)
+        if not all(can_view_budget(request.user, scope, scope_id) for scope, scope_id in keys):
+            raise PermissionDenied('只能查看自己和自己项目的用量')
+        condition = Q()
+        for scope, scope_id in keys:
+            condition |= Q(scope=scope, scope_id=scope_id)
+        existing = {(budget.scope, budget.scope_id): budget for budget in UsageBudget.objects.filter(condition)}
+        budgets = []
+        for scope, scope_id in keys:
+            budget = existing.get((scope, scope_id))
+            if budget is None:
+                # 还没有任何用量
+                budget = UsageBudget(id=None, scope=scope, scope_id=scope_id, **budget_ledger.defaults(scope))
+            budgets.append(budget)
+        return Response({
+            'success': True,
+            'data': UsageBudgetSerializer(budgets, many=True).data
+        })
+
+
+def visible_budgets(user) -> Q:
+    """非管理员能查看的账本: 自己的用户账本和自己项目的账本"""
+    if user.is_staff:
+        return Q()
+    project_ids = [str(pk) for pk in Project.objects.filter(user=user).values_list('pk', flat=True)]
+    return Q(scope='user', scope_id=str(user.id)) | Q(scope='project', scope_id__in=project_ids)
+
+
+def can_view_budget(user, scope: str, scope_id: str) -> bool:
+    """用户能否查看某个账本(账本可能还不存在)"""
+    if user.is_staff:
+        return True
+    if scope == 'user':
+        return scope_id == str(user.id)
+    return Project.objects.filter(pk=scope_id, user=user).exists()
+
+
+class UsageBudgetViewSet(viewsets.ModelViewSet):
+    """
+    使用预算视图集(设置额度需要管理员权限, 普通用户只能查看自己和自己项目的账本)
+    GET/POST          /models/budgets/        预算列表 / 为项目或用户设置额度
+    GET/PATCH/DELETE  /models/budgets/{id}/   查看 / 修改额度 / 删除(同时清空累计用量)
+    """
+    queryset = UsageBudget.objects.all().order_by('scope', 'scope_id')
+    serializer_class = UsageBudgetSerializer
+
+    def get_permissions(self):
+        if self.request.method in permissions.SAFE_METHODS:
+            return [permissions.IsAuthenticated()]
+        return [permissions.IsAdminUser()]
+
+    def get_queryset(self):
+        """只返回可查看的账本, 支持按范围过滤"""
+        queryset = super().get_queryset().filter(visible_budgets(self.request.user))
+        for param in ('scope', 'scope_id'):
+            value = self.request.query_params.get(param)
+            if value:
+                queryset = queryset.filter(**{param: value})
+        return queryset
+
+
+
+class GenerationJobViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.ListModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    生成任务视图集(只能访问自己提交的任务)
+    POST /models/jobs/               提交任务
+    GET  /models/jobs/{id}/          查询任务状态与结果
+    POST /models/jobs/{id}/cancel/   取消任务
+    """
+    queryset = GenerationJob.objects.select_related('model_provider')
+    serializer_class = GenerationJobSerializer
+
+    def get_queryset(self):
+        """只能访问自己提交的任务, 支持按状态、任务类型和项目ID过滤"""
+        queryset = super().get_queryset().filter(user_id=self.request.user.id)
+        params = self.request.query_params
+        for param, field in (('status', 'status'), ('job_type', 'job_type'), ('project_id', 'project_id')):
+            value = params.get(param)
+            if value:
+                queryset = queryset.filter(**{field: value})
+        return queryset
+
+    def create(self, request, *args, **kwargs):
+        """提交任务"""
+        serializer = GenerationJobCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        job = JobService.submit(
+            data['model_provider'],
+            data['payload'],
+            project_id=data.get('project_id'),
+            stage_type=data.get('stage_type'),
+            max_attempts=data.get('max_attempts'),
+            user_id=request.user.id,
+        )
+        return Response(GenerationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """取消任务"""
+        job = self.get_object()
+        if job.status in GenerationJob.FINISHED_STATUSES:
+            return Response({
+                'success': False,
+                'message': f'任务已{job.get_status_display()}, 无法取消'
+            }, status=status.HTTP_409_CONFLICT)
+        job = JobService.cancel(job)
+        return Response({
+            'success': True,
+            'message': '任务已取消' if job.status == 'cancelled' else '已请求取消, 任务将在当前步骤中止',
+            'data': GenerationJobSerializer(job).data
+        })
@@ -0,0 +1,8 @@
+"""故事项目应用配置"""
+from django.apps import AppConfig
+
+
+class ProjectsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'apps.projects'
+    verbose_name = '故事项目'
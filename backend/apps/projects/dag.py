@@ -0,0 +1,113 @@
+"""
+有向无环图执行器
+职责: 依赖全部完成的节点立即并发执行, 按资源池限制并发数; 节点执行期间可以动态追加新节点
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+NodeFunc = Callable[[], Awaitable[None]]
+
+
+class DAGNode:
+    """图中的一个节点"""
+
+    def __init__(self, key: str, func: Optional[NodeFunc], deps: Iterable[str] = (), pool: Optional[str] = None):
+        self.key = key
+        self.func = func
+        self.deps: Set[str] = set(deps)
+        self.pool = pool
+
+
+class DAGRunner:
+    """
+    DAG 执行器
+
+    用法:
+        dag = DAGRunner({'text2image': 4, 'image2video': 2})
+        dag.add('script', run_script)
+        dag.add('storyboard', run_storyboard, deps=['script'])
+        # run_storyboard 中可以继续 dag.add('scene:0:image', ..., deps=['storyboard'])
+        failed = await dag.run()
+
+    节点失败(抛出异常)后, 直接或间接依赖它的节点不会执行, 其余分支继续执行;
+    已完成的检查点用 dag.add(key, None) 登记, 不会被再次执行。
+    """
+
+    def __init__(self, pool_limits: Optional[Dict[str, int]] = None):
+        self.nodes: Dict[str, DAGNode] = {}
+        self.completed: Set[str] = set()
+        self.failed: Dict[str, BaseException] = {}
+        self.blocked: Set[str] = set()
+        self._semaphores = {pool: asyncio.Semaphore(max(limit, 1)) for pool, limit in (pool_limits or {}).items()}
+        self._running: Dict[asyncio.Task, str] = {}
+
+    def add(self, key: str, func: Optional[NodeFunc], deps: Iterable[str] = (), pool: Optional[str] = None) -> None:
+        """
+        添加节点
+
+        Args:
+            key: 节点键
+            func: 无参协程函数; 为 None 表示节点已完成(从检查点恢复)
+            deps: 依赖的节点键
+            pool: 资源池名称, 同一资源池中同时执行的节点数受 pool_limits 限制
+        """
+        if key in self.nodes:
+            raise ValueError(f'节点已存在: {key}')
+        self.nodes[key] = DAGNode(key, func, deps, pool)
+        if func is None:
+            self.completed.add(key)
+
+    def _ready(self) -> List[DAGNode]:
+        running = set(self._running.values())
+        finished = self.completed | set(self.failed) | self.blocked
+        ready = []
+        for node in self.nodes.values():
+            if node.key in finished or node.key in running:
+                continue
+            missing = node.deps - set(self.nodes)
+            if missing:
+                raise ValueError(f'节点 {node.key} 依赖不存在的节点: {", ".join(sorted(missing))}')
+            if node.deps & (set(self.failed) | self.blocked):
+                self.blocked.add(node.key)
+                continue
+            if node.deps <= self.completed:
+                ready.append(node)
+        return ready
+
+    async def _execute(self, node: DAGNode) -> None:
+        semaphore = self._semaphores.get(node.pool)
+        if semaphore is None:
+            await node.func()
+            return
+        async with semaphore:
+            await node.func()
+
+    async def run(self) -> Dict[str, BaseException]:
+        """
+        执行到没有可执行的节点为止
+
+        Returns:
+            失败的节点键 -> 异常
+        """
+        try:
+            while True:
+                for node in self._ready():
+                    self._running[asyncio.create_task(self._execute(node))] = node.key
+                if not self._running:
+                    return self.failed
+                done, _ = await asyncio.wait(list(self._running), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = self._running.pop(task)
+                    if task.cancelled():
+                        # 节点内部被取消(如下游调用取消), task.exception() 会抛出 CancelledError
+                        self.failed[key] = asyncio.CancelledError(f'节点 {key} 被取消')
+                    elif task.exception() is not None:
+                        self.failed[key] = task.exception()
+                    else:
+                        self.completed.add(key)
+        finally:
+            for task in self._running:
+                task.cancel()
+            if self._running:
+                await asyncio.gather(*self._running, return_exceptions=True)
+                self._running.clear()
@@ -0,0 +1,45 @@
+"""
+运行故事项目流水线worker
+用法:
+    python manage.py run_pipeline_worker                  # 常驻运行
+    python manage.py run_pipeline_worker --burst          # 处理完排队中的项目后退出
+    python manage.py run_pipeline_worker --concurrency 4
+"""
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from apps.models.usage_buffer import usage_log_buffer
+from apps.projects.pipeline import PipelineWorker
+
+
+class Command(BaseCommand):
+    help = '领取并执行排队中的故事项目流水线(剧本 -> 分镜 -> 场景图片 -> 场景视频)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help='同时执行的项目数')
+        parser.add_argument('--poll-interval', type=float, default=None, help='队列为空时的轮询间隔(秒)')
+        parser.add_argument('--lock-timeout', type=float, default=None, help='项目锁定时长(秒)')
+        parser.add_argument('--burst', action='store_true', help='没有排队中的项目时退出')
+
+    def handle(self, *args, **options):
+        worker = PipelineWorker(
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+            lock_timeout=options['lock_timeout'],
+        )
+        self.stdout.write(f'worker {worker.worker_id} 启动, 并发项目数 {worker.concurrency}')
+        processed = asyncio.run(self._run(worker, options['burst']))
+        usage_log_buffer.flush()
+        self.stdout.write(self.style.SUCCESS(f'worker 退出, 共处理 {processed} 个项目'))
+
+    async def _run(self, worker, burst):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, worker.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows 不支持 add_signal_handler
+                pass
+        return await worker.run(burst=burst)
@@ -0,0 +1,108 @@
+# Generated by Django 5.2.9 on 2026-10-17 20:45
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Project',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200, verbose_name='项目名称')),
+                ('story_idea', models.TextField(verbose_name='故事创意')),
+                ('config', models.JSONField(blank=True, default=dict, verbose_name='生成配置')),
+                ('status', models.CharField(choices=[('draft', '草稿'), ('queued', '排队中'), ('running', '生成中'), ('completed', '已完成'), ('failed', '失败'), ('cancelled', '已取消')], default='draft', max_length=20, verbose_name='状态')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='错误信息')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='是否请求取消')),
+                ('locked_by', models.CharField(blank=True, max_length=255, null=True, verbose_name='执行worker')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='锁定截止时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='projects', to=settings.AUTH_USER_MODEL, verbose_name='所属用户')),
+            ],
+            options={
+                'verbose_name': '故事项目',
+                'verbose_name_plural': '故事项目',
+                'db_table': 'projects',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProjectStage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage_type', models.CharField(choices=[('script', '剧本'), ('storyboard', '分镜'), ('scene_images', '场景图片'), ('scene_videos', '场景视频')], max_length=50, verbose_name='阶段类型')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('running', '执行中'), ('completed', '已完成'), ('failed', '失败')], default='pending', max_length=20, verbose_name='状态')),
+                ('output', models.JSONField(blank=True, default=dict, verbose_name='阶段产出')),
+                ('input_hash', models.CharField(blank=True, max_length=64, null=True, verbose_name='输入指纹')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='错误信息')),
+                ('attempts', models.IntegerField(default=0, verbose_name='执行次数')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='projects.project', verbose_name='项目')),
+            ],
+            options={
+                'verbose_name': '项目阶段',
+                'verbose_name_plural': '项目阶段',
+                'db_table': 'project_stages',
+            },
+        ),
+        migrations.CreateModel(
+            name='Scene',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField(verbose_name='场景序号')),
+                ('description', models.TextField(blank=True, default='', verbose_name='场景描述')),
+                ('image_prompt', models.TextField(blank=True, default='', verbose_name='图片提示词')),
+                ('video_prompt', models.TextField(blank=True, default='', verbose_name='视频提示词')),
+                ('duration', models.FloatField(default=5.0, verbose_name='时长(秒)')),
+                ('image_status', models.CharField(choices=[('pending', '等待中'), ('running', '执行中'), ('completed', '已完成'), ('failed', '失败')], default='pending', max_length=20, verbose_name='图片状态')),
+                ('image_result', models.JSONField(blank=True, null=True, verbose_name='图片结果')),
+                ('image_attempts', models.IntegerField(default=0, verbose_name='图片执行次数')),
+                ('image_input_hash', models.CharField(blank=True, max_length=64, null=True, verbose_name='图片输入指纹')),
+                ('video_status', models.CharField(choices=[('pending', '等待中'), ('running', '执行中'), ('completed', '已完成'), ('failed', '失败')], default='pending', max_length=20, verbose_name='视频状态')),
+                ('video_result', models.JSONField(blank=True, null=True, verbose_name='视频结果')),
+                ('video_attempts', models.IntegerField(default=0, verbose_name='视频执行次数')),
+                ('video_input_hash', models.CharField(blank=True, max_length=64, null=True, verbose_name='视频输入指纹')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='错误信息')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scenes', to='projects.project', verbose_name='项目')),
+            ],
+            options={
+                'verbose_name': '分镜场景',
+                'verbose_name_plural': '分镜场景',
+                'db_table': 'project_scenes',
+                'ordering': ['project', 'index'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='project',
+            index=models.Index(fields=['user', '-created_at'], name='projects_user_id_58d805_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='project',
+            index=models.Index(fields=['status', 'locked_until'], name='projects_status_197256_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='projectstage',
+            unique_together={('project', 'stage_type')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='scene',
+            unique_together={('project', 'index')},
+        ),
+    ]
@@ -0,0 +1,129 @@
+import uuid
+from django.conf import settings
+from django.db import models
+
+
+class Project(models.Model):
+    """
+    故事项目
+    职责: 保存故事创意和生成配置, 以及流水线(剧本 -> 分镜 -> 场景图片 -> 场景视频)的整体执行状态
+    """
+    STATUS_CHOICES = [
+        ('draft', '草稿'),
+        ('queued', '排队中'),
+        ('running', '生成中'),
+        ('completed', '已完成'),
+        ('failed', '失败'),
+        ('cancelled', '已取消'),
+    ]
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='projects', verbose_name="所属用户"
+    )
+    name = models.CharField(max_length=200, verbose_name="项目名称")
+    story_idea = models.TextField(verbose_name="故事创意")
+    # 生成配置, 如 {"scene_count": 8, "style": "水彩", "width": 1024, "height": 576}
+    config = models.JSONField(default=dict, blank=True, verbose_name="生成配置")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='draft', verbose_name="状态")
+    error_message = models.TextField(null=True, blank=True, verbose_name="错误信息")
+
+    # 流水线执行
+    cancel_requested = models.BooleanField(default=False, verbose_name="是否请求取消")
+    locked_by = models.CharField(max_length=255, null=True, blank=True, verbose_name="执行worker")
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name="锁定截止时间")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="结束时间")
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = 'projects'
+        verbose_name = '故事项目'
+        verbose_name_plural = '故事项目'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+            models.Index(fields=['status', 'locked_until']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.get_status_display()})'
+
+
+class ProjectStage(models.Model):
+    """
+    项目阶段
+    职责: 记录每个阶段的执行状态和产出(检查点), 流水线恢复时跳过已完成的阶段
+    """
+    STAGE_TYPES = [
+        ('script', '剧本'),
+        ('storyboard', '分镜'),
+        ('scene_images', '场景图片'),
+        ('scene_videos', '场景视频'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', '等待中'),
+        ('running', '执行中'),
+        ('completed', '已完成'),
+        ('failed', '失败'),
+    ]
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='stages', verbose_name="项目")
+    stage_type = models.CharField(max_length=50, choices=STAGE_TYPES, verbose_name="阶段类型")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="状态")
+    output = models.JSONField(default=dict, blank=True, verbose_name="阶段产出")
+    # 输入指纹(提示词、提供商配置和上游产出的哈希), 未变化时直接复用产出
+    input_hash = models.CharField(max_length=64, null=True, blank=True, verbose_name="输入指纹")
+    error_message = models.TextField(null=True, blank=True, verbose_name="错误信息")
+    attempts = models.IntegerField(default=0, verbose_name="执行次数")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="结束时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = 'project_stages'
+        verbose_name = '项目阶段'
+        verbose_name_plural = '项目阶段'
+        unique_together = [('project', 'stage_type')]
+
+    def __str__(self):
+        return f'{self.project_id} - {self.get_stage_type_display()} ({self.get_status_display()})'
+
+
+class Scene(models.Model):
+    """
+    分镜场景
+    职责: 保存分镜生成的场景描述, 以及该场景图片、视频各自的执行状态和结果(场景级检查点)
+    """
+    STATUS_CHOICES = ProjectStage.STATUS_CHOICES
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='scenes', verbose_name="项目")
+    index = models.IntegerField(verbose_name="场景序号")
+    description = models.TextField(blank=True, default='', verbose_name="场景描述")
+    image_prompt = models.TextField(blank=True, default='', verbose_name="图片提示词")
+    video_prompt = models.TextField(blank=True, default='', verbose_name="视频提示词")
+    duration = models.FloatField(default=5.0, verbose_name="时长(秒)")
+
+    image_status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="图片状态")
+    image_result = models.JSONField(null=True, blank=True, verbose_name="图片结果")
+    image_attempts = models.IntegerField(default=0, verbose_name="图片执行次数")
+    image_input_hash = models.CharField(max_length=64, null=True, blank=True, verbose_name="图片输入指纹")
+    video_status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="视频状态")
+    video_result = models.JSONField(null=True, blank=True, verbose_name="视频结果")
+    video_attempts = models.IntegerField(default=0, verbose_name="视频执行次数")
+    video_input_hash = models.CharField(max_length=64, null=True, blank=True, verbose_name="视频输入指纹")
+    error_message = models.TextField(null=True, blank=True, verbose_name="错误信息")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = 'project_scenes'
+        verbose_name = '分镜场景'
+        verbose_name_plural = '分镜场景'
+        ordering = ['project', 'index']
+        unique_together = [('project', 'index')]
+
+    def __str__(self):
+        return f'{self.project_id} - 场景{self.index}'
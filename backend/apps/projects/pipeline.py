@@ -0,0 +1,658 @@
+"""
+故事项目生成流水线
+剧本 -> 分镜 -> 各场景图片 -> 各场景视频, 以 DAG 方式执行:
+场景之间相互独立, 场景视频只依赖本场景的图片, 图片/视频按提供商类型限制并发;
+每个阶段、每个场景完成后立即保存检查点和输入指纹(提示词 + 提供商配置 + 上游产出的哈希),
+重新运行时指纹未变化的节点直接复用已有产出, 只有修改过的部分及其下游会重新生成
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import uuid
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.models.budgets import BudgetExceededError
+from apps.models.generation import GenerationService
+from apps.models.models import ModelProvider
+from apps.models.provider_cache import provider_cache
+from apps.models.router import NoAvailableProviderError, provider_router
+from apps.models.usage_buffer import usage_log_buffer
+from core.ai_client.base import AIClientError
+from core.ai_client.fingerprint import normalize_params
+
+from .dag import DAGRunner
+from .models import Project, ProjectStage, Scene
+
+logger = logging.getLogger(__name__)
+
+STAGE_ORDER = [stage_type for stage_type, _ in ProjectStage.STAGE_TYPES]
+# 只影响调度、不影响产出的 extra_config 键, 不计入输入指纹
+RUNTIME_CONFIG_KEYS = frozenset({'max_concurrency', 'execution_timeout', 'batch_size', 'pricing'})
+
+SCRIPT_SYSTEM_PROMPT = (
+    '你是一名专业编剧。根据用户给出的故事创意写出完整的短片剧本, '
+    '按场景分段, 每个场景包含地点、人物、动作和画面描述。'
+)
+STORYBOARD_SYSTEM_PROMPT = (
+    '你是一名分镜师。把剧本拆分为分镜场景, 只输出JSON数组, 不要输出其他内容。'
+    '数组中每个元素包含: description(场景描述), image_prompt(用于文生图的画面提示词), '
+    'video_prompt(用于图生视频的镜头运动和动作描述), duration(时长, 秒)。'
+)
+
+
+def get_pipeline_settings() -> Dict[str, Any]:
+    """settings.PROJECT_PIPELINE 与默认值合并后的配置"""
+    config = {
+        'SCENE_COUNT': 8,
+        'MAX_PARALLEL': {'text2image': 4, 'image2video': 2},
+        'MAX_ATTEMPTS': 3,
+        'RETRY_BACKOFF': 2,
+        'RATE_LIMIT_WAIT': 30.0,
+        'LOCK_TIMEOUT': 300,
+        'POLL_INTERVAL': 2.0,
+        'WORKER_CONCURRENCY': 2,
+    }
+    config.update(getattr(settings, 'PROJECT_PIPELINE', {}))
+    return config
+
+
+class PipelineError(Exception):
+    """流水线节点执行失败"""
+
+
+def provider_signature(provider: Optional[ModelProvider]) -> Optional[Dict[str, Any]]:
+    """
+    提供商中影响产出的配置, 提供商已删除或停用时返回 None
+    生成参数与请求指纹(request_fingerprint)一样先规范化, 空值和浮点精度差异不会改变指纹
+    """
+    if provider is None or not provider.is_active:
+        return None
+    extra_config = provider.extra_config or {}
+    return {
+        'id': str(provider.id),
+        'api_url': provider.api_url,
+        'model_name': provider.model_name,
+        'executor_class': provider.executor_class,
+        'params': normalize_params({
+            field: getattr(provider, field) for field in ('max_tokens', 'temperature', 'top_p')
+        }),
+        'extra_config': normalize_params(
+            {key: value for key, value in extra_config.items() if key not in RUNTIME_CONFIG_KEYS}
+        ),
+    }
+
+
+def input_fingerprint(provider: Optional[ModelProvider], inputs: Dict[str, Any]) -> str:
+    """
+    节点输入指纹
+
+    Args:
+        provider: 生成(或将要生成)产出的提供商
+        inputs: 提示词、生成参数和上游产出
+
+    Returns:
+        SHA-256 十六进制串
+    """
+    material = json.dumps(
+        [provider_signature(provider), inputs],
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'), cls=DjangoJSONEncoder,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class PipelineService:
+    """
+    流水线状态服务
+    职责: 排队、领取、续期、结束和取消项目流水线, 以及读写阶段/场景检查点
+    """
+
+    @staticmethod
+    def start(project: Project, from_stage: Optional[str] = None) -> bool:
+        """
+        把项目放入流水线队列
+        失败或执行中断的阶段/场景重置为等待中; 已完成的保持不变, 执行时按输入指纹决定复用还是重新生成;
+        指定 from_stage 时该阶段及其后的阶段无论指纹是否变化都重新生成
+
+        Returns:
+            是否已排队(项目已在排队或执行中时返回 False)
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            updated = Project.objects.filter(pk=project.pk).exclude(status__in=Project.ACTIVE_STATUSES).update(
+                status='queued', cancel_requested=False, error_message=None, locked_by=None, locked_until=None,
+                finished_at=None, updated_at=now,
+            )
+            if not updated:
+                return False
+            for stage_type in STAGE_ORDER:
+                ProjectStage.objects.get_or_create(project=project, stage_type=stage_type)
+            stages = ProjectStage.objects.filter(project=project)
+            scenes = Scene.objects.filter(project=project)
+            stages.filter(status__in=['failed', 'running']).update(status='pending', error_message=None)
+            scenes.filter(image_status__in=['failed', 'running']).update(image_status='pending', error_message=None)
+            scenes.filter(video_status__in=['failed', 'running']).update(video_status='pending', error_message=None)
+            if from_stage:
+                reset = STAGE_ORDER[STAGE_ORDER.index(from_stage):]
+                stages.filter(stage_type__in=reset).update(
+                    status='pending', output={}, input_hash=None, error_message=None, attempts=0,
+                )
+                if 'storyboard' in reset:
+                    scenes.delete()
+                elif 'scene_images' in reset:
+                    scenes.update(
+                        image_status='pending', image_result=None, image_input_hash=None,
+                        video_status='pending', video_result=None, video_input_hash=None,
+                    )
+                else:
+                    scenes.update(video_status='pending', video_result=None, video_input_hash=None)
+        project.refresh_from_db()
+        return True
+
+    @staticmethod
+    def cancel(project: Project) -> Project:
+        """排队中的项目直接取消; 执行中的项目标记 cancel_requested, 由 worker 在下次续期时中止"""
+        now = timezone.now()
+        updated = Project.objects.filter(pk=project.pk, status='queued').update(
+            status='cancelled', finished_at=now, updated_at=now,
+        )
+        if not updated:
+            Project.objects.filter(pk=project.pk, status='running').update(cancel_requested=True, updated_at=now)
+        project.refresh_from_db()
+        return project
+
+    @staticmethod
+    def claim(worker_id: str, limit: int, lock_timeout: float) -> List[Project]:
+        """领取排队中的项目, 以及锁已过期(worker 崩溃)的执行中项目"""
+        now = timezone.now()
+        candidates = list(
+            Project.objects.filter(
+                Q(status='queued') | Q(status='running', locked_until__lt=now)
+            ).order_by('updated_at')[:limit]
+        )
+        claimed = []
+        for project in candidates:
+            locked_until = now + timedelta(seconds=lock_timeout)
+            updated = Project.objects.filter(
+                pk=project.pk, status=project.status, locked_until=project.locked_until,
+            ).update(
+                status='running', locked_by=worker_id, locked_until=locked_until,
+                started_at=project.started_at or now, updated_at=now,
+            )
+            if updated:
+                project.status, project.locked_by, project.locked_until = 'running', worker_id, locked_until
+                claimed.append(project)
+        return claimed
+
+    @staticmethod
+    def has_queued() -> bool:
+        return Project.objects.filter(status='queued').exists()
+
+    @staticmethod
+    def heartbeat(project_id, worker_id: str, lock_timeout: float) -> bool:
+        """
+        续期项目锁
+
+        Returns:
+            是否应该继续执行(被取消或锁已被其他 worker 接管时返回 False)
+        """
+        now = timezone.now()
+        updated = Project.objects.filter(
+            pk=project_id, status='running', locked_by=worker_id, cancel_requested=False,
+        ).update(locked_until=now + timedelta(seconds=lock_timeout), updated_at=now)
+        return bool(updated)
+
+    @staticmethod
+    def finish(project_id, worker_id: str, status: str, error_message: Optional[str] = None) -> None:
+        now = timezone.now()
+        Project.objects.filter(pk=project_id, status='running', locked_by=worker_id).update(
+            status=status, error_message=error_message, locked_by=None, locked_until=None,
+            finished_at=now, updated_at=now,
+        )
+
+    @staticmethod
+    def load(project_id) -> Tuple[Dict[str, ProjectStage], List[Scene]]:
+        stages = {stage.stage_type: stage for stage in ProjectStage.objects.filter(project_id=project_id)}
+        return stages, list(Scene.objects.filter(project_id=project_id).order_by('index'))
+
+    @staticmethod
+    def update_stage(project_id, stage_type: str, **fields) -> None:
+        ProjectStage.objects.filter(project_id=project_id, stage_type=stage_type).update(
+            updated_at=timezone.now(), **fields
+        )
+
+    @staticmethod
+    def update_scene(scene_id, **fields) -> None:
+        Scene.objects.filter(pk=scene_id).update(updated_at=timezone.now(), **fields)
+
+    @staticmethod
+    def sync_scenes(project_id, items: List[Dict[str, Any]]) -> List[Scene]:
+        """
+        用分镜结果更新项目的场景
+        按序号原地更新已有场景(保留其产出和指纹, 提示词未变化的场景可以直接复用), 删除多余的场景
+        """
+        with transaction.atomic():
+            existing = {scene.index: scene for scene in Scene.objects.filter(project_id=project_id)}
+            Scene.objects.filter(project_id=project_id, index__gte=len(items)).delete()
+            scenes = []
+            for index, item in enumerate(items):
+                fields = {
+                    'description': str(item.get('description', '')),
+                    'image_prompt': str(item.get('image_prompt') or item.get('description', '')),
+                    'video_prompt': str(item.get('video_prompt', '')),
+                    'duration': float(item.get('duration') or 5.0),
+                }
+                scene = existing.get(index)
+                if scene is None:
+                    scene = Scene.objects.create(project_id=project_id, index=index, **fields)
+                elif any(getattr(scene, field) != value for field, value in fields.items()):
+                    for field, value in fields.items():
+                        setattr(scene, field, value)
+                    scene.save(update_fields=[*fields, 'updated_at'])
+                scenes.append(scene)
+            return scenes
+
+    @staticmethod
+    def summarize_scene_stages(project_id, reuse_stats: Optional[Dict[str, Dict[str, int]]] = None) -> None:
+        """
+        根据各场景状态更新 scene_images / scene_videos 两个阶段的汇总状态
+
+        Args:
+            reuse_stats: 本次执行中各阶段 {"reused": 复用数, "executed": 重新生成数}
+        """
+        reuse_stats = reuse_stats or {}
+        scenes = list(Scene.objects.filter(project_id=project_id).values_list('image_status', 'video_status'))
+        now = timezone.now()
+        for stage_type, position in (('scene_images', 0), ('scene_videos', 1)):
+            statuses = [scene[position] for scene in scenes]
+            counts = {status: statuses.count(status) for status in set(statuses)}
+            if not statuses:
+                status = 'pending'
+            elif counts.get('completed', 0) == len(statuses):
+                status = 'completed'
+            elif counts.get('failed'):
+                status = 'failed'
+            else:
+                status = 'pending'
+            ProjectStage.objects.filter(project_id=project_id, stage_type=stage_type).update(
+                status=status, output={'total': len(statuses), **counts, **reuse_stats.get(stage_type, {})},
+                finished_at=now if status == 'completed' else None, updated_at=now,
+            )
+
+
+def parse_storyboard(content: str, limit: int) -> List[Dict[str, Any]]:
+    """从LLM输出中解析分镜JSON数组(容忍代码块包裹或 {"scenes": [...]} 形式)"""
+    match = re.search(r'```(?:json)?\s*(.*?)```', content, re.S)
+    text = match.group(1) if match else content
+    start = min([index for index in (text.find('['), text.find('{')) if index >= 0], default=-1)
+    if start < 0:
+        raise PipelineError('分镜结果不是JSON')
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text[start:])
+    except ValueError as exc:
+        raise PipelineError(f'分镜结果不是有效的JSON: {exc}') from exc
+    if isinstance(data, dict):
+        data = data.get('scenes', [])
+    scenes = [item for item in data if isinstance(item, dict)] if isinstance(data, list) else []
+    if not scenes:
+        raise PipelineError('分镜结果中没有场景')
+    return scenes[:limit]
+
+
+def primary_output(result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    取执行器结果中的第一个输出文件
+    兼容 ComfyUIClient 的 {"scenes": [[{...}]]} 和直接返回 {"url"/"sha256"/"path"} 的执行器
+    """
+    if not result:
+        return {}
+    for scene_files in result.get('scenes') or []:
+        if scene_files:
+            return scene_files[0]
+    return {key: result[key] for key in ('sha256', 'url', 'path') if key in result}
+
+
+class PipelineExecutor:
+    """
+    单个项目的流水线执行器
+
+    节点:
+        script -> storyboard -> scene:<i>:image -> scene:<i>:video
+    场景节点在分镜完成(或复用)后动态加入 DAG。每个节点执行前先计算输入指纹:
+    已完成且指纹与上次相同的节点直接复用产出并记一条 source='reused' 的使用日志;
+    重新生成的节点产出变化后, 下游节点的指纹随之变化, 也会重新生成
+    """
+
+    def __init__(self, project: Project, config: Optional[Dict[str, Any]] = None):
+        self.project = project
+        self.config = config or get_pipeline_settings()
+        self.dag = DAGRunner(self.config['MAX_PARALLEL'])
+        self.stages: Dict[str, ProjectStage] = {}
+        self.scenes: List[Scene] = []
+        self.reuse_stats = {stage_type: {'reused': 0, 'executed': 0} for stage_type in STAGE_ORDER}
+
+    @property
+    def project_config(self) -> Dict[str, Any]:
+        return self.project.config or {}
+
+    async def run(self) -> Tuple[str, Optional[str]]:
+        """
+        执行流水线
+
+        Returns:
+            (项目最终状态, 错误信息)
+        """
+        self.stages, self.scenes = await sync_to_async(PipelineService.load)(self.project.pk)
+        self.dag.add('script', self.run_script)
+        self.dag.add('storyboard', self.run_storyboard, deps=['script'])
+        try:
+            failed = await self.dag.run()
+        finally:
+            await sync_to_async(PipelineService.summarize_scene_stages)(self.project.pk, self.reuse_stats)
+        logger.info('项目 %s 流水线结束, 复用/重新生成: %s', self.project.pk, self.reuse_stats)
+        if failed:
+            errors = [f'{key}: {exc}' for key, exc in list(failed.items())[:5]]
+            return 'failed', '; '.join(errors)
+        return 'completed', None
+
+    def add_scene_nodes(self, scene: Scene) -> None:
+        image_key = f'scene:{scene.index}:image'
+        self.dag.add(image_key, lambda: self.run_scene_image(scene), deps=['storyboard'], pool='text2image')
+        self.dag.add(
+            f'scene:{scene.index}:video', lambda: self.run_scene_video(scene), deps=[image_key], pool='image2video',
+        )
+
+    async def reuse(self, status: str, input_hash: Optional[str], output: Optional[Dict[str, Any]],
+                    inputs: Dict[str, Any], stage_type: str) -> bool:
+        """
+        已完成的节点在输入指纹未变化时复用产出, 并记录一条复用日志
+
+        Args:
+            status/input_hash/output: 节点的检查点, output 中记录了生成产出的 provider_id
+            inputs: 本次的节点输入
+            stage_type: 写入使用日志的阶段类型
+
+        Returns:
+            是否复用
+        """
+        if status != 'completed' or not input_hash or not output or not output.get('provider_id'):
+            return False
+        provider = await provider_cache.aget(output['provider_id'])
+        if input_fingerprint(provider, inputs) != input_hash:
+            return False
+        self.reuse_stats[stage_type]['reused'] += 1
+        await sync_to_async(usage_log_buffer.record)(
+            model_provider=provider, request_data={'input_hash': input_hash}, response_data={},
+            tokens_used=0, latency_ms=0, status='success', source='reused',
+            project_id=self.project.pk, stage_type=stage_type, user_id=self.project.user_id,
+        )
+        return True
+
+    async def call_with_retries(self, provider_type: str, call: Callable[[Any], Awaitable[Dict[str, Any]]]
+                                ) -> Tuple[ModelProvider, Dict[str, Any]]:
+        """
+        选择提供商并调用, 失败时换一个提供商重试(只有一个提供商时重试同一个)
+
+        Returns:
+            (实际产出结果的提供商, 调用结果)
+
+        Raises:
+            PipelineError: 达到最大次数或没有可用提供商
+        """
+        exclude: List[str] = []
+        last_error = None
+        for attempt in range(self.config['MAX_ATTEMPTS']):
+            if attempt:
+                await asyncio.sleep(self.config['RETRY_BACKOFF'] * 2 ** (attempt - 1))
+            providers = await sync_to_async(provider_router.get_providers)(provider_type)
+            if not {str(provider.id) for provider in providers} - set(exclude):
+                # 所有提供商都失败过时不再排除
+                exclude = []
+            try:
+                # 调用期间计入提供商的并发数, least_outstanding 策略据此分配
+                async with provider_router.aacquire(provider_type, exclude=exclude) as provider:
+                    try:
+                        return provider, await call(provider)
+                    except BudgetExceededError as exc:
+                        # 换提供商或重试都不会改变预算
+                        raise PipelineError(str(exc)) from exc
+                    except AIClientError as exc:
+                        last_error = exc
+                        exclude.append(str(provider.id))
+                        logger.warning(
+                            '项目 %s 调用 %s 失败(第%d次): %s', self.project.pk, provider.name, attempt + 1, exc,
+                        )
+            except NoAvailableProviderError as exc:
+                raise PipelineError(f'没有可用的 {provider_type} 模型提供商') from exc
+        raise PipelineError(str(last_error))
+
+    async def _run_stage(self, stage_type: str, provider_type: str, inputs: Dict[str, Any],
+                         func: Callable[[ModelProvider], Awaitable[Dict[str, Any]]]) -> bool:
+        """
+        执行一个项目级阶段并保存检查点
+
+        Returns:
+            是否复用了已有产出
+        """
+        stage = self.stages[stage_type]
+        if await self.reuse(stage.status, stage.input_hash, stage.output, inputs, stage_type):
+            return True
+        stage.attempts += 1
+        await sync_to_async(PipelineService.update_stage)(
+            self.project.pk, stage_type, status='running', attempts=stage.attempts, started_at=timezone.now(),
+            error_message=None,
+        )
+        try:
+            provider, output = await self.call_with_retries(provider_type, func)
+        except Exception as exc:
+            stage.status = 'failed'
+            await sync_to_async(PipelineService.update_stage)(
+                self.project.pk, stage_type, status='failed', error_message=str(exc),
+            )
+            raise
+        output['provider_id'] = str(provider.id)
+        input_hash = input_fingerprint(provider, inputs)
+        stage.status, stage.output, stage.input_hash = 'completed', output, input_hash
+        self.reuse_stats[stage_type]['executed'] += 1
+        await sync_to_async(PipelineService.update_stage)(
+            self.project.pk, stage_type, status='completed', output=output, input_hash=input_hash,
+            finished_at=timezone.now(),
+        )
+        return False
+
+    def llm_call(self, prompt: str, system_prompt: str, stage_type: str):
+        return lambda provider: GenerationService.generate_text(
+            provider, prompt, system_prompt=system_prompt, project_id=self.project.pk,
+            stage_type=stage_type, user_id=self.project.user_id, max_wait=self.config['RATE_LIMIT_WAIT'],
+        )
+
+    async def run_script(self) -> None:
+        prompt = f'故事创意: {self.project.story_idea}'
+        if self.project_config.get('style'):
+            prompt += f"\n风格: {self.project_config['style']}"
+        call = self.llm_call(prompt, SCRIPT_SYSTEM_PROMPT, 'script')
+
+        async def generate(provider: ModelProvider) -> Dict[str, Any]:
+            result = await call(provider)
+            return {'script': result['content'], 'tokens_used': result['tokens_used']}
+
+        await self._run_stage('script', 'llm', {'system_prompt': SCRIPT_SYSTEM_PROMPT, 'prompt': prompt}, generate)
+
+    async def run_storyboard(self) -> None:
+        scene_count = int(self.project_config.get('scene_count', self.config['SCENE_COUNT']))
+        script = self.stages['script'].output.get('script', '')
+        prompt = f'请把下面的剧本拆分为不超过 {scene_count} 个分镜场景:\n\n{script}'
+        call = self.llm_call(prompt, STORYBOARD_SYSTEM_PROMPT, 'storyboard')
+
+        async def generate(provider: ModelProvider) -> Dict[str, Any]:
+            result = await call(provider)
+            items = parse_storyboard(result['content'], scene_count)
+            self.scenes = await sync_to_async(PipelineService.sync_scenes)(self.project.pk, items)
+            return {'scene_count': len(self.scenes), 'tokens_used': result['tokens_used']}
+
+        inputs = {'system_prompt': STORYBOARD_SYSTEM_PROMPT, 'prompt': prompt}
+        await self._run_stage('storyboard', 'llm', inputs, generate)
+        for scene in self.scenes:
+            self.add_scene_nodes(scene)
+
+    def media_payload(self, scene: Scene, prompt: str) -> Dict[str, Any]:
+        payload = {
+            'prompt': prompt,
+            'project_id': str(self.project.pk),
+            'scene_index': scene.index,
+        }
+        if self.project_config.get('style'):
+            payload['prompt'] = f"{self.project_config['style']}, {prompt}"
+        for key in ('width', 'height', 'negative_prompt'):
+            if key in self.project_config:
+                payload[key] = self.project_config[key]
+        return payload
+
+    async def _run_scene_step(self, scene: Scene, kind: str, provider_type: str, payload: Dict[str, Any]) -> None:
+        """执行场景的图片或视频生成并保存场景级检查点, 输入指纹未变化时直接复用"""
+        stage_type = 'scene_images' if kind == 'image' else 'scene_videos'
+        status, input_hash = getattr(scene, f'{kind}_status'), getattr(scene, f'{kind}_input_hash')
+        if await self.reuse(status, input_hash, getattr(scene, f'{kind}_result'), payload, stage_type):
+            return
+        attempts = getattr(scene, f'{kind}_attempts') + 1
+        setattr(scene, f'{kind}_attempts', attempts)
+        await sync_to_async(PipelineService.update_scene)(
+            scene.pk, **{f'{kind}_status': 'running', f'{kind}_attempts': attempts},
+        )
+        try:
+            provider, result = await self.call_with_retries(provider_type, lambda provider: GenerationService.run_media(
+                provider, payload, project_id=self.project.pk, stage_type=stage_type,
+                user_id=self.project.user_id, max_wait=self.config['RATE_LIMIT_WAIT'],
+            ))
+        except Exception as exc:
+            await sync_to_async(PipelineService.update_scene)(
+                scene.pk, **{f'{kind}_status': 'failed'}, error_message=str(exc),
+            )
+            raise
+        # 合并请求时多个调用方共享同一个结果对象, 复制后再附加 provider_id
+        result = {**result, 'provider_id': str(provider.id)}
+        input_hash = input_fingerprint(provider, payload)
+        fields = {f'{kind}_status': 'completed', f'{kind}_result': result, f'{kind}_input_hash': input_hash}
+        for field, value in fields.items():
+            setattr(scene, field, value)
+        self.reuse_stats[stage_type]['executed'] += 1
+        await sync_to_async(PipelineService.update_scene)(scene.pk, **fields, error_message=None)
+
+    async def run_scene_image(self, scene: Scene) -> None:
+        payload = self.media_payload(scene, scene.image_prompt or scene.description)
+        await self._run_scene_step(scene, 'image', 'text2image', payload)
+
+    async def run_scene_video(self, scene: Scene) -> None:
+        image = primary_output(scene.image_result)
+        payload = self.media_payload(scene, scene.video_prompt or scene.description)
+        payload.update({
+            'image': image.get('url') or image.get('path'),
+            'image_sha256': image.get('sha256'),
+            'duration': scene.duration,
+        })
+        await self._run_scene_step(scene, 'video', 'image2video', payload)
+
+
+class PipelineWorker:
+    """
+    流水线worker
+    在一个事件循环中同时执行最多 concurrency 个项目, 每个项目内部的场景再按 MAX_PARALLEL 并发
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, poll_interval: Optional[float] = None,
+                 lock_timeout: Optional[float] = None, worker_id: Optional[str] = None):
+        self.config = get_pipeline_settings()
+        self.concurrency = concurrency or self.config['WORKER_CONCURRENCY']
+        self.poll_interval = poll_interval if poll_interval is not None else self.config['POLL_INTERVAL']
+        self.lock_timeout = lock_timeout or self.config['LOCK_TIMEOUT']
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._stopping = False
+
+    def stop(self) -> None:
+        """不再领取新项目, 等待在途项目结束"""
+        self._stopping = True
+
+    async def run(self, burst: bool = False) -> int:
+        """
+        运行worker
+
+        Args:
+            burst: 为 True 时没有排队中的项目且在途项目结束后退出
+
+        Returns:
+            处理的项目数
+        """
+        processed = 0
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while not self._stopping:
+                free = self.concurrency - len(self._tasks)
+                claimed = []
+                if free > 0:
+                    claimed = await sync_to_async(PipelineService.claim)(self.worker_id, free, self.lock_timeout)
+                for project in claimed:
+                    self._tasks[str(project.pk)] = asyncio.create_task(self._execute(project))
+                    processed += 1
+                if burst and not claimed and not self._tasks:
+                    if not await sync_to_async(PipelineService.has_queued)():
+                        break
+                if self._tasks:
+                    await asyncio.wait(
+                        list(self._tasks.values()), timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED,
+                    )
+                else:
+                    await asyncio.sleep(self.poll_interval)
+            if self._tasks:
+                await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        finally:
+            heartbeat.cancel()
+            await sync_to_async(close_old_connections)()
+        return processed
+
+    async def _execute(self, project: Project) -> None:
+        key = str(project.pk)
+        try:
+            status, error = await PipelineExecutor(project, self.config).run()
+        except asyncio.CancelledError:
+            cancelled = await sync_to_async(
+                Project.objects.filter(pk=project.pk, cancel_requested=True).exists
+            )()
+            if cancelled:
+                await sync_to_async(PipelineService.finish)(project.pk, self.worker_id, 'cancelled')
+            else:
+                # worker 退出等原因中断; 锁已被其他 worker 接管时 finish 不会生效
+                await sync_to_async(PipelineService.finish)(
+                    project.pk, self.worker_id, 'failed', '流水线执行被中断',
+                )
+                raise
+        except Exception as exc:
+            logger.exception('项目 %s 流水线执行异常', key)
+            await sync_to_async(PipelineService.finish)(
+                project.pk, self.worker_id, 'failed', f'{type(exc).__name__}: {exc}',
+            )
+        else:
+            await sync_to_async(PipelineService.finish)(project.pk, self.worker_id, status, error)
+        finally:
+            self._tasks.pop(key, None)
+
+    async def _heartbeat_loop(self) -> None:
+        """定期续期在途项目的锁, 并中止已请求取消的项目"""
+        interval = max(min(self.lock_timeout / 3, 5.0), 0.5)
+        while True:
+            await asyncio.sleep(interval)
+            for key, task in list(self._tasks.items()):
+                alive = await sync_to_async(PipelineService.heartbeat)(key, self.worker_id, self.lock_timeout)
+                if not alive:
+                    task.cancel()
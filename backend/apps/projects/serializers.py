@@ -0,0 +1,95 @@
+"""
+故事项目序列化器
+"""
+from rest_framework import serializers
+
+from .models import Project, ProjectStage, Scene
+from .pipeline import STAGE_ORDER
+
+
+class ProjectStageSerializer(serializers.ModelSerializer):
+    """流水线阶段序列化器"""
+    stage_type_display = serializers.CharField(source='get_stage_type_display', read_only=True)
+    status_display = serializers.CharField(source='get_status_display', read_only=True)
+
+    class Meta:
+        model = ProjectStage
+        fields = [
+            'id', 'stage_type', 'stage_type_display', 'status', 'status_display',
+            'output', 'input_hash', 'error_message', 'attempts', 'started_at', 'finished_at', 'updated_at'
+        ]
+        read_only_fields = fields
+
+
+class SceneSerializer(serializers.ModelSerializer):
+    """分镜场景序列化器"""
+
+    class Meta:
+        model = Scene
+        fields = [
+            'id', 'index', 'description', 'image_prompt', 'video_prompt', 'duration',
+            'image_status', 'image_result', 'image_attempts',
+            'video_status', 'video_result', 'video_attempts',
+            'image_input_hash', 'video_input_hash',
+            'error_message', 'updated_at'
+        ]
+        read_only_fields = fields
+
+
+class SceneUpdateSerializer(serializers.ModelSerializer):
+    """
+    分镜场景修改序列化器
+    修改后重新运行流水线, 只有输入指纹变化的场景(及其视频)会重新生成
+    """
+
+    class Meta:
+        model = Scene
+        fields = ['description', 'image_prompt', 'video_prompt', 'duration']
+
+
+class ProjectSerializer(serializers.ModelSerializer):
+    """故事项目序列化器(列表/创建/修改)"""
+    status_display = serializers.CharField(source='get_status_display', read_only=True)
+
+    class Meta:
+        model = Project
+        fields = [
+            'id', 'name', 'story_idea', 'config', 'status', 'status_display',
+            'error_message', 'cancel_requested', 'started_at', 'finished_at',
+            'created_at', 'updated_at'
+        ]
+        read_only_fields = [
+            'id', 'status', 'error_message', 'cancel_requested', 'started_at', 'finished_at',
+            'created_at', 'updated_at'
+        ]
+
+    def validate_config(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("生成配置必须是JSON对象")
+        scene_count = value.get('scene_count')
+        if scene_count is not None and (not isinstance(scene_count, int) or not 1 <= scene_count <= 100):
+            raise serializers.ValidationError("scene_count 必须是1到100之间的整数")
+        return value
+
+
+class ProjectDetailSerializer(ProjectSerializer):
+    """故事项目详情序列化器, 包含各阶段和场景的执行状态"""
+    stages = serializers.SerializerMethodField()
+    scenes = SceneSerializer(many=True, read_only=True)
+
+    class Meta(ProjectSerializer.Meta):
+        fields = ProjectSerializer.Meta.fields + ['stages', 'scenes']
+
+    def get_stages(self, obj):
+        stages = sorted(obj.stages.all(), key=lambda stage: STAGE_ORDER.index(stage.stage_type))
+        return ProjectStageSerializer(stages, many=True).data
+
+
+class ProjectRunSerializer(serializers.Serializer):
+    """启动流水线参数"""
+    from_stage = serializers.ChoiceField(
+        choices=ProjectStage.STAGE_TYPES,
+        required=False,
+        allow_null=True,
+        help_text="从该阶段开始重新生成(包括之后的阶段), 不指定时只执行未完成的部分"
+    )
@@ -0,0 +1,299 @@
+"""故事项目流水线测试"""
+import asyncio
+import json
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from apps.models.models import ModelProvider, ModelUsageLog
+from apps.models.router import provider_router
+from apps.models.usage_buffer import usage_log_buffer
+from core.ai_client.base import AIClientError, BaseAIClient
+from core.ai_client.openai_client import OpenAIClient
+
+from .dag import DAGRunner
+from .models import Project, Scene
+from .pipeline import PipelineService, PipelineWorker, input_fingerprint
+
+
+class FakeLLMClient(OpenAIClient):
+    """剧本阶段返回固定文本, 分镜阶段返回 scene_count 个场景"""
+    calls = []
+    scene_count = 3
+
+    async def chat(self, messages, timeout=None, **overrides):
+        FakeLLMClient.calls.append(messages[0]['content'])
+        if '分镜' in messages[0]['content']:
+            scenes = [
+                {'description': f'场景{index}', 'image_prompt': f'画面{index}', 'video_prompt': f'镜头{index}'}
+                for index in range(FakeLLMClient.scene_count)
+            ]
+            content = json.dumps(scenes, ensure_ascii=False)
+        else:
+            content = '剧本'
+        return {'content': content, 'tokens_used': 10, 'latency_ms': 1, 'request': {}, 'response': {}}
+
+
+class FakeMediaClient(BaseAIClient):
+    """
+    记录调用和并发峰值的媒体执行器
+    fail 中的 (provider_type, scene_index) 或提供商ID对应的调用失败, gate 不为空时调用等待该事件
+    """
+    calls = []
+    fail = set()
+    running = {}
+    peak = {}
+    outstanding = []
+    gate = None
+
+    async def run(self, payload):
+        provider_type = self.provider.provider_type
+        FakeMediaClient.calls.append((provider_type, payload['scene_index'], str(self.provider.id)))
+        FakeMediaClient.outstanding.append(provider_router.outstanding(self.provider.id))
+        FakeMediaClient.running[provider_type] = FakeMediaClient.running.get(provider_type, 0) + 1
+        FakeMediaClient.peak[provider_type] = max(
+            FakeMediaClient.peak.get(provider_type, 0), FakeMediaClient.running[provider_type]
+        )
+        try:
+            if FakeMediaClient.gate is not None:
+                await FakeMediaClient.gate.wait()
+            await asyncio.sleep(0.01)
+            if {(provider_type, payload['scene_index']), str(self.provider.id)} & FakeMediaClient.fail:
+                raise AIClientError('上游返回 500')
+            return {'url': f"/storage/{provider_type}/{payload['scene_index']}", 'sha256': payload['prompt']}
+        finally:
+            FakeMediaClient.running[provider_type] -= 1
+
+
+class DAGRunnerTests(TestCase):
+    """节点按依赖顺序执行, 资源池限制并发, 失败只阻断下游"""
+
+    def test_nodes_run_after_dependencies(self):
+        order = []
+        dag = DAGRunner()
+
+        def node(key, children=()):
+            async def run():
+                order.append(key)
+                for child in children:
+                    dag.add(child, node(child), deps=[key])
+            return run
+
+        dag.add('b', node('b'), deps=['a'])
+        dag.add('a', node('a', children=['c']))
+        self.assertEqual(asyncio.run(dag.run()), {})
+        self.assertEqual(order, ['a', 'b', 'c'])
+        self.assertEqual(dag.completed, {'a', 'b', 'c'})
+
+    def test_pool_limits_concurrency(self):
+        running, peak = [0], [0]
+
+        async def work():
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+
+        dag = DAGRunner({'media': 2})
+        for index in range(6):
+            dag.add(f'n{index}', work, pool='media')
+        asyncio.run(dag.run())
+        self.assertEqual(peak[0], 2)
+
+    def test_failure_blocks_only_downstream(self):
+        async def fail():
+            raise ValueError('boom')
+
+        async def ok():
+            pass
+
+        dag = DAGRunner()
+        dag.add('bad', fail)
+        dag.add('after_bad', ok, deps=['bad'])
+        dag.add('after_after', ok, deps=['after_bad'])
+        dag.add('good', ok)
+        failed = asyncio.run(dag.run())
+        self.assertEqual(list(failed), ['bad'])
+        self.assertEqual(dag.blocked, {'after_bad', 'after_after'})
+        self.assertEqual(dag.completed, {'good'})
+
+
+@override_settings(PROJECT_PIPELINE={'RETRY_BACKOFF': 0, 'POLL_INTERVAL': 0.05})
+class PipelineTestCase(TestCase):
+    """创建各类型的假提供商和一个项目, 同步执行流水线"""
+
+    def setUp(self):
+        FakeLLMClient.calls, FakeLLMClient.scene_count = [], 3
+        FakeMediaClient.calls, FakeMediaClient.fail = [], set()
+        FakeMediaClient.running, FakeMediaClient.peak, FakeMediaClient.gate = {}, {}, None
+        FakeMediaClient.outstanding = []
+        patcher = mock.patch.object(usage_log_buffer, 'enabled', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = get_user_model().objects.create_user('tester', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.providers = {
+            provider_type: self.create_provider(provider_type)
+            for provider_type in ('llm', 'text2image', 'image2video')
+        }
+        self.project = Project.objects.create(user=self.user, name='p', story_idea='一只猫', config={})
+
+    def create_provider(self, provider_type, name=None):
+        executor = FakeLLMClient if provider_type == 'llm' else FakeMediaClient
+        return ModelProvider.objects.create(
+            name=name or provider_type, provider_type=provider_type, api_url='http://example.com/v1',
+            api_key='key', model_name='model', executor_class=f'{__name__}.{executor.__name__}',
+        )
+
+    def run_pipeline(self, **data):
+        response = self.client.post(f'/projects/{self.project.pk}/run/', data, format='json')
+        self.assertEqual(response.status_code, 202, response.content)
+        FakeLLMClient.calls, FakeMediaClient.calls = [], []
+        async_to_sync(PipelineWorker(poll_interval=0.05).run)(burst=True)
+        self.project.refresh_from_db()
+        return self.project
+
+    def media_calls(self, provider_type):
+        return sorted(index for kind, index, _ in FakeMediaClient.calls if kind == provider_type)
+
+
+class PipelineReuseTests(PipelineTestCase):
+    """输入指纹未变化的节点复用产出, 提示词或提供商配置变化时重新生成"""
+
+    def test_fingerprint_covers_generation_params(self):
+        provider = self.providers['llm']
+        inputs = {'prompt': 'x'}
+        fingerprint = input_fingerprint(provider, inputs)
+        provider.extra_config = {'max_concurrency': 4}
+        provider.temperature = 0.7 + 1e-9
+        self.assertEqual(input_fingerprint(provider, inputs), fingerprint)
+        for field, value in (('temperature', 0.2), ('max_tokens', 100), ('top_p', 0.5),
+                             ('api_url', 'http://other.example.com/v1')):
+            changed = ModelProvider.objects.get(pk=provider.pk)
+            setattr(changed, field, value)
+            self.assertNotEqual(input_fingerprint(changed, inputs), fingerprint, field)
+        self.assertNotEqual(input_fingerprint(provider, {'prompt': 'y'}), fingerprint)
+
+    def test_unchanged_inputs_are_reused(self):
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual((FakeLLMClient.calls, FakeMediaClient.calls), ([], []))
+        # 2 个阶段 + 每个场景的图片和视频各一条复用日志
+        self.assertEqual(ModelUsageLog.objects.filter(project_id=self.project.pk, source='reused').count(), 8)
+
+    def test_changed_prompt_regenerates_scene(self):
+        self.run_pipeline()
+        response = self.client.patch(
+            f'/projects/{self.project.pk}/scenes/1/', {'image_prompt': '新的画面'}, format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual(FakeLLMClient.calls, [])
+        self.assertEqual(self.media_calls('text2image'), [1])
+        self.assertEqual(self.media_calls('image2video'), [1])
+
+    def test_changed_provider_config_regenerates(self):
+        self.run_pipeline()
+        provider = self.providers['image2video']
+        provider.extra_config = {'max_concurrency': 8}
+        provider.save()
+        self.run_pipeline()
+        self.assertEqual(FakeMediaClient.calls, [])
+
+        provider.extra_config = {'fps': 24}
+        provider.save()
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual(self.media_calls('text2image'), [])
+        self.assertEqual(self.media_calls('image2video'), [0, 1, 2])
+
+        llm = self.providers['llm']
+        llm.temperature = 0.2
+        llm.save()
+        self.run_pipeline()
+        # 剧本和分镜重新生成, 分镜内容不变时场景继续复用
+        self.assertEqual(len(FakeLLMClient.calls), 2)
+        self.assertEqual(FakeMediaClient.calls, [])
+
+
+class PipelineExecutionTests(PipelineTestCase):
+    """场景并发、换提供商重试、部分失败和取消"""
+
+    @override_settings(PROJECT_PIPELINE={
+        'RETRY_BACKOFF': 0, 'POLL_INTERVAL': 0.05, 'MAX_PARALLEL': {'text2image': 2, 'image2video': 1},
+    })
+    def test_scenes_fan_out_within_max_parallel(self):
+        FakeLLMClient.scene_count = 6
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual(self.media_calls('text2image'), list(range(6)))
+        self.assertEqual(self.media_calls('image2video'), list(range(6)))
+        self.assertEqual(FakeMediaClient.peak, {'text2image': 2, 'image2video': 1})
+        # 调用期间计入路由器的并发数, 结束后归零
+        self.assertTrue(all(count >= 1 for count in FakeMediaClient.outstanding))
+        self.assertEqual(max(FakeMediaClient.outstanding), 2)
+        self.assertEqual(provider_router.outstanding(self.providers['text2image'].id), 0)
+        stages = {stage.stage_type: stage for stage in self.project.stages.all()}
+        self.assertEqual(stages['scene_videos'].status, 'completed')
+        self.assertEqual(stages['scene_videos'].output['executed'], 6)
+
+    def test_retry_excludes_failed_provider(self):
+        good = self.create_provider('text2image', name='text2image-2')
+        FakeMediaClient.fail = {str(self.providers['text2image'].id)}
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        for index in range(3):
+            calls = [provider_id for kind, scene, provider_id in FakeMediaClient.calls
+                     if (kind, scene) == ('text2image', index)]
+            # 失败的提供商最多被选中一次, 重试换到另一个提供商
+            self.assertEqual(calls[-1], str(good.id))
+            self.assertLessEqual(len(calls), 2)
+        self.assertTrue(all(
+            scene.image_result['provider_id'] == str(good.id) for scene in Scene.objects.filter(project=self.project)
+        ))
+
+    def test_partial_failure_keeps_other_scenes(self):
+        FakeMediaClient.fail = {('text2image', 1)}
+        project = self.run_pipeline()
+        self.assertEqual(project.status, 'failed')
+        self.assertIn('scene:1:image', project.error_message)
+        self.assertEqual(self.media_calls('text2image'), [0, 1, 1, 1, 2])
+        # 失败场景的视频不会执行, 其余场景照常完成
+        self.assertEqual(self.media_calls('image2video'), [0, 2])
+        statuses = dict(Scene.objects.filter(project=project).values_list('index', 'image_status'))
+        self.assertEqual(statuses, {0: 'completed', 1: 'failed', 2: 'completed'})
+
+        # 修复后重新运行只补跑失败的场景
+        FakeMediaClient.fail = set()
+        self.assertEqual(self.run_pipeline().status, 'completed')
+        self.assertEqual(self.media_calls('text2image'), [1])
+        self.assertEqual(self.media_calls('image2video'), [1])
+
+    def test_cancel_stops_running_pipeline(self):
+        response = self.client.post(f'/projects/{self.project.pk}/run/', {}, format='json')
+        self.assertEqual(response.status_code, 202)
+
+        async def run():
+            FakeMediaClient.gate = asyncio.Event()
+            worker = asyncio.create_task(PipelineWorker(poll_interval=0.05, lock_timeout=1.5).run(burst=True))
+            while not FakeMediaClient.running.get('text2image'):
+                await asyncio.sleep(0.01)
+            project = await sync_to_async(Project.objects.get)(pk=self.project.pk)
+            await sync_to_async(PipelineService.cancel)(project)
+            await asyncio.wait_for(worker, timeout=10)
+
+        async_to_sync(run)()
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.status, 'cancelled')
+        self.assertEqual(FakeMediaClient.running['text2image'], 0)
+        self.assertEqual(self.media_calls('image2video'), [])
+        self.assertFalse(Scene.objects.filter(project=self.project, image_status='completed').exists())
+
+    def test_scene_patch_rejects_missing_scene_and_active_project(self):
+        self.run_pipeline()
+        url = f'/projects/{self.project.pk}/scenes/{{}}/'
+        self.assertEqual(self.client.patch(url.format(9), {'image_prompt': 'x'}, format='json').status_code, 404)
+        Project.objects.filter(pk=self.project.pk).update(status='running')
+        self.assertEqual(self.client.patch(url.format(0), {'image_prompt': 'x'}, format='json').status_code, 409)
+        self.assertEqual(Scene.objects.get(project=self.project, index=0).image_prompt, '画面0')
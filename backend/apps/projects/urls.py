@@ -0,0 +1,12 @@
+"""故事项目URL路由"""
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
+
+from .views import ProjectViewSet
+
+router = DefaultRouter()
+router.register(r'', ProjectViewSet, basename='project')
+
+urlpatterns = [
+    path('', include(router.urls)),
+]
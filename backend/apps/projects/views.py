@@ -0,0 +1,113 @@
+"""
+故事项目视图
+"""
+from django.db.models import Prefetch
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+from .models import Project, Scene
+from .pipeline import PipelineService
+from .serializers import (
+    ProjectDetailSerializer,
+    ProjectRunSerializer,
+    ProjectSerializer,
+    SceneSerializer,
+    SceneUpdateSerializer,
+)
+
+
+class ProjectViewSet(viewsets.ModelViewSet):
+    """
+    故事项目视图集(只能访问自己的项目)
+    GET/POST          /projects/                 项目列表 / 创建项目
+    GET/PATCH/DELETE  /projects/{id}/            项目详情(含各阶段和场景状态) / 修改 / 删除
+    POST              /projects/{id}/run/        启动流水线, 从检查点继续; from_stage 指定从某阶段重新生成
+    POST              /projects/{id}/cancel/     取消流水线
+    PATCH             /projects/{id}/scenes/{index}/  修改分镜场景, 重新运行时只重新生成受影响的场景
+    """
+    serializer_class = ProjectSerializer
+
+    def get_queryset(self):
+        queryset = Project.objects.filter(user=self.request.user)
+        if self.action != 'list':
+            queryset = queryset.prefetch_related(
+                'stages', Prefetch('scenes', queryset=Scene.objects.order_by('index'))
+            )
+        status_filter = self.request.query_params.get('status')
+        if status_filter:
+            queryset = queryset.filter(status=status_filter)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ProjectSerializer
+        return ProjectDetailSerializer
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+    def _reject_active(self, project):
+        if project.status in Project.ACTIVE_STATUSES:
+            return Response({
+                'success': False,
+                'message': f'项目{project.get_status_display()}, 请先取消'
+            }, status=status.HTTP_409_CONFLICT)
+        return None
+
+    def update(self, request, *args, **kwargs):
+        return self._reject_active(self.get_object()) or super().update(request, *args, **kwargs)
+
+    def destroy(self, request, *args, **kwargs):
+        return self._reject_active(self.get_object()) or super().destroy(request, *args, **kwargs)
+
+    @action(detail=True, methods=['post'])
+    def run(self, request, pk=None):
+        """启动流水线"""
+        project = self.get_object()
+        serializer = ProjectRunSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if not PipelineService.start(project, from_stage=serializer.validated_data.get('from_stage')):
+            project.refresh_from_db()
+            return self._reject_active(project)
+        project = self.get_queryset().get(pk=project.pk)
+        return Response({
+            'success': True,
+            'message': '项目已进入生成队列',
+            'data': ProjectDetailSerializer(project).data
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """取消流水线"""
+        project = self.get_object()
+        if project.status not in Project.ACTIVE_STATUSES:
+            return Response({
+                'success': False,
+                'message': f'项目{project.get_status_display()}, 无法取消'
+            }, status=status.HTTP_409_CONFLICT)
+        project = PipelineService.cancel(project)
+        return Response({
+            'success': True,
+            'message': '项目已取消' if project.status == 'cancelled' else '已请求取消, 流水线将在当前步骤中止',
+            'data': ProjectSerializer(project).data
+        })
+
+    @action(detail=True, methods=['patch'], url_path=r'scenes/(?P<index>[0-9]+)')
+    def update_scene(self, request, pk=None, index=None):
+        """修改分镜场景"""
+        project = self.get_object()
+        rejected = self._reject_active(project)
+        if rejected:
+            return rejected
+        scene = project.scenes.filter(index=int(index)).first()
+        if scene is None:
+            return Response({'success': False, 'message': '场景不存在'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = SceneUpdateSerializer(scene, data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response({
+            'success': True,
+            'message': '场景已修改, 重新运行流水线后生效',
+            'data': SceneSerializer(scene).data
+        })
@@ -35,7 +35,7 @@ INSTALLED_APPS = [
 
     # 本地应用
     'apps.test',
-    # 'apps.projects',
+    'apps.projects',
     # 'apps.prompts',
     'apps.models',
     # 'apps.content',
@@ -109,6 +109,166 @@ MEDIA_ROOT = BASE_DIR / 'media'
 STORAGE_URL = 'storage/'
 STORAGE_ROOT = BASE_DIR.parent / 'storage'  # 项目根目录的storage文件夹
 
+# 内容寻址存储 (apps.models.storage)
+BLOB_STORAGE = {
+    'ROOT': STORAGE_ROOT / 'blobs',
+    'SHARD_DEPTH': 2,  # 目录分片层数, ab/cd/<sha256>
+    'SHARD_WIDTH': 2,  # 每层分片使用的哈希字符数
+}
+
+# STORAGE_URL / MEDIA_URL 文件服务 (apps.models.media)
+MEDIA_SERVING = {
+    # django: Django流式发送(支持Range); x-accel-redirect: 交给nginx; x-sendfile: 交给Apache/lighttpd
+    'MODE': 'django',
+    # x-accel-redirect 模式下各目录对应的nginx internal location
+    'ACCEL_PREFIXES': {
+        'storage': '/protected/storage/',
+        'media': '/protected/media/',
+        'derivatives': '/protected/storage/derivatives/',
+    },
+    'BLOB_MAX_AGE': 365 * 24 * 3600,  # 内容寻址文件的缓存时间(秒)
+    'MAX_AGE': 0,  # 其他文件的缓存时间(秒)
+}
+
+# 缩略图/预览图/视频封面帧 (apps.models.derivatives)
+MEDIA_DERIVATIVES = {
+    'ROOT': STORAGE_ROOT / 'derivatives',
+    'PRESETS': {
+        'thumb': {'width': 256, 'height': 256},  # 列表网格
+        'preview': {'width': 768, 'height': 768},  # 详情预览
+        'poster': {'width': 1280, 'height': 1280},  # 视频播放器封面
+    },
+    'FORMAT': 'WEBP',
+    'QUALITY': 80,
+    'MAX_DISK_BYTES': 2 * 1024 ** 3,  # 派生缓存磁盘上限, 超出后按最近访问时间淘汰
+    'EAGER_PRESETS': ['thumb'],  # 媒体任务完成后立即生成的规格
+    'FFMPEG_BINARY': 'ffmpeg',
+    'POSTER_OFFSET': 1.0,  # 封面帧的截取时间点(秒)
+    'TOUCH_INTERVAL': 60.0,  # 访问时间的最小更新间隔(秒)
+}
+
+# 模型使用日志写缓冲 (apps.models.usage_buffer)
+USAGE_LOG_BUFFER = {
+    'ENABLED': True,
+    'MAX_BATCH_SIZE': 100,  # 缓冲达到该条数时立即落库
+    'FLUSH_INTERVAL': 1.0,  # 最长落库间隔(秒)
+    'MAX_RETRIES': 3,  # 数据库暂时不可用时每条日志最多重试的落库次数
+}
+
+# 模型使用日志数据外置 (apps.models.payloads)
+USAGE_LOG_PAYLOADS = {
+    'ENABLED': True,
+    'OFFLOAD_THRESHOLD': 8192,  # request_data/response_data 序列化后超过该字节数时压缩存入 model_usage_payloads
+    'PREVIEW_CHARS': 200,  # 日志行中保留的预览字符数
+    'COMPRESSION_LEVEL': 6,  # zlib 压缩级别
+}
+
+# 项目/用户使用预算 (apps.models.budgets)
+# 提供商价格配置在 extra_config['pricing'], 额度通过 /models/budgets/ 设置
+USAGE_BUDGETS = {
+    'ENABLED': True,  # 为False时不检查额度(仍累计用量)
+    'DEFAULT_LIMITS': {  # 新账本的默认额度, None表示不限制
+        'project': {'token_limit': None, 'cost_limit': None},
+        'user': {'token_limit': None, 'cost_limit': None},
+    },
+}
+
+# 模型使用日志保留策略 (apps.models.retention, manage.py archive_usage_logs)
+USAGE_LOG_RETENTION = {
+    'ARCHIVE_AFTER_DAYS': 30,  # 超过该天数的日志写入归档文件并清空请求/响应数据
+    'DELETE_AFTER_DAYS': None,  # 超过该天数的日志行直接删除(统计保留在汇总表中), None表示不删除
+    'ARCHIVE_ROOT': BASE_DIR.parent / 'archives' / 'usage_logs',  # 不放在 STORAGE_ROOT 下, 避免被 /storage/ 对外提供
+    'FORMAT': 'gzip',  # gzip 或 zstd(需要安装 zstandard)
+    'BATCH_SIZE': 500,  # 每批处理的行数, 每批一个短事务
+    'BATCH_PAUSE': 0.05,  # 批次之间暂停的秒数, 让出 SQLite 写锁
+}
+
+# 模型提供商路由 (apps.models.router)
+PROVIDER_ROUTER = {
+    'STRATEGY': 'weighted_round_robin',  # 或 least_outstanding
+    'HEALTH_WINDOW_SECONDS': 300.0,  # 健康判断的统计窗口(秒)
+    'HEALTH_MIN_SAMPLES': 10,  # 窗口内样本数达到该值才做健康判断
+    'MAX_FAILURE_RATE': 0.5,  # 失败率超过该值时摘除
+    'MAX_AVG_LATENCY_MS': None,  # 平均延迟超过该值时摘除, None表示不按延迟摘除
+    'EJECT_SECONDS': 30.0,  # 摘除时长(秒)
+}
+
+# 提供商熔断与自适应超时 (apps.models.circuit_breaker)
+CIRCUIT_BREAKER = {
+    'ENABLED': True,
+    'FAILURE_THRESHOLD': 5,  # 连续 failed/timeout 次数达到该值时熔断
+    'RECOVERY_SECONDS': 30.0,  # 熔断时长(秒), 之后进入半开状态放行探测请求
+    'HALF_OPEN_MAX_CALLS': 1,  # 半开状态下同时放行的探测请求数
+    'ADAPTIVE_TIMEOUT': {  # 超时取最近成功调用延迟的 pXX × MULTIPLIER, 不超过提供商的 timeout
+        'ENABLED': True,
+        'PERCENTILE': 99,
+        'MULTIPLIER': 3.0,
+        'MIN_SAMPLES': 20,  # 样本不足时使用提供商的 timeout
+        'SAMPLE_SIZE': 200,  # 保留最近多少次成功调用的延迟
+        'MIN_TIMEOUT': 5.0,  # 自适应超时的下限(秒)
+    },
+}
+
+# 提供商配置快照缓存 (apps.models.provider_cache)
+# 版本号保存在 CACHE_ALIAS 指向的缓存中, 多进程部署时应使用共享缓存(如 Redis)
+PROVIDER_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'VERSION_CHECK_INTERVAL': 1.0,  # 检查版本号的最小间隔(秒)
+    'MAX_AGE': 300.0,  # 快照最长使用时间(秒), 共享缓存不可用时的兜底
+}
+
+# 提供商限流 (apps.models.rate_limit)
+# 多进程部署时可改用 apps.models.rate_limit.CacheRateLimitBackend 配合共享缓存
+RATE_LIMIT = {
+    'BACKEND': 'apps.models.rate_limit.InMemoryRateLimitBackend',
+    'OPTIONS': {},
+}
+
+# LLM响应缓存 (core.ai_client.response_cache)
+LLM_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 1024,  # 内存层最多缓存的条目数(LRU淘汰)
+    'TTL': 3600,  # 缓存有效期(秒)
+    'DISK_PATH': None,  # 磁盘层SQLite文件路径, 如 BASE_DIR / 'cache' / 'llm_responses.sqlite3'
+    'MAX_DISK_ENTRIES': 100000,
+    'CACHE_NONDETERMINISTIC': False,  # temperature > 0 的请求是否也缓存
+}
+
+# 生成任务队列 (apps.models.jobs), 由 python manage.py run_generation_worker 执行
+GENERATION_JOBS = {
+    'VISIBILITY_TIMEOUT': 600,  # 任务锁定时长(秒), worker 崩溃后超过该时长任务会被重新领取
+    'POLL_INTERVAL': 1.0,  # 队列为空时的轮询间隔(秒)
+    'MAX_ATTEMPTS': 3,  # 默认最大执行次数
+    'RETRY_BACKOFF': 5,  # 重试退避基数(秒), 第n次重试等待 RETRY_BACKOFF * 2^(n-1)
+    'RETRY_BACKOFF_MAX': 600,
+    'DEFAULT_PROVIDER_CONCURRENCY': 2,  # 提供商未在 extra_config.max_concurrency 配置时的并发上限
+    'WORKER_CONCURRENCY': 4,  # 每个worker同时执行的任务数
+    'PROGRESS_INTERVAL': 2.0,  # 执行进度写入任务的最小间隔(秒)
+}
+
+# 故事项目流水线 (apps.projects.pipeline), 由 python manage.py run_pipeline_worker 执行
+PROJECT_PIPELINE = {
+    'SCENE_COUNT': 8,  # 项目 config 未指定 scene_count 时的最大分镜数
+    'MAX_PARALLEL': {  # 单个项目内同时生成的场景数(按提供商类型)
+        'text2image': 4,
+        'image2video': 2,
+    },
+    'MAX_ATTEMPTS': 3,  # 每个阶段/场景的最大调用次数, 失败后优先换提供商重试
+    'RETRY_BACKOFF': 2,  # 重试退避基数(秒)
+    'RATE_LIMIT_WAIT': 30.0,  # 触发限流时最多等待的秒数
+    'LOCK_TIMEOUT': 300,  # 项目锁定时长(秒), worker 崩溃后超过该时长项目会被重新领取并从检查点继续
+    'POLL_INTERVAL': 2.0,
+    'WORKER_CONCURRENCY': 2,  # 每个worker同时执行的项目数
+}
+
+# 批量文本生成 (apps.models.generation.GenerationService.generate_batch, POST /models/providers/{id}/batch_generate/)
+LLM_BATCH = {
+    'MAX_ITEMS': 200,  # 单次请求最多的提示语数
+    'CONCURRENCY': 4,  # 默认同时进行的上游调用数
+    'PACK_SIZE': 1,  # 默认每次上游调用打包的提示语数, 1 表示不打包
+    'MAX_PACK_SIZE': 20,
+}
+
 # 默认主键字段
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -1,3 +1,6 @@
+import re
+
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include, re_path
 from drf_yasg import openapi
@@ -6,6 +9,8 @@ from drf_yasg.views import get_schema_view
 # drf_yasg2 从这里开始
 from rest_framework import permissions
 
+from apps.models.media import serve_media, serve_storage
+
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -29,5 +34,8 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('user/', include('apps.users.urls')),
     path('models/', include('apps.models.urls')),
+    path('projects/', include('apps.projects.urls')),
+    re_path(rf'^{re.escape(settings.STORAGE_URL.strip("/"))}/(?P<path>.+)$', serve_storage, name='storage-file'),
+    re_path(rf'^{re.escape(settings.MEDIA_URL.strip("/"))}/(?P<path>.+)$', serve_media, name='media-file'),
     # path('tasks/', include('apps.test.urls'))
 ]
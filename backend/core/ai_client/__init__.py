@@ -0,0 +1,4 @@
+"""
+AI客户端(执行器)
+ModelProvider.executor_class 保存这里各客户端类的完整路径
+"""
@@ -0,0 +1,74 @@
+"""执行器基类"""
+from typing import Optional
+
+
+class AIClientError(Exception):
+    """
+    执行器调用失败
+    status 对应 ModelUsageLog.STATUS_CHOICES, 便于直接写入使用日志
+    """
+    status = 'failed'
+
+    def __init__(self, message: str, status: str = None, status_code: int = None):
+        super().__init__(message)
+        if status is not None:
+            self.status = status
+        self.status_code = status_code
+
+
+class AIClientTimeoutError(AIClientError):
+    """上游请求超时"""
+    status = 'timeout'
+
+
+class AIClientRateLimitedError(AIClientError):
+    """上游返回 429"""
+    status = 'rate_limited'
+
+
+class BaseAIClient:
+    """
+    AI执行器基类
+    职责: 持有一个模型提供商的配置, 由 ExecutorRegistry 按提供商缓存复用
+    """
+    # run() 是否接受 on_progress 参数
+    supports_progress = False
+    # run() 是否接受 timeout 参数
+    supports_timeout = False
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    @property
+    def timeout(self) -> float:
+        """请求超时(秒)"""
+        return float(self.provider.timeout or 60)
+
+    def request_timeout(self, timeout: Optional[float] = None) -> float:
+        """
+        本次调用的超时(秒)
+        调用方按调用传入(如熔断器的自适应超时), 执行器实例在并发调用间共享, 不能保存在实例上
+
+        Args:
+            timeout: 调用方指定的超时, 为空时使用配置的 timeout, 不超过配置的 timeout
+        """
+        return self.timeout if timeout is None else min(float(timeout), self.timeout)
+
+    @property
+    def extra_config(self) -> dict:
+        """提供商的额外配置"""
+        return self.provider.extra_config or {}
+
+    async def run(self, payload: dict) -> dict:
+        """
+        执行一次生成任务(文生图/图生视频等), 由具体执行器实现
+        supports_progress 为 True 的执行器还接受 on_progress 进度回调(参数是一个事件字典, 可以是协程函数),
+        supports_timeout 为 True 的执行器还接受 timeout(本次调用的超时, 见 request_timeout)
+
+        Returns:
+            任务结果, 可包含 tokens_used 供使用日志记录
+        """
+        raise AIClientError(f'{type(self).__name__} 不支持任务执行', status='error')
+
+    def close(self) -> None:
+        """释放客户端持有的资源, 提供商配置变更时由注册表调用"""
@@ -0,0 +1,292 @@
+"""
+ComfyUI 执行器
+把 extra_config['workflow'] 中的工作流模板填充参数后提交到 ComfyUI 的 prompt 队列,
+通过 websocket 接收进度事件, 结束后并行下载输出文件
+"""
+import asyncio
+import copy
+import json
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+from asgiref.sync import sync_to_async
+from websockets.asyncio.client import connect
+from websockets.exceptions import WebSocketException
+
+from .base import AIClientError, AIClientTimeoutError, BaseAIClient
+from .http_pool import http_pool
+
+ProgressCallback = Callable[[Dict[str, Any]], Optional[Awaitable[None]]]
+
+
+class ComfyUIClient(BaseAIClient):
+    """
+    ComfyUI 客户端
+
+    extra_config:
+        workflow: API格式的工作流模板, 字符串输入中可以使用 {{prompt}}、{{seed}}、{{width}} 等占位符
+        batch_size: 每次提交合并的场景数, 默认 4
+        execution_timeout: 等待一次提交执行完成的最长时间(秒), 默认 1800
+
+    多个场景会被合并进同一个 prompt 图(节点ID加上场景前缀), 一次提交、一次排队完成
+    """
+    DEFAULT_BATCH_SIZE = 4
+    DEFAULT_EXECUTION_TIMEOUT = 1800
+    supports_progress = True
+    supports_timeout = True
+
+    @property
+    def base_url(self) -> str:
+        return self.provider.api_url.rstrip('/')
+
+    @property
+    def ws_url(self) -> str:
+        """websocket 地址: http(s) -> ws(s), 路径为 /ws"""
+        parts = urlsplit(self.base_url)
+        scheme = 'wss' if parts.scheme == 'https' else 'ws'
+        return urlunsplit((scheme, parts.netloc, parts.path.rstrip('/') + '/ws', '', ''))
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        if not self.provider.api_key:
+            return {}
+        return {'Authorization': f'Bearer {self.provider.api_key}'}
+
+    @staticmethod
+    def fill_template(value: Any, params: Dict[str, Any]) -> Any:
+        """
+        用场景参数填充模板
+        整个字符串就是一个占位符时保留参数的原始类型(如 seed 为整数), 否则做字符串替换
+        """
+        if isinstance(value, dict):
+            return {key: ComfyUIClient.fill_template(item, params) for key, item in value.items()}
+        if isinstance(value, list):
+            return [ComfyUIClient.fill_template(item, params) for item in value]
+        if not isinstance(value, str) or '{{' not in value:
+            return value
+        stripped = value.strip()
+        if stripped.startswith('{{') and stripped.endswith('}}') and stripped.count('{{') == 1:
+            name = stripped[2:-2].strip()
+            if name in params:
+                return params[name]
+        for name, param in params.items():
+            value = value.replace('{{' + name + '}}', str(param))
+        return value
+
+    @staticmethod
+    def prefix_graph(graph: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+        """给工作流的节点ID加前缀, 并同步改写节点之间的连线 [node_id, output_index]"""
+        prefixed = {}
+        for node_id, node in graph.items():
+            node = copy.deepcopy(node)
+            for name, value in (node.get('inputs') or {}).items():
+                if isinstance(value, list) and len(value) == 2 and str(value[0]) in graph:
+                    node['inputs'][name] = [f'{prefix}{value[0]}', value[1]]
+            prefixed[f'{prefix}{node_id}'] = node
+        return prefixed
+
+    def build_prompt(self, scenes: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """把多个场景合并成一个 prompt 图, 第 i 个场景的节点前缀为 s{i}_"""
+        template = self.extra_config.get('workflow')
+        if not template:
+            raise AIClientError('extra_config 中缺少 workflow 工作流模板', status='error')
+        defaults = {key: self.extra_config[key] for key in ('width', 'height', 'fps', 'duration') if key in self.extra_config}
+        prompt = {}
+        for index, scene in enumerate(scenes):
+            params = {**defaults, **scene}
+            params.setdefault('seed', uuid.uuid4().int % (2 ** 32))
+            prompt.update(self.prefix_graph(self.fill_template(template, params), f's{index}_'))
+        return prompt
+
+    async def submit(self, prompt: Dict[str, Any], client_id: str, timeout: Optional[float] = None) -> str:
+        """提交到 ComfyUI 队列, 返回 prompt_id"""
+        timeout = self.request_timeout(timeout)
+        client = http_pool.get_client(self.base_url)
+        try:
+            response = await client.post(
+                f'{self.base_url}/prompt', json={'prompt': prompt, 'client_id': client_id},
+                headers=self.headers, timeout=timeout,
+            )
+        except httpx.TimeoutException as exc:
+            raise AIClientTimeoutError(f'提交工作流超时({timeout}秒)') from exc
+        except httpx.HTTPError as exc:
+            raise AIClientError(f'提交工作流失败: {exc}', status='error') from exc
+        if response.status_code >= 400:
+            raise AIClientError(f'ComfyUI 返回 {response.status_code}: {response.text[:500]}',
+                                status_code=response.status_code)
+        try:
+            return response.json()['prompt_id']
+        except (ValueError, KeyError, TypeError) as exc:
+            raise AIClientError(f'ComfyUI 提交响应缺少 prompt_id: {response.text[:200]}') from exc
+
+    async def wait_for_outputs(self, ws, prompt_id: str, on_progress: Optional[ProgressCallback]) -> Dict[str, Any]:
+        """
+        读取 websocket 事件直到该 prompt 执行完成
+
+        Returns:
+            节点ID -> 节点输出
+        """
+        outputs: Dict[str, Any] = {}
+        async for message in ws:
+            if isinstance(message, bytes):
+                # 预览图等二进制帧
+                continue
+            try:
+                event = json.loads(message)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            data = event.get('data') or {}
+            if data.get('prompt_id') not in (None, prompt_id):
+                continue
+            event_type = event.get('type')
+            if event_type == 'executed' and data.get('output'):
+                outputs[str(data['node'])] = data['output']
+            elif event_type == 'execution_error':
+                raise AIClientError(f"ComfyUI 执行失败: {data.get('exception_message', '')}")
+            elif event_type == 'execution_interrupted':
+                raise AIClientError('ComfyUI 执行被中断')
+            if on_progress is not None and event_type in ('progress', 'executing', 'executed'):
+                maybe_awaitable = on_progress({'type': event_type, **data})
+                if asyncio.iscoroutine(maybe_awaitable):
+                    await maybe_awaitable
+            if event_type == 'executing' and data.get('node') is None and data.get('prompt_id') == prompt_id:
+                return outputs
+            if event_type == 'execution_success' and data.get('prompt_id') == prompt_id:
+                return outputs
+        raise AIClientError('ComfyUI websocket 连接意外关闭', status='error')
+
+    async def fetch_history(self, prompt_id: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """websocket 没有带回输出时从 /history 读取"""
+        timeout = self.request_timeout(timeout)
+        client = http_pool.get_client(self.base_url)
+        try:
+            response = await client.get(
+                f'{self.base_url}/history/{prompt_id}', headers=self.headers, timeout=timeout,
+            )
+        except httpx.TimeoutException as exc:
+            raise AIClientTimeoutError(f'读取 ComfyUI 历史超时({timeout}秒)') from exc
+        except httpx.HTTPError as exc:
+            raise AIClientError(f'读取 ComfyUI 历史失败: {exc}', status='error') from exc
+        if response.status_code >= 400:
+            raise AIClientError(f'读取 ComfyUI 历史失败: {response.status_code}', status_code=response.status_code)
+        try:
+            return (response.json().get(prompt_id) or {}).get('outputs', {})
+        except (ValueError, AttributeError) as exc:
+            raise AIClientError(f'ComfyUI 历史不是合法的JSON对象: {response.text[:200]}') from exc
+
+    async def download(self, file_info: Dict[str, Any], timeout: Optional[float] = None) -> bytes:
+        """下载一个输出文件"""
+        timeout = self.request_timeout(timeout)
+        client = http_pool.get_client(self.base_url)
+        params = {
+            'filename': file_info['filename'],
+            'subfolder': file_info.get('subfolder', ''),
+            'type': file_info.get('type', 'output'),
+        }
+        try:
+            response = await client.get(f'{self.base_url}/view', params=params, headers=self.headers, timeout=timeout)
+        except httpx.TimeoutException as exc:
+            raise AIClientTimeoutError(f"下载 {file_info['filename']} 超时({timeout}秒)") from exc
+        except httpx.HTTPError as exc:
+            raise AIClientError(f"下载 {file_info['filename']} 失败: {exc}", status='error') from exc
+        if response.status_code >= 400:
+            raise AIClientError(f"下载 {file_info['filename']} 失败: {response.status_code}",
+                                status_code=response.status_code)
+        return response.content
+
+    @staticmethod
+    def collect_files(outputs: Dict[str, Any], scene_count: int) -> List[List[Dict[str, Any]]]:
+        """按节点前缀把输出文件分配回各个场景"""
+        files: List[List[Dict[str, Any]]] = [[] for _ in range(scene_count)]
+        for node_id, output in outputs.items():
+            scene_index = int(node_id.split('_', 1)[0][1:]) if node_id.startswith('s') and '_' in node_id else 0
+            for kind in ('images', 'gifs', 'videos'):
+                for file_info in output.get(kind) or []:
+                    if file_info.get('type', 'output') == 'output':
+                        files[scene_index].append({**file_info, 'kind': kind})
+        return files
+
+    async def execute_batch(self, scenes: List[Dict[str, Any]], on_progress: Optional[ProgressCallback] = None,
+                            timeout: Optional[float] = None) -> List[List[Dict[str, Any]]]:
+        """
+        一次提交执行多个场景
+        timeout 是连接、提交和下载等单次请求的超时, 等待执行完成的时长由 execution_timeout 限制
+
+        Returns:
+            与 scenes 对应的输出文件列表, 每个文件包含 filename/subfolder/type/kind/content(bytes)
+        """
+        client_id = uuid.uuid4().hex
+        prompt = self.build_prompt(scenes)
+        timeout = self.request_timeout(timeout)
+        execution_timeout = float(self.extra_config.get('execution_timeout', self.DEFAULT_EXECUTION_TIMEOUT))
+        try:
+            # 先连接 websocket 再提交, 避免错过快速完成的事件
+            async with connect(f'{self.ws_url}?clientId={client_id}', additional_headers=self.headers,
+                               max_size=None, open_timeout=timeout) as ws:
+                prompt_id = await self.submit(prompt, client_id, timeout)
+                outputs = await asyncio.wait_for(
+                    self.wait_for_outputs(ws, prompt_id, on_progress), execution_timeout
+                )
+        except asyncio.TimeoutError as exc:
+            raise AIClientTimeoutError(f'ComfyUI 执行超时({execution_timeout}秒)') from exc
+        except (OSError, WebSocketException) as exc:
+            raise AIClientError(f'ComfyUI websocket 连接失败: {exc}', status='error') from exc
+        if not outputs:
+            outputs = await self.fetch_history(prompt_id, timeout)
+
+        files = self.collect_files(outputs, len(scenes))
+        flat = [file_info for scene_files in files for file_info in scene_files]
+        contents = await asyncio.gather(*(self.download(file_info, timeout) for file_info in flat))
+        for file_info, content in zip(flat, contents):
+            file_info['content'] = content
+        return files
+
+    async def generate_scenes(self, scenes: List[Dict[str, Any]], on_progress: Optional[ProgressCallback] = None,
+                              timeout: Optional[float] = None) -> List[List[Dict[str, Any]]]:
+        """按 batch_size 分批并发提交所有场景"""
+        batch_size = max(int(self.extra_config.get('batch_size', self.DEFAULT_BATCH_SIZE)), 1)
+        batches = [scenes[start:start + batch_size] for start in range(0, len(scenes), batch_size)]
+        results = await asyncio.gather(*(self.execute_batch(batch, on_progress, timeout) for batch in batches))
+        return [scene_files for batch_files in results for scene_files in batch_files]
+
+    def save_output(self, file_info: Dict[str, Any], project_id=None) -> Dict[str, Any]:
+        """把输出文件存入内容寻址存储, 返回文件描述"""
+        from apps.models.storage import blob_store
+
+        blob = blob_store.put_bytes(
+            file_info['content'], filename=file_info['filename'], provider=self.provider, project_id=project_id,
+        )
+        return {
+            'filename': file_info['filename'],
+            'kind': file_info['kind'],
+            'sha256': blob.sha256,
+            'url': blob_store.url(blob.sha256),
+            'mime_type': blob.mime_type,
+            'size': blob.size,
+        }
+
+    async def run(self, payload: Dict[str, Any], on_progress: Optional[ProgressCallback] = None,
+                  timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        执行生成任务
+        payload 为 {"scenes": [{...场景参数}, ...]} 或单个场景的参数, 可带 project_id;
+        on_progress 接收 websocket 的 progress/executing/executed 事件; timeout 为单次请求的超时
+
+        Returns:
+            {"scenes": [[{"filename", "kind", "sha256", "url", "mime_type", "size"}, ...], ...]}
+        """
+        scenes = payload.get('scenes') or [payload]
+        project_id = payload.get('project_id')
+        started = time.monotonic()
+        files = await self.generate_scenes(scenes, on_progress, timeout)
+        saved = []
+        for scene_files in files:
+            saved.append([
+                await sync_to_async(self.save_output)(file_info, project_id) for file_info in scene_files
+            ])
+        return {'scenes': saved, 'execution_ms': int((time.monotonic() - started) * 1000)}
@@ -0,0 +1,25 @@
+"""请求指纹"""
+import hashlib
+import json
+from typing import Any, Dict
+
+
+def normalize_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉空值并统一浮点精度, 让等价参数得到相同的指纹"""
+    normalized = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = round(value, 6)
+        normalized[key] = value
+    return normalized
+
+
+def request_fingerprint(provider_id, model_name: str, params: Dict[str, Any], prompt: Any) -> str:
+    """(提供商ID, 模型名, 规范化参数, 提示语) 的 SHA-256, 用作缓存键和合并请求的键"""
+    material = json.dumps(
+        [str(provider_id), model_name, normalize_params(params), prompt],
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
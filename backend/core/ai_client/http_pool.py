@@ -0,0 +1,132 @@
+"""
+共享HTTP连接池
+职责: 同一个 api_url 源(scheme://host:port)的所有请求复用一个 keep-alive 连接池,
+并行调用不再各自建立TCP/TLS连接
+"""
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from asgiref.sync import AsyncToSync, SyncToAsync
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPPoolManager:
+    """
+    按 (事件循环, 源) 管理 httpx.AsyncClient
+    AsyncClient 绑定创建它的事件循环, 因此不同事件循环各自持有连接池。
+
+    - 同步代码(如视图)通过 async_to_sync() 在连接池的常驻事件循环中执行协程, 连接池跨请求复用;
+      asgiref.sync.async_to_sync 每次调用都会新建事件循环, 连接池无法复用
+    - 其他事件循环(如 asyncio.run 启动的 worker)结束时, 通过取消守护任务在该循环内关闭它的连接池
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[int, str], Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+        # 事件循环ID -> 关闭连接池的守护任务
+        self._watchers: Dict[int, asyncio.Task] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def origin(url: str) -> str:
+        """提取 URL 的源"""
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}'
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """连接池的常驻事件循环, 首次使用时在后台线程中启动"""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='http-pool-loop', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def async_to_sync(self, awaitable):
+        """
+        与 asgiref.sync.async_to_sync 相同, 但协程在连接池的常驻事件循环中执行
+        thread_sensitive 的 sync_to_async(如ORM访问)仍回到调用线程执行;
+        已处于 ASGI 服务器的事件循环之下时沿用该循环
+        """
+        wrapper = AsyncToSync(awaitable)
+        # sync_to_async 留下的线程局部变量不会清除, 可能指向已结束的事件循环
+        outer = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+        if wrapper.main_event_loop is None and (outer is None or not outer.is_running()):
+            wrapper.main_event_loop = self.get_loop()
+        return wrapper
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        """获取当前事件循环下该源的共享客户端(需在协程中调用)"""
+        loop = asyncio.get_running_loop()
+        key = (id(loop), self.origin(url))
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry[0] is loop and not entry[1].is_closed:
+                return entry[1]
+            dropped = self._prune_closed_loops()
+            client = httpx.AsyncClient(limits=self.limits)
+            self._clients[key] = (loop, client)
+            if id(loop) not in self._watchers and loop is not self._loop:
+                self._watchers[id(loop)] = loop.create_task(self._close_on_shutdown())
+        for stale in dropped:
+            loop.create_task(self._close_quietly(stale))
+        return client
+
+    def _prune_closed_loops(self) -> List[httpx.AsyncClient]:
+        """丢弃已关闭事件循环的连接池(调用方需持有锁), 返回需要关闭的客户端"""
+        dropped = []
+        for key, (loop, client) in list(self._clients.items()):
+            if loop.is_closed():
+                del self._clients[key]
+                self._watchers.pop(id(loop), None)
+                dropped.append(client)
+        return dropped
+
+    @staticmethod
+    async def _close_quietly(client: httpx.AsyncClient) -> None:
+        """
+        关闭已关闭事件循环遗留的客户端
+        连接的传输层绑定在原事件循环上, 关闭可能失败, 此时释放连接池状态后由GC回收套接字
+        """
+        try:
+            await client.aclose()
+        except RuntimeError as exc:
+            logger.debug('关闭遗留的HTTP连接池失败: %s', exc)
+
+    async def _close_on_shutdown(self) -> None:
+        """守护任务: 事件循环结束(asyncio.run 取消剩余任务)时在该循环内关闭连接池"""
+        try:
+            await asyncio.get_running_loop().create_future()
+        except asyncio.CancelledError:
+            await self.aclose()
+            raise
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环下的所有连接池"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = [
+                (key, client) for key, (owner, client) in self._clients.items() if owner is loop
+            ]
+            for key, _ in clients:
+                del self._clients[key]
+            watcher = self._watchers.pop(id(loop), None)
+        if watcher is not None and watcher is not asyncio.current_task():
+            watcher.cancel()
+        for _, client in clients:
+            await client.aclose()
+
+
+# 进程级共享的连接池管理器
+http_pool = HTTPPoolManager()
@@ -0,0 +1,264 @@
+"""OpenAI兼容接口客户端"""
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from .base import AIClientError, AIClientRateLimitedError, AIClientTimeoutError, BaseAIClient
+from .http_pool import http_pool
+
+
+class PackedResponseError(AIClientError):
+    """打包请求的输出无法拆分成逐条结果(上游调用本身成功)"""
+    status = 'unpack_failed'
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.result: Optional[Dict[str, Any]] = None
+
+
+class OpenAIClient(BaseAIClient):
+    """
+    OpenAI兼容的 Chat Completions 客户端
+    使用提供商的 model_name/max_tokens/temperature/top_p/timeout, 连接复用 http_pool 中的共享连接池
+    """
+    CHAT_COMPLETIONS_PATH = '/chat/completions'
+    # 打包请求要求模型输出 JSON 对象, extra_config['packed_response_format'] 为 null 时不发送该参数
+    PACKED_RESPONSE_FORMAT = {'type': 'json_object'}
+    PACKED_INSTRUCTION = (
+        '你会收到一个JSON数组, 每个元素包含 id 和 prompt。请逐个独立完成每个 prompt, '
+        '只输出一个JSON对象: {"results": [{"id": <id>, "content": "<该prompt的完整回答>"}]}, '
+        'results 必须覆盖全部 id, 不要输出其他内容。'
+    )
+
+    @property
+    def endpoint(self) -> str:
+        """Chat Completions 接口地址, api_url 可以是 base url 或完整地址"""
+        api_url = self.provider.api_url.rstrip('/')
+        if api_url.endswith(self.CHAT_COMPLETIONS_PATH):
+            return api_url
+        return api_url + self.CHAT_COMPLETIONS_PATH
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            'Authorization': f'Bearer {self.provider.api_key}',
+            'Content-Type': 'application/json',
+        }
+
+    def build_payload(self, messages: List[Dict[str, Any]], **overrides) -> Dict[str, Any]:
+        """
+        组装请求体
+        参数优先级: 调用方覆盖 > 提供商字段 > extra_config['request_params']
+        """
+        payload: Dict[str, Any] = dict(self.extra_config.get('request_params', {}))
+        payload['model'] = self.provider.model_name
+        payload['messages'] = messages
+        for field in ('max_tokens', 'temperature', 'top_p'):
+            value = getattr(self.provider, field)
+            if value is not None:
+                payload[field] = value
+        payload.update({key: value for key, value in overrides.items() if value is not None})
+        return payload
+
+    @staticmethod
+    def to_messages(prompt: str, system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        messages = []
+        if system_prompt:
+            messages.append({'role': 'system', 'content': system_prompt})
+        messages.append({'role': 'user', 'content': prompt})
+        return messages
+
+    async def chat(self, messages: List[Dict[str, Any]], timeout: Optional[float] = None,
+                   **overrides) -> Dict[str, Any]:
+        """
+        调用 Chat Completions
+
+        Args:
+            messages: 消息列表
+            timeout: 本次调用的超时(秒), 不超过提供商配置的 timeout
+            overrides: 覆盖提供商的 max_tokens/temperature/top_p 等参数
+
+        Returns:
+            {'content', 'tokens_used', 'latency_ms', 'request', 'response'}
+
+        Raises:
+            AIClientError: 请求失败, status 对应 ModelUsageLog 状态
+        """
+        payload = self.build_payload(messages, **overrides)
+        timeout = self.request_timeout(timeout)
+        client = http_pool.get_client(self.endpoint)
+        started = time.monotonic()
+        try:
+            response = await client.post(
+                self.endpoint, json=payload, headers=self.headers, timeout=timeout,
+            )
+        except httpx.TimeoutException as exc:
+            raise AIClientTimeoutError(f'请求超时({timeout}秒)') from exc
+        except httpx.HTTPError as exc:
+            raise AIClientError(f'请求失败: {exc}', status='error') from exc
+        latency_ms = int((time.monotonic() - started) * 1000)
+        self.raise_for_status(response)
+        try:
+            data = response.json()
+        except ValueError as exc:
+            raise AIClientError(f'上游响应不是合法的JSON: {response.text[:200]}') from exc
+        if not isinstance(data, dict):
+            raise AIClientError(f'上游响应格式错误: {response.text[:200]}')
+        return {
+            'content': self.extract_content(data),
+            'tokens_used': (data.get('usage') or {}).get('total_tokens', 0),
+            'latency_ms': latency_ms,
+            'request': payload,
+            'response': data,
+        }
+
+    async def generate(self, prompt: str, system_prompt: Optional[str] = None, timeout: Optional[float] = None,
+                       **overrides) -> Dict[str, Any]:
+        """单轮文本生成"""
+        return await self.chat(self.to_messages(prompt, system_prompt), timeout=timeout, **overrides)
+
+    def to_packed_messages(self, prompts: List[str], system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        """把多个提示语打包成一次请求的消息, 共享的系统提示语放在打包说明之后"""
+        instruction = self.PACKED_INSTRUCTION
+        if system_prompt:
+            instruction = f'{instruction}\n\n{system_prompt}'
+        items = [{'id': index, 'prompt': prompt} for index, prompt in enumerate(prompts)]
+        return self.to_messages(json.dumps(items, ensure_ascii=False), instruction)
+
+    @staticmethod
+    def split_packed(content: str, count: int) -> List[str]:
+        """
+        拆分打包请求的输出
+
+        Raises:
+            PackedResponseError: 输出不是约定的JSON或缺少部分 id
+        """
+        text = content.strip()
+        if text.startswith('```'):
+            # 去掉 markdown 代码块
+            text = text.split('\n', 1)[-1].rsplit('```', 1)[0]
+        try:
+            results = json.loads(text)['results']
+            contents = {int(item['id']): item['content'] for item in results}
+        except (ValueError, TypeError, KeyError) as exc:
+            raise PackedResponseError(f'打包响应无法解析: {exc}') from exc
+        missing = [index for index in range(count) if index not in contents]
+        if missing:
+            raise PackedResponseError(f'打包响应缺少 {len(missing)} 个结果')
+        # 模型偶尔把回答输出成对象, 原样序列化
+        return [
+            value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            for value in (contents[index] for index in range(count))
+        ]
+
+    async def chat_packed(self, prompts: List[str], system_prompt: Optional[str] = None,
+                          timeout: Optional[float] = None, **overrides) -> Dict[str, Any]:
+        """
+        把多个提示语打包成一次 Chat Completions 调用, 要求结构化输出后按 id 拆分
+
+        Returns:
+            {'contents', 'tokens_used', 'latency_ms', 'request', 'response'}, contents 与 prompts 一一对应
+
+        Raises:
+            PackedResponseError: 上游调用成功但输出无法拆分, exc.result 为 chat() 的原始结果
+            AIClientError: 请求失败
+        """
+        response_format = self.extra_config.get('packed_response_format', self.PACKED_RESPONSE_FORMAT)
+        if response_format:
+            overrides.setdefault('response_format', response_format)
+        result = await self.chat(self.to_packed_messages(prompts, system_prompt), timeout=timeout, **overrides)
+        try:
+            contents = self.split_packed(result['content'], len(prompts))
+        except PackedResponseError as exc:
+            exc.result = result
+            raise
+        return {**result, 'contents': contents}
+
+    async def stream_chat(self, messages: List[Dict[str, Any]], timeout: Optional[float] = None,
+                          **overrides) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式调用 Chat Completions, timeout 同 chat()
+
+        Yields:
+            {'type': 'delta', 'content'}: 每个增量片段
+            {'type': 'done', 'content', 'tokens_used', 'latency_ms', 'first_token_ms', 'request'}: 结束时一次
+
+        Raises:
+            AIClientError: 请求失败, status 对应 ModelUsageLog 状态
+        """
+        payload = self.build_payload(messages, stream=True, **overrides)
+        payload.setdefault('stream_options', {'include_usage': True})
+        timeout = self.request_timeout(timeout)
+        client = http_pool.get_client(self.endpoint)
+        started = time.monotonic()
+        first_token_ms = None
+        tokens_used = 0
+        parts: List[str] = []
+        try:
+            async with client.stream(
+                'POST', self.endpoint, json=payload, headers=self.headers, timeout=timeout,
+            ) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self.raise_for_status(response)
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError as exc:
+                        raise AIClientError(f'流式响应片段不是合法的JSON: {data[:200]}') from exc
+                    if not isinstance(chunk, dict):
+                        continue
+                    if chunk.get('usage'):
+                        tokens_used = chunk['usage'].get('total_tokens', tokens_used)
+                    choices = chunk.get('choices') or []
+                    delta = (choices[0].get('delta') or {}).get('content') if choices else None
+                    if not delta:
+                        continue
+                    if first_token_ms is None:
+                        first_token_ms = int((time.monotonic() - started) * 1000)
+                    parts.append(delta)
+                    yield {'type': 'delta', 'content': delta}
+        except httpx.TimeoutException as exc:
+            raise AIClientTimeoutError(f'请求超时({timeout}秒)') from exc
+        except httpx.HTTPError as exc:
+            raise AIClientError(f'请求失败: {exc}', status='error') from exc
+        yield {
+            'type': 'done',
+            'content': ''.join(parts),
+            'tokens_used': tokens_used,
+            'latency_ms': int((time.monotonic() - started) * 1000),
+            'first_token_ms': first_token_ms,
+            'request': payload,
+        }
+
+    async def stream_generate(self, prompt: str, system_prompt: Optional[str] = None,
+                              timeout: Optional[float] = None, **overrides) -> AsyncIterator[Dict[str, Any]]:
+        """单轮流式文本生成"""
+        async for event in self.stream_chat(self.to_messages(prompt, system_prompt), timeout=timeout, **overrides):
+            yield event
+
+    @staticmethod
+    def raise_for_status(response: httpx.Response) -> None:
+        """把上游错误转换成 AIClientError"""
+        if response.status_code < 400:
+            return
+        message = f'上游返回 {response.status_code}: {response.text[:500]}'
+        if response.status_code == 429:
+            raise AIClientRateLimitedError(message, status_code=response.status_code)
+        raise AIClientError(message, status_code=response.status_code)
+
+    @staticmethod
+    def extract_content(data: Dict[str, Any]) -> str:
+        """提取第一条候选的文本"""
+        choices = data.get('choices') or []
+        if not choices:
+            return ''
+        message = choices[0].get('message') or {}
+        return message.get('content') or choices[0].get('text') or ''
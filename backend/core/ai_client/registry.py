@@ -0,0 +1,173 @@
+"""
+执行器注册表
+职责: 把 executor_class 的点分路径解析为类并缓存, 每个提供商只保留一个客户端实例,
+收到更新的提供商配置(updated_at 更大)时重建; 被替换的实例等正在进行的调用结束后再关闭
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Tuple, Type
+
+from django.utils.module_loading import import_string
+
+from .base import BaseAIClient
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorImportError(ImportError):
+    """执行器类无法导入或不是 BaseAIClient 子类"""
+
+
+class ExecutorRegistry:
+    """
+    执行器注册表
+
+    - get_client(): 获取提供商当前的客户端实例
+    - lease(): 在调用期间持有客户端, 期间实例被替换或失效也不会被关闭
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes: Dict[str, Type[BaseAIClient]] = {}
+        # provider_id -> (updated_at, 客户端实例)
+        self._clients: Dict[str, Tuple[Any, BaseAIClient]] = {}
+        # id(客户端实例) -> 正在进行的调用数
+        self._leases: Dict[int, int] = {}
+        # 已被替换、等待调用结束后关闭的实例: id -> 实例
+        self._retired: Dict[int, BaseAIClient] = {}
+
+    def resolve(self, dotted_path: str) -> Type[BaseAIClient]:
+        """
+        解析执行器类, 同一路径只导入一次
+
+        Raises:
+            ExecutorImportError: 路径无法导入或不是执行器类
+        """
+        executor_class = self._classes.get(dotted_path)
+        if executor_class is not None:
+            return executor_class
+        try:
+            executor_class = import_string(dotted_path)
+        except ImportError as exc:
+            raise ExecutorImportError(f'无法导入执行器类 {dotted_path}: {exc}') from exc
+        if not (isinstance(executor_class, type) and issubclass(executor_class, BaseAIClient)):
+            raise ExecutorImportError(f'{dotted_path} 不是 BaseAIClient 的子类')
+        with self._lock:
+            self._classes[dotted_path] = executor_class
+        return executor_class
+
+    def is_resolvable(self, dotted_path: str) -> bool:
+        """执行器类路径是否可以解析"""
+        try:
+            self.resolve(dotted_path)
+        except ExecutorImportError:
+            return False
+        return True
+
+    @staticmethod
+    def get_executor_path(provider) -> str:
+        """提供商使用的执行器路径, 未配置时使用该类型的默认执行器"""
+        return provider.executor_class or provider.get_default_executor()
+
+    @staticmethod
+    def is_current(cached_updated_at, provider) -> bool:
+        """
+        缓存的实例是否不旧于传入的提供商配置
+        快照缓存或序列化器持有的旧快照(updated_at 更小)不会替换已按新配置创建的实例
+        """
+        if cached_updated_at is None or provider.updated_at is None:
+            return cached_updated_at == provider.updated_at
+        return provider.updated_at <= cached_updated_at
+
+    def get_client(self, provider) -> BaseAIClient:
+        """
+        获取提供商的客户端实例
+        只有传入的配置比缓存实例更新时才重建; 旧实例没有进行中的调用时立即关闭, 否则在最后一个调用结束后关闭
+        """
+        cached = self._clients.get(str(provider.id))
+        if cached is not None and self.is_current(cached[0], provider):
+            return cached[1]
+        executor_class = self.resolve(self.get_executor_path(provider))
+        with self._lock:
+            client, stale = self._checkout(provider, executor_class)
+        for client_to_close in stale:
+            self._close(client_to_close)
+        return client
+
+    @contextmanager
+    def lease(self, provider) -> Iterator[BaseAIClient]:
+        """
+        在一次调用期间持有提供商的客户端实例
+        期间实例即使被新配置替换或被 invalidate(), 也要等所有持有者退出后才关闭
+        """
+        executor_class = self.resolve(self.get_executor_path(provider))
+        with self._lock:
+            client, stale = self._checkout(provider, executor_class)
+            self._leases[id(client)] = self._leases.get(id(client), 0) + 1
+        for client_to_close in stale:
+            self._close(client_to_close)
+        try:
+            yield client
+        finally:
+            with self._lock:
+                remaining = self._leases.pop(id(client)) - 1
+                if remaining:
+                    self._leases[id(client)] = remaining
+                    client = None
+                else:
+                    client = self._retired.pop(id(client), None)
+            if client is not None:
+                self._close(client)
+
+    def invalidate(self, provider_id=None) -> None:
+        """丢弃指定提供商(或全部)的客户端实例"""
+        with self._lock:
+            if provider_id is None:
+                entries = list(self._clients.values())
+                self._clients.clear()
+            else:
+                entry = self._clients.pop(str(provider_id), None)
+                entries = [entry] if entry else []
+            stale = self._retire([client for _, client in entries])
+        for client in stale:
+            self._close(client)
+
+    def _checkout(self, provider, executor_class):
+        """
+        取出或重建提供商的客户端实例(调用方需持有锁)
+
+        Returns:
+            (客户端实例, 可以立即关闭的旧实例列表)
+        """
+        key = str(provider.id)
+        cached = self._clients.get(key)
+        if cached is not None and self.is_current(cached[0], provider):
+            return cached[1], []
+        client = executor_class(provider)
+        self._clients[key] = (provider.updated_at, client)
+        return client, self._retire([cached[1]] if cached is not None else [])
+
+    def _retire(self, clients) -> list:
+        """
+        处理被替换的实例(调用方需持有锁)
+        有进行中调用的实例等调用结束后关闭, 返回可以立即关闭的实例
+        """
+        ready = []
+        for client in clients:
+            if self._leases.get(id(client)):
+                self._retired[id(client)] = client
+            else:
+                ready.append(client)
+        return ready
+
+    @staticmethod
+    def _close(client: BaseAIClient) -> None:
+        try:
+            client.close()
+        except Exception:
+            logger.exception('关闭执行器 %r 失败', client)
+
+
+# 进程级共享的执行器注册表
+executor_registry = ExecutorRegistry()
@@ -0,0 +1,160 @@
+"""
+LLM响应缓存
+职责: 对字节级相同的请求(提供商、模型、规范化参数、提示语)复用之前的响应,
+内存层做 LRU + TTL, 可选的 SQLite 磁盘层让缓存在进程重启后仍然有效
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+
+from .fingerprint import request_fingerprint
+
+
+class ResponseCache:
+    """
+    两级响应缓存
+
+    - 内存层: OrderedDict 实现 LRU, 超过 max_entries 淘汰最久未使用的条目
+    - 磁盘层(可选): SQLite 表, 超过 max_disk_entries 时按最近访问时间淘汰
+    - temperature > 0 的请求结果不确定, 默认不缓存, 调用方可显式开启
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, disk_path: Optional[str] = None,
+                 max_disk_entries: int = 100000, cache_nondeterministic: bool = False, enabled: bool = True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.cache_nondeterministic = cache_nondeterministic
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # key -> (过期时间, 值)
+        self._memory: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._local = threading.local()
+        self._disk_writes = 0
+        if disk_path:
+            self._init_disk()
+
+    @classmethod
+    def from_settings(cls) -> 'ResponseCache':
+        """根据 settings.LLM_RESPONSE_CACHE 创建缓存"""
+        config = getattr(settings, 'LLM_RESPONSE_CACHE', {})
+        disk_path = config.get('DISK_PATH')
+        return cls(
+            max_entries=config.get('MAX_ENTRIES', 1024),
+            ttl=config.get('TTL', 3600.0),
+            disk_path=str(disk_path) if disk_path else None,
+            max_disk_entries=config.get('MAX_DISK_ENTRIES', 100000),
+            cache_nondeterministic=config.get('CACHE_NONDETERMINISTIC', False),
+            enabled=config.get('ENABLED', True),
+        )
+
+    @staticmethod
+    def make_key(provider_id, model_name: str, params: Dict[str, Any], prompt: Any) -> str:
+        """计算缓存键, 见 request_fingerprint"""
+        return request_fingerprint(provider_id, model_name, params, prompt)
+
+    def should_cache(self, params: Dict[str, Any], allow_nondeterministic: Optional[bool] = None) -> bool:
+        """
+        请求是否可以走缓存
+        temperature > 0 时输出带随机性, 只有显式开启才缓存
+        """
+        if not self.enabled:
+            return False
+        temperature = params.get('temperature')
+        if temperature is None or temperature <= 0:
+            return True
+        if allow_nondeterministic is None:
+            return self.cache_nondeterministic
+        return allow_nondeterministic
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存, 未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+        if not self.disk_path:
+            return None
+        row = self._disk().execute(
+            'SELECT value, expires_at FROM response_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        self._disk().execute('UPDATE response_cache SET accessed_at = ? WHERE key = ?', (now, key))
+        value = json.loads(row[0])
+        self._remember(key, row[1], value)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        """写入缓存(值需要可以JSON序列化)"""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        self._remember(key, expires_at, value)
+        if not self.disk_path:
+            return
+        connection = self._disk()
+        connection.execute(
+            'INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), expires_at, now),
+        )
+        self._disk_writes += 1
+        # 每写入一定次数做一次过期清理和容量淘汰, 避免每次写入都扫表
+        if self._disk_writes % 100 == 0:
+            self._evict_disk(now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self.disk_path:
+            self._disk().execute('DELETE FROM response_cache')
+
+    def _remember(self, key: str, expires_at: float, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _disk(self) -> sqlite3.Connection:
+        """每个线程一个 SQLite 连接(autocommit)"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.disk_path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _init_disk(self) -> None:
+        directory = os.path.dirname(self.disk_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._disk()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)')
+
+    def _evict_disk(self, now: float) -> None:
+        connection = self._disk()
+        connection.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+        connection.execute(
+            'DELETE FROM response_cache WHERE key IN ('
+            'SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_disk_entries,),
+        )
+
+
+# 进程级共享的响应缓存
+response_cache = ResponseCache.from_settings()
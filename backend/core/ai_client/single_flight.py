@@ -0,0 +1,86 @@
+"""
+请求合并(single-flight)
+职责: 同一时刻键相同的多个调用只执行一次, 其余调用等待并共享这次的结果
+"""
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class LeaderCancelled(Exception):
+    """leader 被取消, 等待者需要重新选举 leader"""
+
+
+class SingleFlight:
+    """
+    按键合并并发调用
+
+    在途调用用 concurrent.futures.Future 表示, 因此不同线程/事件循环
+    (如 async_to_sync 为每次调用创建的事件循环)中的相同请求也能合并。
+    leader 被取消时不会把 CancelledError 传给等待者, 而是由等待者重新选出 leader 执行自己的 call;
+    等待者被取消也不会影响 leader 和其他等待者
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+
+    def inflight_count(self) -> int:
+        with self._lock:
+            return len(self._inflight)
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行或加入一次调用
+
+        Args:
+            key: 合并键
+            call: 无参协程函数, 只有 leader 会执行; leader 被取消后由某个等待者执行它自己的 call
+
+        Returns:
+            (结果, 是否共享了其他调用者的结果)
+
+        Raises:
+            call 抛出的异常(取消除外)会同样抛给所有等待者
+        """
+        while True:
+            with self._lock:
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = concurrent.futures.Future()
+                    self._inflight[key] = future
+            if leader:
+                break
+            try:
+                # shield: 等待者被取消时不取消共享的 future
+                return await asyncio.shield(asyncio.wrap_future(future)), True
+            except LeaderCancelled:
+                continue
+
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self._settle(key, future, exception=LeaderCancelled())
+            raise
+        except BaseException as exc:
+            self._settle(key, future, exception=exc)
+            raise
+        self._settle(key, future, result=result)
+        return result, False
+
+    def _settle(self, key: str, future: concurrent.futures.Future, result: Any = None,
+                exception: Optional[BaseException] = None) -> None:
+        """先移出在途表再设置结果, 重新选举的等待者不会再拿到这个 future"""
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+# 进程级共享的请求合并器
+single_flight = SingleFlight()